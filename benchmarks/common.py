@@ -0,0 +1,122 @@
+"""Result reporting and baseline comparison shared by the benchmark scripts."""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+from pathlib import Path
+from typing import Any
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+BASELINES_DIR = Path(__file__).resolve().parent / "baselines"
+
+# Metrics named like these are better when higher; every other metric
+# (latencies, memory, error rates) is better when lower.
+_HIGHER_IS_BETTER = ("_per_sec",)
+# Tail latencies vary too much between runs on shared machines to gate on;
+# they are reported and saved, but not compared.
+_NOT_COMPARED = ("p99_",)
+
+Results = dict[str, dict[str, float]]
+
+
+def use_src() -> None:
+    """Make the service modules importable, as when running from ``src``."""
+    sys.path.insert(0, str(SRC_DIR))
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """The ``q``-th percentile (0-100) of ``samples``, interpolated."""
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[
+        min(max(round(q) - 1, 0), 98)
+    ]
+
+
+def add_baseline_arguments(parser: argparse.ArgumentParser, suite: str) -> None:
+    default = BASELINES_DIR / f"{suite}.json"
+    parser.add_argument(
+        "--save",
+        nargs="?",
+        const=default,
+        type=Path,
+        help=f"write the results as the new baseline (default: {default})",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=default,
+        type=Path,
+        help=f"compare against a baseline and exit 1 on regression (default: {default})",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative regression per metric when comparing (default: 0.2)",
+    )
+
+
+def finish(args: argparse.Namespace, suite: str, results: Results) -> int:
+    """Print ``results``, then save and/or compare them as requested; returns the exit code."""
+    _print_table(results)
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        document = {
+            "suite": suite,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        args.save.write_text(json.dumps(document, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline written to {args.save}")
+
+    if not args.compare:
+        return 0
+    baseline: Results = json.loads(args.compare.read_text())["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nRegressions against {args.compare} (tolerance {args.tolerance:.0%}):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regression against {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+def compare(results: Results, baseline: Results, tolerance: float) -> list[str]:
+    """Metrics of ``results`` worse than ``baseline`` by more than ``tolerance``."""
+    regressions = []
+    for name, metrics in baseline.items():
+        for metric, expected in metrics.items():
+            actual = results.get(name, {}).get(metric)
+            if actual is None or metric.startswith(_NOT_COMPARED):
+                continue
+            if not expected:
+                if actual > 0 and not metric.endswith(_HIGHER_IS_BETTER):
+                    regressions.append(f"{name}.{metric}: {_format(actual)} vs 0")
+                continue
+            change = (actual - expected) / expected
+            if metric.endswith(_HIGHER_IS_BETTER):
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{name}.{metric}: {_format(actual)} vs {_format(expected)} "
+                    f"({change:+.0%} worse)"
+                )
+    return regressions
+
+
+def _format(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:,.1f}" if abs(value) >= 100 else f"{value:.3g}"
+    return str(value)
+
+
+def _print_table(results: Results) -> None:
+    width = max(len(name) for name in results)
+    for name, metrics in results.items():
+        values = "  ".join(f"{metric}={_format(value)}" for metric, value in metrics.items())
+        print(f"{name:<{width}}  {values}")
@@ -0,0 +1,297 @@
+"""End-to-end load test of ``POST /notifications/send-email``.
+
+    uv run --with aiosmtpd python benchmarks/load.py [--requests 500] [--concurrency 50]
+        [--smtp-delay 0.05] [--web-workers 1] [--transport smtp] [--save] [--compare]
+
+Starts a stand-in SMTP server (aiosmtpd, answering each message after
+``--smtp-delay`` seconds) and the service itself with ``serve.py``, then
+sends ``--requests`` notifications from ``--concurrency`` concurrent clients
+and waits until the SMTP server received all of them. Reports request
+throughput and latency, delivered emails per second, and the server's
+resident memory per queued message at the peak of the backlog (Linux only,
+most meaningful with one web worker).
+
+With ``--transport null`` the service discards messages after rendering
+them, and emails per second are read from its ``/metrics`` instead.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import httpx
+
+from common import SRC_DIR, Results, add_baseline_arguments, finish, percentile
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:
+    sys.exit("The load test needs aiosmtpd: uv run --with aiosmtpd python benchmarks/load.py")
+
+API_KEY = "benchmark"
+PAYLOAD = {
+    "subject": "Load test",
+    "templateVariables": {
+        "headline": "Your weekly report is ready",
+        "body": "Here is a summary of your account activity for the past week.",
+        "actionUrl": "https://app.example.com/reports/weekly",
+    },
+    "to": ["load@example.com"],
+}
+
+
+class DelayedHandler:
+    """Accepts every message after a fixed delay and records when it arrived."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.received = 0
+        self.last_received = 0.0
+        self.all_received = threading.Event()
+        self.expected: int | None = None
+
+    async def handle_DATA(self, server, session, envelope) -> str:  # noqa: ANN001
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+        self.last_received = time.perf_counter()
+        if self.expected is not None and self.received >= self.expected:
+            self.all_received.set()
+        return "250 OK"
+
+
+def accept_any_login(*args: object) -> AuthResult:
+    return AuthResult(success=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> int | None:
+    """Resident memory of ``pid`` and its children, from ``/proc``."""
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
+    pids = [pid]
+    children = proc / str(pid) / "task" / str(pid) / "children"
+    if children.is_file():
+        pids += [int(child) for child in children.read_text().split()]
+    total = 0
+    for p in pids:
+        for line in (proc / str(p) / "status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+def metric_value(metrics: str, name: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith(f"{name} "):
+            return float(line.split()[1])
+    return 0.0
+
+
+async def wait_for_smtp(
+    handler: DelayedHandler, accepted: int, timeout: float
+) -> tuple[int, float]:
+    """Wait until the stand-in SMTP server received ``accepted`` emails."""
+    handler.expected = accepted
+    if handler.received >= accepted:
+        handler.all_received.set()
+    await asyncio.to_thread(handler.all_received.wait, timeout)
+    return handler.received, handler.last_received
+
+
+async def wait_for_metrics(
+    client: httpx.AsyncClient, accepted: int, timeout: float
+) -> tuple[int, float]:
+    """Wait until the service reports ``accepted`` emails delivered."""
+    deadline = time.monotonic() + timeout
+    while True:
+        metrics = (await client.get("/metrics")).text
+        delivered = int(metric_value(metrics, "notifications_delivered_total"))
+        if delivered >= accepted or time.monotonic() > deadline:
+            return delivered, time.perf_counter()
+        await asyncio.sleep(0.01)
+
+
+def start_server(args: argparse.Namespace, smtp_port: int, port: int) -> subprocess.Popen[bytes]:
+    env = {
+        **os.environ,
+        "API_KEY": API_KEY,
+        "API_KEYS": "{}",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_USE_TLS": "false",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "WEB_WORKERS": str(args.web_workers),
+        "TRANSPORT_BACKEND": args.transport,
+        "WEB_ACCESS_LOG": "false",
+        "RATE_LIMIT_REQUESTS": str(10**9),
+        "RATE_LIMIT_WINDOW": "second",
+        "ENABLE_CSRF": "false",
+        "QUEUE_MAX_SIZE": str(max(args.requests, 10_000)),
+        "DEBUG": "false",
+    }
+    return subprocess.Popen(
+        [sys.executable, "serve.py"],
+        cwd=SRC_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.server_logs else subprocess.DEVNULL,
+    )
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("Service did not become ready")
+        await asyncio.sleep(0.1)
+
+
+async def run_load(
+    args: argparse.Namespace, client: httpx.AsyncClient, server_pid: int
+) -> tuple[list[float], dict[int, int], float, list[tuple[int, float]]]:
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    samples: list[tuple[int, float]] = []
+    remaining = args.requests
+    done = asyncio.Event()
+
+    async def client_loop() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            response = await client.post(
+                "/notifications/send-email", json=PAYLOAD, headers={"X-API-KEY": API_KEY}
+            )
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def sample_memory() -> None:
+        while not done.is_set():
+            rss = rss_bytes(server_pid)
+            if rss is not None:
+                metrics = (await client.get("/metrics")).text
+                samples.append((rss, metric_value(metrics, "notifications_queue_depth")))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+    return latencies, statuses, elapsed, samples
+
+
+async def benchmark(args: argparse.Namespace) -> Results:
+    handler = DelayedHandler(args.smtp_delay)
+    smtp = Controller(
+        handler,
+        hostname="127.0.0.1",
+        port=free_port(),
+        authenticator=accept_any_login,
+        auth_require_tls=False,
+    )
+    smtp.start()
+    port = free_port()
+    server = start_server(args, smtp.port, port)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}",
+            limits=httpx.Limits(max_connections=args.concurrency + 1),
+            timeout=60.0,
+        ) as client:
+            await wait_until_ready(client)
+            idle_rss = rss_bytes(server.pid)
+
+            started = time.perf_counter()
+            latencies, statuses, elapsed, samples = await run_load(args, client, server.pid)
+            accepted = statuses.get(201, 0)
+            if args.transport == "smtp":
+                delivered, finished = await wait_for_smtp(
+                    handler, accepted, args.drain_timeout
+                )
+            else:
+                delivered, finished = await wait_for_metrics(
+                    client, accepted, args.drain_timeout
+                )
+            if delivered < accepted:
+                print(
+                    f"Only {delivered} of {accepted} emails were delivered "
+                    f"within {args.drain_timeout}s",
+                    file=sys.stderr,
+                )
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        smtp.stop()
+
+    errors = sum(count for status, count in statuses.items() if status != 201)
+    if errors:
+        print(f"Non-201 responses: {statuses}", file=sys.stderr)
+
+    result = {
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+        "emails_per_sec": delivered / (finished - started),
+        "error_rate": errors / len(latencies),
+    }
+    peak = max(samples, key=lambda sample: sample[1], default=None)
+    if idle_rss is not None and peak is not None and peak[1] > 0:
+        result["bytes_per_queued_message"] = (peak[0] - idle_rss) / peak[1]
+    return {"send_email": result}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="notifications to send")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent clients")
+    parser.add_argument(
+        "--smtp-delay", type=float, default=0.05, help="seconds the SMTP server takes per message"
+    )
+    parser.add_argument("--web-workers", type=int, default=1, help="WEB_WORKERS of the service")
+    parser.add_argument(
+        "--transport",
+        choices=["smtp", "null"],
+        default="smtp",
+        help="TRANSPORT_BACKEND of the service; null measures everything but delivery",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=300.0,
+        help="seconds to wait for queued emails to reach the SMTP server",
+    )
+    parser.add_argument("--server-logs", action="store_true", help="show the service's logs")
+    add_baseline_arguments(parser, "load")
+    args = parser.parse_args()
+    return finish(args, "load", asyncio.run(benchmark(args)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
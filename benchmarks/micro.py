@@ -0,0 +1,135 @@
+"""Micro-benchmarks of the CPU-bound steps of a send.
+
+    python benchmarks/micro.py [--min-time 1.0] [--save] [--compare]
+
+Each case is timed call by call for at least ``--min-time`` seconds after a
+warm-up, and reported as calls per second (at the median) with p50/p99
+latency. Rendering a full message also reports the peak memory allocated
+while building it next to the size of the message, and logging reports what
+a log call costs the caller.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+from common import Results, add_baseline_arguments, finish, percentile, use_src
+
+use_src()
+
+from logs import JSONFormatter, QueueLogHandler  # noqa: E402
+from rendering import MessageRenderer, RenderJob  # noqa: E402
+from schemas import EmailInput, NotificationTemplateVariables  # noqa: E402
+
+PLAIN_VARIABLES = {
+    "headline": "Your weekly report is ready",
+    "body": "Here is a summary of your account activity for the past week. " * 8,
+    "badge": "Report",
+    "actionUrl": "https://app.example.com/reports/weekly",
+    "actionLabel": "Open Report",
+    "footerNote": "This is an automated message, please do not reply.",
+}
+MARKUP_VARIABLES = {
+    **PLAIN_VARIABLES,
+    "body": "Here is <b>your</b> summary &amp; <script>alert(1)</script> activity. " * 8,
+}
+EMAIL_INPUT = {
+    "subject": "Weekly report",
+    "templateVariables": PLAIN_VARIABLES,
+    "to": ["jane@example.com"],
+    "previewText": "Your weekly report is ready",
+}
+
+
+def bench(fn: Callable[[], Any], min_time: float) -> dict[str, float]:
+    for _ in range(10):
+        fn()
+    samples: list[float] = []
+    gc.collect()
+    started = time.perf_counter()
+    while time.perf_counter() - started < min_time:
+        call_started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - call_started)
+    median = percentile(samples, 50)
+    return {
+        # From the median rather than the mean, so that pauses do not skew it.
+        "ops_per_sec": 1 / median,
+        "p50_us": median * 1e6,
+        "p99_us": percentile(samples, 99) * 1e6,
+    }
+
+
+def peak_bytes(fn: Callable[[], Any]) -> float:
+    fn()
+    tracemalloc.start()
+    try:
+        fn()
+        return float(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--min-time", type=float, default=1.0, help="seconds spent timing each case"
+    )
+    add_baseline_arguments(parser, "micro")
+    args = parser.parse_args()
+
+    renderer = MessageRenderer.create()
+    renderer.load()
+    variables = NotificationTemplateVariables.model_validate(PLAIN_VARIABLES)
+    template_variables = {
+        "subject": "Weekly report",
+        **{k: v if v is not None else "" for k, v in variables.model_dump().items()},
+    }
+    job = RenderJob(
+        template="notification",
+        subject="Weekly report",
+        preview_text=None,
+        variables=variables.model_dump(),
+        to=["jane@example.com"],
+        cc=[],
+    )
+
+    # What logging costs the caller; lines are formatted and discarded by the writer thread.
+    log_handler = QueueLogHandler(JSONFormatter(), 100_000, 100, open(os.devnull, "w"))
+    log = logging.getLogger("benchmark")
+    log.propagate = False
+    log.addHandler(log_handler)
+    log.setLevel(logging.INFO)
+    log_extra = {"recipients": 1, "sender": "noreply@example.com", "subject": "Weekly report"}
+
+    cases: dict[str, Callable[[], Any]] = {
+        "validate_variables_plain": lambda: NotificationTemplateVariables.model_validate(
+            PLAIN_VARIABLES
+        ),
+        "validate_variables_markup": lambda: NotificationTemplateVariables.model_validate(
+            MARKUP_VARIABLES
+        ),
+        "validate_email_input": lambda: EmailInput.model_validate(EMAIL_INPUT),
+        "render_html": lambda: renderer.templates.render("notification", template_variables),
+        "render_message": lambda: renderer.render(job),
+        "render_cache_key": lambda: renderer.cache_key(job),
+        "log_record": lambda: log.info("Email sent successfully", extra=log_extra),
+    }
+    results: Results = {}
+    for name, fn in cases.items():
+        results[name] = bench(fn, args.min_time)
+    # Peak memory of building one message, against the size of the message
+    # itself: what each message in flight costs before it reaches a transport.
+    results["render_message"]["peak_bytes"] = peak_bytes(lambda: renderer.render(job))
+    results["render_message"]["message_bytes"] = float(len(renderer.render(job)))
+    return finish(args, "micro", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,9 @@
 #!/bin/sh
 set -e
 
-exec litestar --app main:app run --host 0.0.0.0 --port "${PORT:-8000}"
+if [ "$1" = "worker" ]; then
+    exec python worker.py
+fi
+
+# WEB_WORKERS (default 1) sets the number of forked HTTP worker processes
+exec python serve.py
@@ -0,0 +1,260 @@
+"""Cache of pre-encoded inline images referenced by the email templates.
+
+Run ``python assets.py optimize`` at image build time to losslessly shrink
+the configured PNG assets in place, so every message carries fewer bytes.
+"""
+
+import logging
+import struct
+import sys
+import time
+import zlib
+from collections.abc import Iterator
+from dataclasses import dataclass
+from email.mime.image import MIMEImage
+from pathlib import Path
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Ancillary chunks that affect how the image looks; optimize_png drops the
+# others (text, timestamps, EXIF, ...).
+_PNG_RENDERING_CHUNKS = {b"PLTE", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT"}
+# Samples per pixel for each PNG color type.
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+@dataclass(frozen=True)
+class InlineAsset:
+    """An image part that is built and serialized once, then shared by every message.
+
+    ``encoded`` is the whole part as it appears in a message: its headers
+    and the base64-encoded image.
+    """
+
+    content_id: str
+    path: Path
+    mtime_ns: int
+    encoded: bytes
+
+
+class StaticAssetCache:
+    """Maps template content-ids (``cid:...``) to cached, serialized image parts.
+
+    Files are read and encoded once, and their modification time is checked
+    at most every ``reload_interval`` seconds so that replacing an image on
+    disk is picked up without a restart.
+    """
+
+    def __init__(
+        self, static_dir: Path, assets: dict[str, str], reload_interval: float
+    ) -> None:
+        self.static_dir = static_dir
+        self.assets = assets
+        self.reload_interval = reload_interval
+        self._cache: dict[str, InlineAsset] = {}
+        self._checked_at: dict[str, float] = {}
+        self._missing: set[str] = set()
+        for content_id in assets:
+            self.get(content_id)
+
+    def get(self, content_id: str) -> InlineAsset | None:
+        """Return the cached asset for ``content_id``, reloading it if the file changed."""
+        cached = self._cache.get(content_id)
+        now = time.monotonic()
+        checked_at = self._checked_at.get(content_id)
+        if checked_at is not None and now - checked_at < self.reload_interval:
+            return cached
+
+        self._checked_at[content_id] = now
+        path = self.static_dir / self.assets[content_id]
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except OSError:
+            if content_id not in self._missing:
+                self._missing.add(content_id)
+                logger.warning(
+                    "Inline asset not found, it will be omitted from emails",
+                    extra={"content_id": content_id, "path": str(path)},
+                )
+            self._cache.pop(content_id, None)
+            return None
+        self._missing.discard(content_id)
+
+        if cached and cached.mtime_ns == mtime_ns:
+            return cached
+
+        self._cache[content_id] = asset = self._load(content_id, path, mtime_ns)
+        return asset
+
+    def version(self) -> tuple[int | None, ...]:
+        """Modification time of each configured asset; changes when any is replaced."""
+        return tuple(
+            asset.mtime_ns if (asset := self.get(content_id)) else None
+            for content_id in self.assets
+        )
+
+    def referenced_by(self, html: str) -> list[InlineAsset]:
+        """Return the assets for every configured content-id that ``html`` references."""
+        assets = []
+        for content_id in self.assets:
+            if f"cid:{content_id}" in html and (asset := self.get(content_id)):
+                assets.append(asset)
+        return assets
+
+    def _load(self, content_id: str, path: Path, mtime_ns: int) -> InlineAsset:
+        image = MIMEImage(path.read_bytes())
+        image.add_header("Content-ID", f"<{content_id}>")
+        image.add_header("Content-Disposition", "inline", filename=path.name)
+        logger.debug(
+            "Loaded inline asset", extra={"content_id": content_id, "path": str(path)}
+        )
+        return InlineAsset(
+            content_id=content_id, path=path, mtime_ns=mtime_ns, encoded=image.as_bytes()
+        )
+
+
+def _png_chunks(data: bytes) -> Iterator[tuple[bytes, bytes]]:
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG image")
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        yield kind, data[offset + 8 : offset + 8 + length]
+        offset += 12 + length
+
+
+def _png_chunk(kind: bytes, body: bytes) -> bytes:
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+
+def _paeth(left: int, up: int, up_left: int) -> int:
+    estimate = left + up - up_left
+    to_left, to_up, to_up_left = abs(estimate - left), abs(estimate - up), abs(estimate - up_left)
+    if to_left <= to_up and to_left <= to_up_left:
+        return left
+    return up if to_up <= to_up_left else up_left
+
+
+def _unfilter(raw: bytes, stride: int, bpp: int) -> list[bytes]:
+    """Undo the per-scanline filters of decompressed PNG data."""
+    rows: list[bytes] = []
+    previous = bytes(stride)
+    for start in range(0, len(raw), stride + 1):
+        kind = raw[start]
+        row = bytearray(raw[start + 1 : start + 1 + stride])
+        for x in range(stride):
+            left = row[x - bpp] if x >= bpp else 0
+            up = previous[x]
+            if kind == 1:
+                row[x] = (row[x] + left) & 0xFF
+            elif kind == 2:
+                row[x] = (row[x] + up) & 0xFF
+            elif kind == 3:
+                row[x] = (row[x] + (left + up) // 2) & 0xFF
+            elif kind == 4:
+                up_left = previous[x - bpp] if x >= bpp else 0
+                row[x] = (row[x] + _paeth(left, up, up_left)) & 0xFF
+        rows.append(previous := bytes(row))
+    return rows
+
+
+def _filter(rows: list[bytes], bpp: int) -> bytes:
+    """Filter each scanline with whichever PNG filter leaves the smallest residuals.
+
+    This is the minimum sum of absolute differences heuristic from the PNG
+    specification, which usually compresses best.
+    """
+    out = bytearray()
+    previous = bytes(len(rows[0])) if rows else b""
+    for row in rows:
+        left = bytes(bpp) + row[:-bpp]
+        up_left = bytes(bpp) + previous[:-bpp]
+        candidates = [
+            row,
+            bytes((x - a) & 0xFF for x, a in zip(row, left)),
+            bytes((x - b) & 0xFF for x, b in zip(row, previous)),
+            bytes((x - (a + b) // 2) & 0xFF for x, a, b in zip(row, left, previous)),
+            bytes(
+                (x - _paeth(a, b, c)) & 0xFF
+                for x, a, b, c in zip(row, left, previous, up_left)
+            ),
+        ]
+        kind = min(
+            range(len(candidates)),
+            key=lambda k: sum(v if v < 128 else 256 - v for v in candidates[k]),
+        )
+        out.append(kind)
+        out += candidates[kind]
+        previous = row
+    return bytes(out)
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Losslessly re-encode a PNG image, returning ``data`` if that is not smaller.
+
+    Scanlines are re-filtered and recompressed at the highest zlib level,
+    and metadata chunks that do not affect rendering are dropped. Interlaced
+    images are only recompressed.
+    """
+    header = b""
+    chunks: list[bytes] = []
+    idat: list[bytes] = []
+    for kind, body in _png_chunks(data):
+        if kind == b"IHDR":
+            header = body
+        elif kind == b"IDAT":
+            idat.append(body)
+        elif kind in _PNG_RENDERING_CHUNKS:
+            chunks.append(_png_chunk(kind, body))
+    width, _, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", header)
+
+    raw = zlib.decompress(b"".join(idat))
+    if not interlace:
+        bits = depth * _PNG_CHANNELS[color]
+        bpp = max(bits // 8, 1)
+        raw = _filter(_unfilter(raw, (width * bits + 7) // 8, bpp), bpp)
+
+    def compress(strategy: int) -> bytes:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        return compressor.compress(raw) + compressor.flush()
+
+    compressed = min(
+        (compress(strategy) for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED)),
+        key=len,
+    )
+    optimized = b"".join(
+        [
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", header),
+            *chunks,
+            _png_chunk(b"IDAT", compressed),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+    return optimized if len(optimized) < len(data) else data
+
+
+def optimize_assets(static_dir: Path, assets: dict[str, str]) -> None:
+    """Rewrite every PNG in ``assets`` with :func:`optimize_png`, in place."""
+    for name in sorted(set(assets.values())):
+        path = static_dir / name
+        data = path.read_bytes()
+        if not data.startswith(PNG_SIGNATURE):
+            logger.info("Skipped %s, not a PNG image", name)
+            continue
+        optimized = optimize_png(data)
+        if optimized is not data:
+            path.write_bytes(optimized)
+        logger.info("Optimized %s: %d -> %d bytes", name, len(data), len(optimized))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) != 2 or sys.argv[1] != "optimize":
+        sys.exit("usage: python assets.py optimize")
+    optimize_assets(STATIC_DIR, settings.inline_assets)
@@ -1,6 +1,15 @@
-"""API Key authentication middleware using Litestar's AbstractAuthenticationMiddleware."""
+"""API Key authentication middleware using Litestar's AbstractAuthenticationMiddleware.
 
+Run ``python auth.py hash <key>`` to get the digest to put in ``API_KEYS``.
+"""
+
+import hashlib
 import logging
+import sys
+import time
+from collections import Counter as Tally, OrderedDict
+from dataclasses import dataclass
+
 from litestar.connection import ASGIConnection
 from litestar.exceptions import NotAuthorizedException
 from litestar.middleware.authentication import (
@@ -8,11 +17,115 @@ from litestar.middleware.authentication import (
     AuthenticationResult,
 )
 
-from config import settings
+from config import SecuritySettings, settings
+from metrics import AUTH_ATTEMPTS
 
 logger = logging.getLogger(__name__)
 
 
+def hash_key(api_key: str) -> str:
+    """SHA-256 hex digest of an API key.
+
+    A fast hash is enough: keys are long random tokens, not passwords.
+    """
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+@dataclass
+class APIKey:
+    name: str
+    digest: bytes
+
+
+class APIKeyIndex:
+    """Resolves a presented key to its :class:`APIKey` without storing keys in clear.
+
+    Keys are indexed by digest, so a lookup costs one hash and one dict probe
+    regardless of how many keys are configured. The probe compares digests,
+    not keys: its timing can only tell how close the SHA-256 of a guess is to
+    a stored digest, which does not help find a key. Recently verified keys
+    are kept in a small LRU so hot clients skip the hash entirely; only valid
+    keys ever enter it.
+    """
+
+    def __init__(self, keys: list[APIKey], cache_size: int) -> None:
+        self._by_digest = {key.digest: key for key in keys}
+        self._verified: OrderedDict[str, APIKey] = OrderedDict()
+        self._cache_size = cache_size
+
+    @classmethod
+    def from_settings(cls, security: SecuritySettings) -> "APIKeyIndex":
+        if security.api_keys:
+            keys = [
+                APIKey(name, bytes.fromhex(spec.sha256))
+                for name, spec in security.api_keys.items()
+            ]
+        else:
+            keys = [APIKey("default", bytes.fromhex(hash_key(security.api_key)))]
+        return cls(keys, security.api_key_cache_size)
+
+    def lookup(self, api_key: str) -> APIKey | None:
+        if (key := self._verified.get(api_key)) is not None:
+            self._verified.move_to_end(api_key)
+            return key
+
+        digest = hashlib.sha256(api_key.encode()).digest()
+        key = self._by_digest.get(digest)
+        if key is None:
+            return None
+
+        self._verified[api_key] = key
+        if len(self._verified) > self._cache_size:
+            self._verified.popitem(last=False)
+        return key
+
+
+class AuthLog:
+    """Aggregates authentication outcomes into one log line per interval.
+
+    Successes are only counted. The first failure of each kind in an interval
+    is logged with the client address, the rest are counted.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._outcomes: Tally[tuple[str, str]] = Tally()
+        self._warned: set[str] = set()
+        self._since = time.monotonic()
+
+    def record(self, result: str, key: str) -> None:
+        AUTH_ATTEMPTS.inc(result=result, key=key)
+        self._outcomes[result, key] += 1
+        self._flush_if_due()
+
+    def failure(self, result: str, message: str, connection: ASGIConnection) -> None:
+        if result not in self._warned:
+            self._warned.add(result)
+            logger.warning(
+                message,
+                connection.client.host if connection.client else "unknown",
+            )
+        self.record(result, "")
+
+    def _flush_if_due(self) -> None:
+        now = time.monotonic()
+        if now - self._since < self.interval:
+            return
+        logger.info(
+            "Authentication summary",
+            extra={
+                "interval": round(now - self._since, 1),
+                "outcomes": {
+                    f"{result}:{key}" if key else result: count
+                    for (result, key), count in self._outcomes.items()
+                },
+            },
+        )
+        self._outcomes.clear()
+        self._warned.clear()
+        self._since = now
+
+
 class APIKeyAuthMiddleware(AbstractAuthenticationMiddleware):
     """Middleware to authenticate requests using X-API-KEY header."""
 
@@ -24,8 +137,12 @@ class APIKeyAuthMiddleware(AbstractAuthenticationMiddleware):
         "/swagger",
         "/redoc",
         "/health",
+        "/metrics",
     }
 
+    keys = APIKeyIndex.from_settings(settings.security)
+    auth_log = AuthLog(settings.security.auth_log_interval)
+
     async def authenticate_request(
         self, connection: ASGIConnection
     ) -> AuthenticationResult:
@@ -35,7 +152,7 @@ class APIKeyAuthMiddleware(AbstractAuthenticationMiddleware):
             connection: The ASGI connection object containing request data.
 
         Returns:
-            AuthenticationResult with authenticated user data.
+            AuthenticationResult with the name of the authenticated key.
 
         Raises:
             NotAuthorizedException: If API key is missing or invalid.
@@ -48,22 +165,27 @@ class APIKeyAuthMiddleware(AbstractAuthenticationMiddleware):
         api_key = connection.headers.get("X-API-KEY")
 
         if not api_key:
-            logger.warning(
+            self.auth_log.failure(
+                "missing",
                 "Authentication failed: Missing X-API-KEY header from %s",
-                connection.client.host if connection.client else "unknown",
+                connection,
             )
             raise NotAuthorizedException(detail="Missing X-API-KEY header")
 
-        if api_key != settings.security.api_key:
-            logger.warning(
-                "Authentication failed: Invalid API key from %s",
-                connection.client.host if connection.client else "unknown",
+        key = self.keys.lookup(api_key)
+        if key is None:
+            self.auth_log.failure(
+                "invalid", "Authentication failed: Invalid API key from %s", connection
             )
             raise NotAuthorizedException(detail="Invalid API key")
 
-        logger.info(
-            "Authentication successful from %s",
-            connection.client.host if connection.client else "unknown",
+        self.auth_log.record("success", key.name)
+        return AuthenticationResult(
+            user={"authenticated": True, "key": key.name}, auth=key.name
         )
 
-        return AuthenticationResult(user={"authenticated": True}, auth=api_key)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "hash":
+        sys.exit("usage: python auth.py hash <key>")
+    print(hash_key(sys.argv[2]))
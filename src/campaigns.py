@@ -0,0 +1,621 @@
+"""Campaigns: one notification sent to every recipient of an uploaded list.
+
+A campaign is created as a draft, then its recipient list is uploaded as CSV
+or NDJSON. The upload is parsed and validated row by row as it streams in,
+and valid rows are spooled to a local file, so memory does not grow with the
+size of the list. A :class:`CampaignRunner` task then moves recipients from
+the spool to the outbox in chunks, and only while the outbox holds less than
+``CAMPAIGN_QUEUE_SHARE`` of ``QUEUE_MAX_SIZE``: the workers drain the queue
+under the relay's send limits, which therefore pace the campaign, and the
+rest of the queue stays free for other notifications.
+
+Status and counters live in a :class:`CampaignStore`, in memory or in Redis,
+so that any process can report progress and pause, resume or cancel a
+campaign. Recipients are queued by the process the list was uploaded to.
+"""
+
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import re
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from collections.abc import AsyncIterable, AsyncIterator, Collection
+from contextlib import suppress
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import IO, Any
+from uuid import uuid4
+
+from litestar.exceptions import ClientException
+from pydantic import ValidationError
+from pydantic.alias_generators import to_camel
+from redis.asyncio import Redis
+
+from config import CampaignSettings, QueueSettings
+from outbox import Outbox, OutboxMessage
+from schemas import Campaign, CampaignInput, CampaignRecipient, CampaignRowError, EmailInput
+from sender import FailedDelivery
+
+logger = logging.getLogger(__name__)
+
+CSV_MEDIA_TYPE = "text/csv"
+EMAIL_COLUMN = "email"
+# Longest CSV record or NDJSON line accepted, to bound what is buffered.
+MAX_ROW_BYTES = 1024 * 1024
+
+COUNTERS = ("recipients", "rejected", "queued", "sent", "failed")
+
+_CSV_SPECIAL = re.compile(r'["\n]')
+
+
+def _complete_records_end(text: str) -> int:
+    """Index just past the last newline of ``text`` outside a quoted field."""
+    quoted = False
+    end = 0
+    for match in _CSV_SPECIAL.finditer(text):
+        if match.group() == '"':
+            quoted = not quoted
+        elif not quoted:
+            end = match.end()
+    return end
+
+
+async def iter_csv_rows(chunks: AsyncIterable[bytes]) -> AsyncIterator[dict[str, Any]]:
+    """Yield each record of a UTF-8 CSV stream as a :class:`CampaignRecipient` dict.
+
+    The header row names the columns: ``email`` holds the address and every
+    other column a template variable, omitted from the row when empty. Only
+    complete records are parsed, so quoted fields may span chunks and lines.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    header: list[str] | None = None
+    buffer = ""
+
+    def parse(text: str) -> list[list[str]]:
+        return [row for row in csv.reader(io.StringIO(text)) if row]
+
+    async def records() -> AsyncIterator[list[str]]:
+        nonlocal buffer
+        async for chunk in chunks:
+            buffer += decoder.decode(chunk)
+            end = _complete_records_end(buffer)
+            if not end:
+                if len(buffer) > MAX_ROW_BYTES:
+                    raise ClientException(detail="CSV record exceeds the maximum size of 1 MiB")
+                continue
+            complete, buffer = buffer[:end], buffer[end:]
+            for row in parse(complete):
+                yield row
+        buffer += decoder.decode(b"", final=True)
+        for row in parse(buffer):
+            yield row
+
+    async for row in records():
+        if header is None:
+            header = [name.strip() for name in row]
+            if EMAIL_COLUMN not in header:
+                raise ClientException(detail="The CSV header must have an 'email' column")
+            continue
+        values = dict(zip(header, row))
+        item: dict[str, Any] = {
+            "email": values.pop(EMAIL_COLUMN, ""),
+            "variables": {name: value for name, value in values.items() if value},
+        }
+        if len(row) > len(header):
+            # Rejected by CampaignRecipient, which forbids unknown fields.
+            item["unnamedColumns"] = row[len(header) :]
+        yield item
+
+
+async def iter_ndjson_rows(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Yield the non-blank lines of an NDJSON stream, undecoded.
+
+    Only each new chunk is searched for line breaks, so a line spread over
+    many chunks is assembled in linear time.
+    """
+    pending = bytearray()
+    async for chunk in chunks:
+        start = 0
+        while (end := chunk.find(b"\n", start)) != -1:
+            pending += chunk[start:end]
+            start = end + 1
+            if len(pending) > MAX_ROW_BYTES:
+                break
+            if pending.strip():
+                yield bytes(pending)
+            pending.clear()
+        else:
+            pending += chunk[start:]
+        if len(pending) > MAX_ROW_BYTES:
+            raise ClientException(detail="NDJSON line exceeds the maximum size of 1 MiB")
+    if pending.strip():
+        yield bytes(pending)
+
+
+def parse_recipient(row: dict[str, Any] | bytes) -> CampaignRecipient:
+    if isinstance(row, bytes):
+        return CampaignRecipient.model_validate_json(row)
+    return CampaignRecipient.model_validate(row)
+
+
+def campaign_payload(campaign: CampaignInput, recipient: CampaignRecipient) -> EmailInput:
+    """The notification ``campaign`` sends to ``recipient``.
+
+    The recipient's variables override the campaign's, and the merged
+    variables are validated against the template.
+    """
+    variables = {
+        to_camel(name): value
+        for source in (campaign.template_variables, recipient.variables)
+        for name, value in source.items()
+    }
+    return EmailInput.model_validate(
+        {
+            "subject": campaign.subject,
+            "template": campaign.template,
+            "templateVariables": variables,
+            "previewText": campaign.preview_text,
+            "to": [recipient.email],
+        }
+    )
+
+
+def _row_errors(error: ValidationError) -> list[dict[str, Any]]:
+    return error.errors(include_url=False, include_context=False, include_input=False)
+
+
+class CampaignStore(ABC):
+    """Status and progress counters of campaigns."""
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def create(self, campaign: Campaign) -> None:
+        """Store a new campaign."""
+
+    @abstractmethod
+    async def get(self, campaign_id: str) -> Campaign | None:
+        """The campaign with its current status and counters, if it exists."""
+
+    @abstractmethod
+    async def status(self, campaign_id: str) -> str | None:
+        """The current status alone, ``None`` if the campaign does not exist."""
+
+    @abstractmethod
+    async def transition(
+        self, campaign_id: str, allowed: Collection[str], status: str
+    ) -> str | None:
+        """Set ``status`` if the current status is one of ``allowed``.
+
+        Returns the status found, whether or not it was changed, and
+        ``None`` if the campaign does not exist.
+        """
+
+    @abstractmethod
+    async def increment(self, campaign_id: str, counts: dict[str, int]) -> None:
+        """Add ``counts`` to the counters of a campaign, if it still exists."""
+
+    @abstractmethod
+    async def set_errors(self, campaign_id: str, errors: list[CampaignRowError]) -> None:
+        """Record the rejected rows of the recipient list."""
+
+    async def record(self, campaign_id: str, counter: str) -> None:
+        """Count one delivery outcome; stores may apply it later, in bulk."""
+        await self.increment(campaign_id, {counter: 1})
+
+    async def delivered(self, message: OutboxMessage) -> None:
+        """``on_delivered`` hook of the worker pool."""
+        if message.campaign_id:
+            await self.record(message.campaign_id, "sent")
+
+    async def dead_lettered(
+        self, message: OutboxMessage, failures: list[FailedDelivery]
+    ) -> None:
+        """``on_dead_letter`` hook of the retry scheduler."""
+        if message.campaign_id:
+            await self.record(message.campaign_id, "failed")
+
+
+class MemoryCampaignStore(CampaignStore):
+    """Campaigns of this process only; they do not survive a restart."""
+
+    def __init__(self, campaign_settings: CampaignSettings) -> None:
+        self.settings = campaign_settings
+        self._campaigns: dict[str, tuple[Campaign, float]] = {}
+
+    async def create(self, campaign: Campaign) -> None:
+        now = time.monotonic()
+        for campaign_id, (_, expires) in list(self._campaigns.items()):
+            if expires <= now:
+                del self._campaigns[campaign_id]
+        self._campaigns[campaign.id] = (
+            campaign.model_copy(deep=True),
+            now + self.settings.campaign_ttl,
+        )
+
+    def _get(self, campaign_id: str) -> Campaign | None:
+        entry = self._campaigns.get(campaign_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def get(self, campaign_id: str) -> Campaign | None:
+        campaign = self._get(campaign_id)
+        return campaign.model_copy(deep=True) if campaign else None
+
+    async def status(self, campaign_id: str) -> str | None:
+        campaign = self._get(campaign_id)
+        return campaign.status if campaign else None
+
+    async def transition(
+        self, campaign_id: str, allowed: Collection[str], status: str
+    ) -> str | None:
+        campaign = self._get(campaign_id)
+        if campaign is None:
+            return None
+        current = campaign.status
+        if current in allowed:
+            campaign.status = status
+        return current
+
+    async def increment(self, campaign_id: str, counts: dict[str, int]) -> None:
+        if campaign := self._get(campaign_id):
+            for counter, amount in counts.items():
+                setattr(campaign, counter, getattr(campaign, counter) + amount)
+
+    async def set_errors(self, campaign_id: str, errors: list[CampaignRowError]) -> None:
+        if campaign := self._get(campaign_id):
+            campaign.errors = list(errors)
+
+
+_TRANSITION_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'status')
+if not current then
+    return false
+end
+for i = 2, #ARGV do
+    if ARGV[i] == current then
+        redis.call('HSET', KEYS[1], 'status', ARGV[1])
+        break
+    end
+end
+return current
+"""
+
+_INCREMENT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+class RedisCampaignStore(CampaignStore):
+    """Campaigns kept in Redis, shared by every process and expiring after ``CAMPAIGN_TTL``.
+
+    Each campaign is a hash holding its definition as JSON, its status and
+    one field per counter. Delivery outcomes are counted in process memory
+    and added to the hash every ``CAMPAIGN_PROGRESS_INTERVAL`` seconds, so
+    that a send does not cost a Redis round trip.
+    """
+
+    def __init__(self, redis: Redis, campaign_settings: CampaignSettings) -> None:
+        self.redis = redis
+        self.settings = campaign_settings
+        self._transition = redis.register_script(_TRANSITION_SCRIPT)
+        self._increment = redis.register_script(_INCREMENT_SCRIPT)
+        self._pending: defaultdict[str, defaultdict[str, int]] = defaultdict(
+            lambda: defaultdict(int)
+        )
+        self._task: asyncio.Task[None] | None = None
+
+    def _key(self, campaign_id: str) -> str:
+        return f"{self.settings.campaign_key_prefix}:{campaign_id}"
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_periodically(), name="campaign-progress")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    async def create(self, campaign: Campaign) -> None:
+        key = self._key(campaign.id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                key,
+                mapping={
+                    "campaign": campaign.model_dump_json(by_alias=True),
+                    "status": campaign.status,
+                    **{counter: getattr(campaign, counter) for counter in COUNTERS},
+                },
+            )
+            pipe.expire(key, self.settings.campaign_ttl)
+            await pipe.execute()
+
+    async def get(self, campaign_id: str) -> Campaign | None:
+        fields = await self.redis.hgetall(self._key(campaign_id))
+        if not fields:
+            return None
+        data = {key.decode(): value.decode() for key, value in fields.items()}
+        document = json.loads(data["campaign"])
+        document["status"] = data["status"]
+        for counter in COUNTERS:
+            document[counter] = int(data.get(counter, 0))
+        if "errors" in data:
+            document["errors"] = json.loads(data["errors"])
+        return Campaign.model_validate(document)
+
+    async def status(self, campaign_id: str) -> str | None:
+        status = await self.redis.hget(self._key(campaign_id), "status")
+        return status.decode() if status is not None else None
+
+    async def transition(
+        self, campaign_id: str, allowed: Collection[str], status: str
+    ) -> str | None:
+        current = await self._transition(keys=[self._key(campaign_id)], args=[status, *allowed])
+        return current.decode() if current is not None else None
+
+    async def increment(self, campaign_id: str, counts: dict[str, int]) -> None:
+        args = [value for counter, amount in counts.items() for value in (counter, amount)]
+        if args:
+            await self._increment(keys=[self._key(campaign_id)], args=args)
+
+    async def set_errors(self, campaign_id: str, errors: list[CampaignRowError]) -> None:
+        await self.redis.hset(
+            self._key(campaign_id),
+            "errors",
+            json.dumps([error.model_dump(mode="json", by_alias=True) for error in errors]),
+        )
+
+    async def record(self, campaign_id: str, counter: str) -> None:
+        self._pending[campaign_id][counter] += 1
+
+    async def flush(self) -> None:
+        """Add the outcomes counted since the last flush to the stored counters."""
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+        for campaign_id, counts in pending.items():
+            await self.increment(campaign_id, counts)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.campaign_progress_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(
+                    "Failed to save campaign progress",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+
+
+def _read_lines(file: IO[bytes], count: int) -> list[bytes]:
+    lines = []
+    for line in file:
+        lines.append(line)
+        if len(lines) >= count:
+            break
+    return lines
+
+
+class CampaignRunner:
+    """Ingests recipient lists and queues each campaign's notifications.
+
+    Runs one task per campaign being queued. Between chunks the task checks
+    the stored status: it waits while the campaign is paused and stops once
+    it is cancelled. Notifications already queued are sent regardless.
+    """
+
+    def __init__(
+        self,
+        store: CampaignStore,
+        outbox: Outbox,
+        queue_settings: QueueSettings,
+        campaign_settings: CampaignSettings,
+    ) -> None:
+        self.store = store
+        self.outbox = outbox
+        self.settings = campaign_settings
+        self.capacity = max(
+            int(queue_settings.queue_max_size * campaign_settings.campaign_queue_share), 1
+        )
+        self.spool_dir = Path(campaign_settings.campaign_spool_dir or tempfile.gettempdir())
+        self._tasks: dict[str, asyncio.Task[None]] = {}
+
+    async def close(self) -> None:
+        """Stop queueing; campaigns interrupted here are cancelled."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = {}
+
+    async def ingest(
+        self, campaign: Campaign, rows: AsyncIterable[dict[str, Any] | bytes]
+    ) -> Campaign:
+        """Validate and spool a recipient list, then start queueing the campaign.
+
+        Raises:
+            ClientException: If recipients were already uploaded (409), or the
+                list is empty or longer than ``CAMPAIGN_MAX_RECIPIENTS``.
+        """
+        previous = await self.store.transition(campaign.id, {"draft"}, "running")
+        if previous != "draft":
+            raise ClientException(
+                detail=f"Recipients of campaign {campaign.id} were already uploaded",
+                status_code=409,
+            )
+
+        spool = self.spool_dir / f"campaign-{campaign.id}.ndjson"
+        try:
+            recipients, rejected, errors = await self._spool(campaign, rows, spool)
+        except BaseException:
+            await asyncio.to_thread(spool.unlink, missing_ok=True)
+            await self.store.transition(campaign.id, {"running"}, "draft")
+            raise
+
+        await self.store.increment(campaign.id, {"recipients": recipients, "rejected": rejected})
+        if errors:
+            await self.store.set_errors(campaign.id, errors)
+        logger.info(
+            "Campaign recipients uploaded",
+            extra={"campaign_id": campaign.id, "recipients": recipients, "rejected": rejected},
+        )
+        self._tasks[campaign.id] = asyncio.create_task(
+            self._run(campaign, spool), name=f"campaign-{campaign.id}"
+        )
+        self._tasks[campaign.id].add_done_callback(lambda _: self._tasks.pop(campaign.id, None))
+        return await self.store.get(campaign.id) or campaign
+
+    async def _spool(
+        self, campaign: Campaign, rows: AsyncIterable[dict[str, Any] | bytes], spool: Path
+    ) -> tuple[int, int, list[CampaignRowError]]:
+        # Validation is mostly checking addresses, and a list holds many of
+        # them: chunks are validated and written in a thread, so that other
+        # requests are not held up for the length of the upload.
+        recipients = rejected = 0
+        errors: list[CampaignRowError] = []
+        chunk: list[dict[str, Any] | bytes] = []
+        row_number = 0
+
+        def write_chunk() -> None:
+            nonlocal recipients, rejected
+            first_row = row_number - len(chunk) + 1
+            for row, item in enumerate(chunk, first_row):
+                try:
+                    recipient = parse_recipient(item)
+                    campaign_payload(campaign, recipient)
+                except ValidationError as e:
+                    rejected += 1
+                    if len(errors) < self.settings.campaign_max_errors:
+                        errors.append(CampaignRowError(row=row, errors=_row_errors(e)))
+                    continue
+                recipients += 1
+                file.write(recipient.model_dump_json().encode() + b"\n")
+
+        await asyncio.to_thread(spool.parent.mkdir, parents=True, exist_ok=True)
+        file = await asyncio.to_thread(spool.open, "wb")
+        try:
+            async for item in rows:
+                row_number += 1
+                if row_number > self.settings.campaign_max_recipients:
+                    raise ClientException(
+                        detail="Recipient list exceeds the maximum of "
+                        f"{self.settings.campaign_max_recipients} rows"
+                    )
+                chunk.append(item)
+                if len(chunk) >= self.settings.campaign_chunk_size:
+                    await asyncio.to_thread(write_chunk)
+                    chunk = []
+            if not row_number:
+                raise ClientException(detail="Recipient list is empty")
+            await asyncio.to_thread(write_chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+        return recipients, rejected, errors
+
+    def _messages(self, campaign: Campaign, lines: list[bytes]) -> list[OutboxMessage]:
+        messages = []
+        for line in lines:
+            try:
+                payload = campaign_payload(campaign, CampaignRecipient.model_validate_json(line))
+            except ValidationError as e:
+                # Validated on upload; only a template change since can get here.
+                logger.error(
+                    "Campaign recipient no longer valid, skipped",
+                    extra={"campaign_id": campaign.id, "errors": _row_errors(e)},
+                )
+                continue
+            messages.append(
+                OutboxMessage(payload=payload, request_id=None, campaign_id=campaign.id)
+            )
+        return messages
+
+    async def _run(self, campaign: Campaign, spool: Path) -> None:
+        interval = self.settings.campaign_poll_interval
+        pending: list[OutboxMessage] = []
+        file = await asyncio.to_thread(spool.open, "rb")
+        try:
+            while True:
+                try:
+                    status = await self.store.status(campaign.id)
+                    if status == "paused":
+                        await asyncio.sleep(interval)
+                        continue
+                    if status != "running":
+                        logger.info(
+                            "Campaign stopped", extra={"campaign_id": campaign.id, "status": status}
+                        )
+                        return
+
+                    if not pending:
+                        lines = await asyncio.to_thread(
+                            _read_lines, file, self.settings.campaign_chunk_size
+                        )
+                        if not lines:
+                            break
+                        pending = await asyncio.to_thread(self._messages, campaign, lines)
+                        if invalid := len(lines) - len(pending):
+                            await self.store.increment(campaign.id, {"failed": invalid})
+
+                    free = self.capacity - await self.outbox.depth()
+                    queued = await self.outbox.enqueue_many(pending[:free]) if free > 0 else 0
+                    if queued:
+                        await self.store.increment(campaign.id, {"queued": queued})
+                        pending = pending[queued:]
+                except Exception as e:
+                    logger.error(
+                        "Failed to queue campaign recipients",
+                        extra={
+                            "campaign_id": campaign.id,
+                            "error_type": type(e).__name__,
+                            "error_message": str(e),
+                        },
+                    )
+                    await asyncio.sleep(interval)
+                    continue
+                if pending:
+                    # The outbox is at the campaign's share; wait for the workers.
+                    await asyncio.sleep(interval)
+
+            await self.store.transition(campaign.id, {"running", "paused"}, "finished")
+            logger.info("Campaign fully queued", extra={"campaign_id": campaign.id})
+        except asyncio.CancelledError:
+            with suppress(Exception):
+                await self.store.transition(campaign.id, {"running", "paused"}, "cancelled")
+            logger.warning(
+                "Campaign cancelled by shutdown before every recipient was queued",
+                extra={"campaign_id": campaign.id},
+            )
+            raise
+        finally:
+            file.close()
+            spool.unlink(missing_ok=True)
+
+
+def new_campaign(data: CampaignInput) -> Campaign:
+    return Campaign(
+        **data.model_dump(),
+        id=uuid4().hex,
+        status="draft",
+        created_at=datetime.now(UTC),
+    )
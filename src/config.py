@@ -1,5 +1,5 @@
 from typing import Literal
-from pydantic import EmailStr
+from pydantic import BaseModel, EmailStr, Field, ValidationInfo, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 config = SettingsConfigDict(
@@ -13,33 +13,238 @@ class SMTPSettings(BaseSettings):
     smtp_username: str = "user"
     smtp_password: str = "password"
     smtp_use_tls: bool = True
+    smtp_max_recipients_per_message: int = 100  # RCPT TO per transaction before splitting
+
+    # Connection pool
+    smtp_pool_min_size: int = 1
+    smtp_pool_max_size: int = 10
+    smtp_pool_idle_timeout: float = 60.0  # seconds before an idle connection is closed
+    smtp_pool_max_messages: int = 100  # messages sent before a connection is recycled
+    smtp_pool_health_check_after: float = 5.0  # idle seconds before NOOP on reuse
+
+    # Send limiter: adaptive cap on concurrent SMTP transactions plus a rate limit
+    smtp_max_in_flight: int = 10
+    smtp_min_in_flight: int = 1
+    smtp_rate_limit: float = 0.0  # messages per second, 0 for no limit
+    smtp_rate_burst: int = 10
+    smtp_backoff_factor: float = 0.5  # in-flight cap multiplier on 421/451/452 or a latency spike
+    smtp_backoff_cooldown: float = 1.0  # seconds before the cap can be lowered again
+    smtp_latency_spike_factor: float = 3.0  # latency above this multiple of the average is a spike
+    smtp_latency_spike_min: float = 0.5  # seconds; faster transactions never count as a spike
 
     model_config = config
 
 
+class APIKeySpec(BaseModel):
+    """A named API key, stored as the SHA-256 hex digest of the key."""
+
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+    # Requests per RATE_LIMIT_WINDOW, 0 for no limit; RATE_LIMIT_REQUESTS if unset
+    rate_limit: int | None = None
+    tenant: str | None = None  # keys of the same tenant share one rate limit
+
+
 class SecuritySettings(BaseSettings):
     """Security configuration for API authentication and rate limiting."""
 
     api_key: str = "changeme-generate-secure-key"
+    # Named, hashed keys (`python auth.py hash <key>`); when set, API_KEY is not accepted
+    api_keys: dict[str, APIKeySpec] = {}
+    api_key_cache_size: int = 1024  # verified keys remembered without rehashing
+    auth_log_interval: float = 60.0  # seconds between aggregated auth log lines
     cors_origins: list[str] = [""]
-    rate_limit_requests: int = 10
+    rate_limit_requests: int = 10  # per API key or tenant, or per client IP without a key
     rate_limit_window: Literal["second", "minute", "hour", "day"] = "minute"
+    # Paths (regular expressions) that are not rate limited
+    rate_limit_exclude: list[str] = ["^/$", "^/schema", "^/metrics$"]
+    # Proxies (addresses or CIDR networks) whose X-Forwarded-For is trusted for the client IP
+    rate_limit_trusted_proxies: list[str] = []
+    # Share of the window (and at most of the quota) a worker spends tokens taken from
+    # Redis locally; 0 asks Redis on every request
+    rate_limit_local_share: float = Field(default=0.05, ge=0, le=1)
+    rate_limit_key_prefix: str = "notifications:ratelimit"
     enable_csrf: bool = False
+    # Signs CSRF tokens for all keys; required with ENABLE_CSRF
+    csrf_secret: str | None = Field(default=None, validate_default=True)
 
     redis_url: str | None = None  # e.g., "redis://localhost:6379/0"
 
     model_config = config
 
+    @field_validator("csrf_secret")
+    @classmethod
+    def check_csrf_secret(cls, v: str | None, info: ValidationInfo) -> str | None:
+        if info.data.get("enable_csrf") and not v:
+            raise ValueError("CSRF_SECRET must be set when ENABLE_CSRF is true")
+        return v
+
+
+class QueueSettings(BaseSettings):
+    """Outbound queue and sending worker configuration."""
+
+    queue_backend: Literal["memory", "redis"] = "memory"
+    queue_max_size: int = 10_000  # backlog size at which new sends are rejected
+    queue_workers: int = 4  # concurrent consumers per process
+    queue_batch_size: int = 10  # messages a worker takes from the queue at once
+    queue_consume: bool = True  # set to false on API-only instances
+    queue_stream: str = "notifications:outbox"
+    queue_consumer_group: str = "senders"
+    queue_claim_idle_after: float = 300.0  # seconds before an unacked message is redelivered
+    queue_max_deliveries: int = 5  # times a message is handed out unacked before it is dead-lettered
+    queue_poll_timeout: float = 1.0
+    queue_schedule_key: str = "notifications:scheduled"
+    queue_scheduler_poll_interval: float = 1.0  # seconds between checks for due messages
+    queue_scheduler_batch_size: int = 100  # due messages released to the queue at once
+    queue_schedule_max_delay: float = 366 * 86400  # furthest sendAt / delaySeconds accepted
+    queue_shutdown_timeout: float = 10.0
+
+    model_config = config
+
+
+class RetrySettings(BaseSettings):
+    """Retry backoff and dead-letter configuration for failed deliveries."""
+
+    retry_max_attempts: int = 5  # including the first attempt
+    retry_base_delay: float = 30.0  # seconds before the first retry, doubled on each attempt
+    retry_max_delay: float = 3600.0
+    retry_jitter: float = 0.2  # +/- fraction applied to each delay
+    dead_letter_max_entries: int = 1000
+    dead_letter_ttl: int = 7 * 24 * 3600  # seconds
+    dead_letter_index_key: str = "notifications:dead_letters"  # Redis sorted set of entry ids
+
+    model_config = config
+
+
+class TransportSettings(BaseSettings):
+    """Where rendered messages are delivered."""
+
+    # smtp: pooled SMTP relay; http: provider API; file: local maildir/mbox; null: discard
+    transport_backend: Literal["smtp", "http", "file", "null"] = "smtp"
+
+    transport_http_url: str | None = None
+    transport_http_token: str | None = None
+    transport_http_timeout: float = 30.0
+    transport_http_max_connections: int = 10  # kept-alive connections to the provider
+    transport_http_batch_size: int = 1  # messages per request
+    transport_http_linger: float = 0.01  # seconds to wait for a batch to fill
+
+    transport_file_path: str = "outbox.maildir"
+    transport_file_format: Literal["maildir", "mbox"] = "maildir"
+
+    model_config = config
+
+
+class DigestSettings(BaseSettings):
+    """Coalescing of notification bursts to one recipient into digest emails."""
+
+    digest_window: float = 0.0  # seconds a burst is collected for, 0 disables coalescing
+    digest_templates: list[str] = ["notification"]  # templates whose notifications coalesce
+    digest_max_items: int = 50  # notifications per digest; a full window is sent early
+    digest_max_keys: int = 10_000  # open (recipient, template) windows
+    digest_max_buffered: int = 10_000  # notifications held across all windows
+
+    model_config = config
+
+
+class CampaignSettings(BaseSettings):
+    """Campaigns: one notification sent to an uploaded recipient list."""
+
+    campaign_max_recipients: int = 1_000_000  # rows accepted per upload
+    campaign_max_upload_bytes: int = 256 * 1024 * 1024  # size of a recipient list upload
+    campaign_chunk_size: int = 500  # recipients validated, and later queued, at once
+    # Share of QUEUE_MAX_SIZE a campaign may fill; the rest stays free for other sends
+    campaign_queue_share: float = Field(default=0.5, gt=0, le=1)
+    campaign_poll_interval: float = 1.0  # seconds between checks of a full queue or a pause
+    campaign_progress_interval: float = 1.0  # seconds between writes of sent/failed counters
+    campaign_max_errors: int = 100  # rejected rows reported with their errors
+    campaign_spool_dir: str | None = None  # uploaded lists are spooled here, default: temp dir
+    campaign_ttl: int = 30 * 24 * 3600  # seconds a campaign stays queryable
+    campaign_key_prefix: str = "notifications:campaign"  # Redis key of each campaign
+
+    model_config = config
+
+
+class StatusSettings(BaseSettings):
+    """Delivery status records of accepted notifications."""
+
+    status_ttl: int = 7 * 24 * 3600  # seconds a record is kept after its last update
+    status_max_entries: int = 100_000  # records kept in memory without Redis
+    status_flush_interval: float = 0.2  # seconds between writes of buffered updates to Redis
+    status_max_pending: int = 100_000  # buffered updates; more are dropped
+    status_query_max_ids: int = 1000  # message ids per bulk status query
+    status_key_prefix: str = "notifications:status"  # Redis key of each record
+
+    model_config = config
+
+
+class LogSettings(BaseSettings):
+    """Structured logging, written to stderr by a background thread."""
+
+    log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "INFO"  # DEBUG when DEBUG=true
+    log_format: Literal["json", "text"] = "json"
+    log_queue_size: int = 10_000  # records waiting to be written; more are dropped
+    log_batch_size: int = 100  # records written per flush
+    # Per logger (and its children): fraction of records below WARNING kept,
+    # e.g. {"sender": 0.1}
+    log_sample_rates: dict[str, float] = {}
+    # Per logger: records per second for each distinct message, e.g. {"auth": 1}
+    log_rate_limits: dict[str, float] = {}
+
+    model_config = config
+
 
 class Settings(BaseSettings):
     debug: bool = False
     smtp: SMTPSettings = SMTPSettings()
     security: SecuritySettings = SecuritySettings()
+    queue: QueueSettings = QueueSettings()
+    retry: RetrySettings = RetrySettings()
+    transport: TransportSettings = TransportSettings()
+    digest: DigestSettings = DigestSettings()
+    campaign: CampaignSettings = CampaignSettings()
+    status: StatusSettings = StatusSettings()
+    log: LogSettings = LogSettings()
 
     email_recipient: EmailStr = "editme@example.com"
     email_sender: EmailStr = "noreply@example.com"
 
+    # Templates: modules written by `python templating.py compile`, used outside debug mode
+    template_precompiled_dir: str | None = None
+    template_bytecode_cache_dir: str | None = None
+
+    # Inline images: content-id referenced as ``cid:<id>`` in templates -> file in src/static
+    inline_assets: dict[str, str] = {"zozbit_logo": "zozbit.png"}
+    inline_assets_reload_interval: float = 5.0  # seconds between file change checks
+
+    notification_body_max_length: int = 20_000  # characters in templateVariables.body
+    sanitize_cache_size: int = 4096  # sanitized short strings kept for reuse
+    sanitize_cache_max_length: int = 256  # longer strings are never cached
+
+    idempotency_ttl: int = 24 * 3600  # seconds a response is replayed for its Idempotency-Key
+    idempotency_lock_ttl: int = 60  # seconds a key stays reserved by a request that never completes
+    idempotency_content_window: int = 0  # seconds identical bodies are deduplicated, 0 disables
+
+    # Where messages are rendered and serialized: on the event loop, or in a pool
+    render_executor: Literal["inline", "thread", "process"] = "thread"
+    render_workers: int = 4
+    render_cache_max_bytes: int = 64 * 1024 * 1024  # rendered messages kept for reuse, 0 disables
+
+    max_recipients: int = 1000  # to + cc + bcc per notification
+    batch_max_items: int = 1000  # maximum notifications per send-batch request
+
+    # Serving (serve.py): app preloaded once, then forked into web_workers processes
+    host: str = "0.0.0.0"
+    port: int = 8000
+    web_workers: int = 1  # more than one requires REDIS_URL for shared state
+    web_access_log: bool = True
+
     glitchtip_dsn: str | None = None
+    sentry_traces_sample_rate: float = 0.1  # fraction of requests traced
+    # Per-route overrides, keyed by path prefix; the longest matching prefix wins
+    sentry_route_sample_rates: dict[str, float] = {"/health": 0.0, "/metrics": 0.0}
+
+    # Port of the /metrics endpoint served by the standalone worker (disabled when unset)
+    worker_metrics_port: int | None = None
 
     model_config = config
 
@@ -1,15 +1,82 @@
-from typing import Annotated
+import json
+import time
+from collections.abc import AsyncIterator
+from typing import Annotated, Any
 
-from litestar import Controller, Response, get, post, status_codes
-from litestar.background_tasks import BackgroundTask
+from litestar import Controller, Request, Response, delete, get, post, status_codes
 from litestar.contrib.pydantic import PydanticDTO
+from litestar.exceptions import (
+    ClientException,
+    NotFoundException,
+    ServiceUnavailableException,
+)
 from litestar.openapi.spec import Example
 from litestar.openapi.datastructures import ResponseSpec
-from litestar.params import Body
+from litestar.params import Body, Parameter
 from litestar.connection import ASGIConnection
 
-from schemas import EmailInput, SuccessResponse, HealthResponse
-from sender import ISender
+from pydantic import ValidationError
+
+from campaigns import (
+    CSV_MEDIA_TYPE,
+    CampaignRunner,
+    CampaignStore,
+    iter_csv_rows,
+    iter_ndjson_rows,
+    new_campaign,
+)
+from config import settings
+from dead_letters import DeadLetterStore
+from idempotency import IDEMPOTENCY_HEADER, replay_stored_response, store_response
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, collect as collect_metrics
+from outbox import Outbox, OutboxMessage, QueueFullError
+from scheduler import DeliveryScheduler
+from send_limiter import SendLimiter
+from schemas import (
+    BatchItemResult,
+    BatchResponse,
+    Campaign,
+    CampaignInput,
+    DeadLetterEntry,
+    DeliveryStatus,
+    EmailInput,
+    SendingHealth,
+    StatusQuery,
+    StatusQueryResponse,
+    SuccessResponse,
+    HealthResponse,
+)
+from smtp_pool import SMTPConnectionPool
+from status import StatusStore
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def _iter_batch_items(request: Request) -> AsyncIterator[Any]:
+    """Yield batch items from a JSON array, or raw lines from an NDJSON stream.
+
+    NDJSON lines are yielded undecoded so that each one is parsed and
+    validated in a single step, and a malformed line only rejects that item.
+    """
+    if request.content_type[0] == NDJSON_MEDIA_TYPE:
+        async for line in iter_ndjson_rows(request.stream()):
+            yield line
+        return
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError as e:
+        raise ClientException(detail="Invalid JSON in request body") from e
+    if not isinstance(items, list):
+        raise ClientException(detail="Expected a JSON array of notifications")
+    for item in items:
+        yield item
+
+
+def _validate_batch_item(item: Any) -> EmailInput:
+    if isinstance(item, bytes):
+        return EmailInput.model_validate_json(item)
+    return EmailInput.model_validate(item)
 
 
 class HealthController(Controller):
@@ -22,31 +89,88 @@ class HealthController(Controller):
             "Returns the service health status. "
             "This endpoint does not require authentication and can be used to: "
             "1) Verify the service is running, "
-            "2) Obtain CSRF cookie for POST requests (if CSRF protection is enabled).\n\n"
+            "2) Obtain CSRF cookie for POST requests (if CSRF protection is enabled), "
+            "3) See whether outbound sending is throttled by the SMTP relay or saturated.\n\n"
             "**Frontend Integration:**\n"
             "Call this endpoint first to receive the CSRF cookie, then include it automatically "
             "in subsequent POST requests using `credentials: 'include'`."
         ),
-        return_dto=PydanticDTO[HealthResponse],
         status_code=status_codes.HTTP_200_OK,
         response_description="Service is healthy",
         exclude_from_auth=True,
         responses={
             status_codes.HTTP_200_OK: ResponseSpec(
-                data_container=PydanticDTO[HealthResponse],
+                data_container=HealthResponse,
                 media_type="application/json",
                 description="Service health status",
-                examples=[Example(summary="Healthy", value={"status": "healthy"})],
+                examples=[
+                    Example(
+                        summary="Healthy",
+                        value={
+                            "status": "healthy",
+                            "sending": {
+                                "inFlight": 3,
+                                "waiting": 0,
+                                "limit": 10,
+                                "maxInFlight": 10,
+                                "rateLimit": 0.0,
+                                "latency": 0.21,
+                                "throttled": False,
+                                "saturated": False,
+                            },
+                        },
+                    )
+                ],
             ),
         },
     )
-    async def health_check(self, request: ASGIConnection) -> Response[HealthResponse]:
+    async def health_check(
+        self, request: ASGIConnection, send_limiter: SendLimiter
+    ) -> Response[HealthResponse]:
+        state = send_limiter.state()
         return Response(
-            content=HealthResponse(status="healthy"),
+            content=HealthResponse(
+                status="healthy",
+                sending=SendingHealth(
+                    in_flight=state.in_flight,
+                    waiting=state.waiting,
+                    limit=state.limit,
+                    max_in_flight=state.max_in_flight,
+                    rate_limit=state.rate_limit,
+                    latency=state.latency,
+                    throttled=state.throttled,
+                    saturated=state.saturated,
+                ),
+            ),
             status_code=status_codes.HTTP_200_OK,
         )
 
 
+class MetricsController(Controller):
+    path: str = "/metrics"
+    tags = ["Health"]
+
+    @get(
+        summary="Prometheus metrics",
+        description=(
+            "Send pipeline metrics in the Prometheus text exposition format: "
+            "per-stage latency histograms (validation, sanitize, render, mime_build, "
+            "smtp_connect, smtp_login, smtp_send), queue depth, scheduled retries, "
+            "in-flight SMTP transactions, and delivery failures by SMTP reply code. "
+            "Values are per process. This endpoint does not require authentication."
+        ),
+        media_type=METRICS_CONTENT_TYPE,
+        exclude_from_auth=True,
+    )
+    async def metrics(
+        self,
+        outbox: Outbox,
+        scheduler: DeliveryScheduler,
+        smtp_pool: SMTPConnectionPool,
+    ) -> str:
+        return await collect_metrics(outbox, scheduler, smtp_pool)
+
+
 class NotificationsRouter(Controller):
     path: str = "/notifications"
     tags = ["Notifications"]
@@ -56,14 +180,23 @@ class NotificationsRouter(Controller):
         summary="Send an email notification",
         description=(
             "Sends a styled HTML email notification with embedded logo using the notification template. "
-            "The email is sent asynchronously in the background, so this endpoint returns immediately. "
+            "The email is placed on the outbound queue and sent by the sending workers, so this endpoint returns immediately. "
             "The notification includes customizable headline, body, badge, call-to-action button, and footer.\n\n"
+            "**Scheduling:** set `sendAt` or `delaySeconds` to deliver later. The response holds the "
+            "message id, which cancels a scheduled email with `DELETE /notifications/scheduled/{id}`.\n\n"
+            "**Delivery status:** `GET /notifications/{id}` reports whether the email was sent.\n\n"
+            "**Idempotency:** send an `Idempotency-Key` header to make retries safe. "
+            "A repeated key returns the original response, marked with `Idempotent-Replayed: true`, "
+            "without queueing another email.\n\n"
             "**Possible Responses:**\n"
             "- `201`: Email queued successfully\n"
             "- `400`: Validation error (missing required fields, invalid length, etc.)\n"
-            "- `422`: Invalid JSON in request body\n"
-            "- `500`: Internal server error"
+            "- `409`: A request with the same `Idempotency-Key` is still in progress\n"
+            "- `422`: Invalid JSON in request body, or `Idempotency-Key` reused with a different body\n"
+            "- `500`: Internal server error\n"
+            "- `503`: Outbound queue is full, retry after the `Retry-After` delay"
         ),
+        before_request=replay_stored_response,
         return_dto=PydanticDTO[SuccessResponse],
         status_code=status_codes.HTTP_201_CREATED,
         response_description="Email queued successfully and will be sent in the background",
@@ -76,7 +209,10 @@ class NotificationsRouter(Controller):
                 examples=[
                     Example(
                         summary="Successful Response",
-                        value={"message": "Email sent successfully"},
+                        value={
+                            "message": "Email sent successfully",
+                            "id": "3f0c0e0b9a8d4c1f8f3f8e2d1c0b9a8d",
+                        },
                     )
                 ],
             ),
@@ -91,10 +227,441 @@ class NotificationsRouter(Controller):
                 description="Complete email notification payload with subject and template variables",
             ),
         ],
-        email_sender: ISender[EmailInput],
+        outbox: Outbox,
+        scheduler: DeliveryScheduler,
+        statuses: StatusStore,
+        request: Request,
+        idempotency_key: Annotated[
+            str | None,
+            Parameter(
+                header=IDEMPOTENCY_HEADER,
+                description="Client-generated key; retries with the same key are not sent again",
+                required=False,
+                max_length=255,
+            ),
+        ] = None,
+    ) -> Response[SuccessResponse]:
+        message = OutboxMessage(payload=data)
+        due = data.due(time.time())
+        if due is not None:
+            await scheduler.schedule(message, due)
+            await statuses.accepted(message, due)
+            content = SuccessResponse(message="Email scheduled", id=message.id)
+            await store_response(request, status_codes.HTTP_201_CREATED, content)
+            return Response(content=content, status_code=status_codes.HTTP_201_CREATED)
+
+        try:
+            await outbox.enqueue(message)
+        except QueueFullError as e:
+            raise ServiceUnavailableException(
+                detail="Notification queue is full, please retry later",
+                headers={"Retry-After": "5"},
+            ) from e
+
+        await statuses.accepted(message)
+        content = SuccessResponse(message="Email sent successfully", id=message.id)
+        await store_response(request, status_codes.HTTP_201_CREATED, content)
+        return Response(content=content, status_code=status_codes.HTTP_201_CREATED)
+
+    @post(
+        path="/send-batch",
+        summary="Send a batch of email notifications",
+        description=(
+            "Queues many notifications in a single request. The body is either a JSON array of "
+            "`EmailInput` objects (`Content-Type: application/json`) or one `EmailInput` object per "
+            f"line (`Content-Type: {NDJSON_MEDIA_TYPE}`), which is parsed as it streams in. "
+            "Every item is validated independently and the response reports, in order, "
+            "the message id of each accepted item or the errors of each rejected one. "
+            "Items with `sendAt` or `delaySeconds` are scheduled rather than queued.\n\n"
+            "**Possible Responses:**\n"
+            "- `201`: All items queued\n"
+            "- `207`: Some items were rejected, see the per-item results\n"
+            "- `400`: Malformed body, empty batch or more than the allowed number of items\n"
+            "- `500`: Internal server error"
+        ),
+        return_dto=PydanticDTO[BatchResponse],
+        status_code=status_codes.HTTP_201_CREATED,
+        response_description="Per-item results of the batch",
+        responses={
+            status_codes.HTTP_207_MULTI_STATUS: ResponseSpec(
+                data_container=PydanticDTO[BatchResponse],
+                media_type="application/json",
+                description="Batch partially queued",
+                examples=[
+                    Example(
+                        summary="Partial failure",
+                        value={
+                            "accepted": 1,
+                            "rejected": 1,
+                            "results": [
+                                {"index": 0, "status": "accepted", "id": "3f0c0e0b9a8d4c1f8f3f8e2d1c0b9a8d"},
+                                {
+                                    "index": 1,
+                                    "status": "rejected",
+                                    "errors": [
+                                        {
+                                            "type": "missing",
+                                            "loc": ["subject"],
+                                            "msg": "Field required",
+                                        }
+                                    ],
+                                },
+                            ],
+                        },
+                    )
+                ],
+            ),
+        },
+    )
+    async def send_batch(
+        self,
+        request: Request,
+        outbox: Outbox,
+        scheduler: DeliveryScheduler,
+        statuses: StatusStore,
+    ) -> Response[BatchResponse]:
+        results: list[BatchItemResult] = []
+        messages: list[OutboxMessage] = []
+        accepted_results: list[BatchItemResult] = []
+        scheduled: list[tuple[OutboxMessage, float]] = []
+
+        accepted_at = time.time()
+        index = 0
+        async for item in _iter_batch_items(request):
+            if index >= settings.batch_max_items:
+                raise ClientException(
+                    detail=f"Batch exceeds the maximum of {settings.batch_max_items} items"
+                )
+            try:
+                message = OutboxMessage(payload=_validate_batch_item(item))
+            except ValidationError as e:
+                results.append(
+                    BatchItemResult(
+                        index=index,
+                        status="rejected",
+                        errors=e.errors(
+                            include_url=False, include_context=False, include_input=False
+                        ),
+                    )
+                )
+            else:
+                result = BatchItemResult(index=index, status="accepted", id=message.id)
+                results.append(result)
+                due = message.payload.due(accepted_at)
+                if due is None:
+                    messages.append(message)
+                    accepted_results.append(result)
+                else:
+                    scheduled.append((message, due))
+            index += 1
+
+        if not index:
+            raise ClientException(detail="Batch contains no notifications")
+
+        await scheduler.schedule_many(scheduled)
+        queued = await outbox.enqueue_many(messages)
+        for message, due in scheduled:
+            await statuses.accepted(message, due)
+        for message in messages[:queued]:
+            await statuses.accepted(message)
+        for result in accepted_results[queued:]:
+            result.status = "rejected"
+            result.id = None
+            result.errors = [
+                {"type": "queue_full", "msg": "Notification queue is full, please retry later"}
+            ]
+
+        accepted = queued + len(scheduled)
+        rejected = len(results) - accepted
+        return Response(
+            content=BatchResponse(accepted=accepted, rejected=rejected, results=results),
+            status_code=(
+                status_codes.HTTP_207_MULTI_STATUS
+                if rejected
+                else status_codes.HTTP_201_CREATED
+            ),
+        )
+
+    @get(
+        path="/{message_id:str}",
+        summary="Get the delivery status of a notification",
+        description=(
+            "Reports where a notification accepted by `send-email` or `send-batch` is in its "
+            "delivery: `queued`, `deferred` until its `sendAt` or next retry, `coalesced` while "
+            "held for a digest, `sending`, `sent`, "
+            "`failed` once it was dead-lettered, or `cancelled`; with the SMTP reply of the last "
+            "failed attempt. Records expire after `STATUS_TTL` seconds without an update, "
+            "and can take up to `STATUS_FLUSH_INTERVAL` seconds to appear on other instances."
+        ),
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def get_status(
+        self, message_id: str, statuses: StatusStore
+    ) -> Response[DeliveryStatus]:
+        status = await statuses.get(message_id)
+        if status is None:
+            raise NotFoundException(detail=f"Notification {message_id} not found")
+        return Response(content=status)
+
+    @post(
+        path="/status",
+        summary="Get the delivery status of many notifications",
+        description=(
+            "Returns the status records of up to `STATUS_QUERY_MAX_IDS` message ids in one "
+            "request, in the order given; unknown or expired ids are listed in `missing`."
+        ),
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def query_status(
+        self, data: StatusQuery, statuses: StatusStore
+    ) -> Response[StatusQueryResponse]:
+        found = await statuses.get_many(data.ids)
+        return Response(
+            content=StatusQueryResponse(
+                statuses=[found[i] for i in data.ids if i in found],
+                missing=[i for i in data.ids if i not in found],
+            )
+        )
+
+
+class ScheduledController(Controller):
+    path: str = "/notifications/scheduled"
+    tags = ["Notifications"]
+
+    @delete(
+        path="/{message_id:str}",
+        summary="Cancel a scheduled notification",
+        description=(
+            "Cancels a notification sent with `sendAt` or `delaySeconds`, or an "
+            "automatic retry waiting for its next attempt. Returns `404` once the "
+            "notification has been released for sending."
+        ),
+        status_code=status_codes.HTTP_204_NO_CONTENT,
+    )
+    async def cancel_scheduled(
+        self, message_id: str, scheduler: DeliveryScheduler, statuses: StatusStore
+    ) -> None:
+        if not await scheduler.cancel(message_id):
+            raise NotFoundException(detail=f"No scheduled notification {message_id}")
+        await statuses.cancelled(message_id)
+
+
+class DeadLetterController(Controller):
+    path: str = "/notifications/dead-letters"
+    tags = ["Dead Letters"]
+
+    @get(
+        summary="List undeliverable notifications",
+        description=(
+            "Returns the most recent notifications that failed permanently (SMTP 5xx) "
+            "or ran out of retries, newest first. Each entry holds the notification "
+            "narrowed to the recipients that failed."
+        ),
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def list_dead_letters(
+        self,
+        dead_letters: DeadLetterStore,
+        limit: Annotated[int, Parameter(ge=1, le=1000, description="Maximum entries")] = 100,
+    ) -> Response[list[DeadLetterEntry]]:
+        return Response(content=await dead_letters.recent(limit))
+
+    @get(
+        path="/{entry_id:str}",
+        summary="Get an undeliverable notification",
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def get_dead_letter(
+        self, entry_id: str, dead_letters: DeadLetterStore
+    ) -> Response[DeadLetterEntry]:
+        return Response(content=await _get_dead_letter(dead_letters, entry_id))
+
+    @post(
+        path="/{entry_id:str}/replay",
+        summary="Replay an undeliverable notification",
+        description=(
+            "Puts the notification back on the outbound queue as a fresh delivery "
+            "and removes it from the dead-letter store."
+        ),
+        return_dto=PydanticDTO[SuccessResponse],
+        status_code=status_codes.HTTP_202_ACCEPTED,
+    )
+    async def replay_dead_letter(
+        self,
+        entry_id: str,
+        dead_letters: DeadLetterStore,
+        outbox: Outbox,
+        statuses: StatusStore,
     ) -> Response[SuccessResponse]:
+        entry = await _get_dead_letter(dead_letters, entry_id)
+        message = OutboxMessage(payload=entry.payload, id=entry.message_id)
+        try:
+            await outbox.enqueue(message)
+        except QueueFullError as e:
+            raise ServiceUnavailableException(
+                detail="Notification queue is full, please retry later",
+                headers={"Retry-After": "5"},
+            ) from e
+        await statuses.requeued(message)
+        await dead_letters.delete(entry_id)
+        return Response(
+            content=SuccessResponse(message="Notification queued for replay"),
+            status_code=status_codes.HTTP_202_ACCEPTED,
+        )
+
+    @delete(
+        path="/{entry_id:str}",
+        summary="Discard an undeliverable notification",
+        status_code=status_codes.HTTP_204_NO_CONTENT,
+    )
+    async def delete_dead_letter(
+        self, entry_id: str, dead_letters: DeadLetterStore
+    ) -> None:
+        await _get_dead_letter(dead_letters, entry_id)
+        await dead_letters.delete(entry_id)
+
+
+async def _get_dead_letter(dead_letters: DeadLetterStore, entry_id: str) -> DeadLetterEntry:
+    entry = await dead_letters.get(entry_id)
+    if entry is None:
+        raise NotFoundException(detail=f"Dead-letter entry {entry_id} not found")
+    return entry
+
+
+class CampaignController(Controller):
+    path: str = "/notifications/campaigns"
+    tags = ["Campaigns"]
+
+    @post(
+        summary="Create a campaign",
+        description=(
+            "Creates a draft campaign: one notification to be sent to every recipient of a "
+            "list uploaded next with `POST /notifications/campaigns/{id}/recipients`."
+        ),
+        status_code=status_codes.HTTP_201_CREATED,
+    )
+    async def create_campaign(
+        self, data: CampaignInput, campaigns: CampaignStore
+    ) -> Response[Campaign]:
+        campaign = new_campaign(data)
+        await campaigns.create(campaign)
+        return Response(content=campaign, status_code=status_codes.HTTP_201_CREATED)
+
+    @post(
+        path="/{campaign_id:str}/recipients",
+        summary="Upload the recipients of a campaign and start it",
+        description=(
+            f"The body is a CSV file (`Content-Type: {CSV_MEDIA_TYPE}`) whose header row has an "
+            "`email` column and one column per template variable, or one "
+            '`{"email": ..., "variables": {...}}` object per line '
+            f"(`Content-Type: {NDJSON_MEDIA_TYPE}`). Each recipient's variables override the "
+            "campaign's. The list is validated as it streams in; invalid rows are skipped and "
+            "reported in `rejected` and `errors`.\n\n"
+            "Recipients are then queued in chunks, paced by the SMTP relay's limits, while the "
+            "campaign reports its progress in `queued`, `sent` and `failed`.\n\n"
+            "**Possible Responses:**\n"
+            "- `202`: Recipients accepted, the campaign is running\n"
+            "- `400`: Empty or malformed list, or more than the allowed number of rows\n"
+            "- `404`: Unknown campaign\n"
+            "- `409`: Recipients were already uploaded\n"
+            "- `413`: List larger than the allowed upload size\n"
+            "- `415`: Unsupported content type"
+        ),
+        status_code=status_codes.HTTP_202_ACCEPTED,
+        request_max_body_size=settings.campaign.campaign_max_upload_bytes,
+    )
+    async def upload_recipients(
+        self,
+        campaign_id: str,
+        request: Request,
+        campaigns: CampaignStore,
+        campaign_runner: CampaignRunner,
+    ) -> Response[Campaign]:
+        campaign = await _get_campaign(campaigns, campaign_id)
+        media_type = request.content_type[0]
+        if media_type == CSV_MEDIA_TYPE:
+            rows = iter_csv_rows(request.stream())
+        elif media_type == NDJSON_MEDIA_TYPE:
+            rows = iter_ndjson_rows(request.stream())
+        else:
+            raise ClientException(
+                detail=f"Expected {CSV_MEDIA_TYPE} or {NDJSON_MEDIA_TYPE}",
+                status_code=status_codes.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+        return Response(
+            content=await campaign_runner.ingest(campaign, rows),
+            status_code=status_codes.HTTP_202_ACCEPTED,
+        )
+
+    @get(
+        path="/{campaign_id:str}",
+        summary="Get a campaign and its progress",
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def get_campaign(
+        self, campaign_id: str, campaigns: CampaignStore
+    ) -> Response[Campaign]:
+        return Response(content=await _get_campaign(campaigns, campaign_id))
+
+    @post(
+        path="/{campaign_id:str}/pause",
+        summary="Pause a running campaign",
+        description="Stops queueing recipients; notifications already queued are still sent.",
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def pause_campaign(
+        self, campaign_id: str, campaigns: CampaignStore
+    ) -> Response[Campaign]:
+        return Response(
+            content=await _change_status(campaigns, campaign_id, {"running"}, "paused")
+        )
+
+    @post(
+        path="/{campaign_id:str}/resume",
+        summary="Resume a paused campaign",
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def resume_campaign(
+        self, campaign_id: str, campaigns: CampaignStore
+    ) -> Response[Campaign]:
+        return Response(
+            content=await _change_status(campaigns, campaign_id, {"paused"}, "running")
+        )
+
+    @post(
+        path="/{campaign_id:str}/cancel",
+        summary="Cancel a campaign",
+        description=(
+            "Stops queueing recipients for good; notifications already queued are still sent."
+        ),
+        status_code=status_codes.HTTP_200_OK,
+    )
+    async def cancel_campaign(
+        self, campaign_id: str, campaigns: CampaignStore
+    ) -> Response[Campaign]:
         return Response(
-            content=SuccessResponse(message="Email sent successfully"),
-            background=BackgroundTask(email_sender.send, data),
-            status_code=status_codes.HTTP_201_CREATED,
+            content=await _change_status(
+                campaigns, campaign_id, {"draft", "running", "paused"}, "cancelled"
+            )
+        )
+
+
+async def _get_campaign(campaigns: CampaignStore, campaign_id: str) -> Campaign:
+    campaign = await campaigns.get(campaign_id)
+    if campaign is None:
+        raise NotFoundException(detail=f"Campaign {campaign_id} not found")
+    return campaign
+
+
+async def _change_status(
+    campaigns: CampaignStore, campaign_id: str, allowed: set[str], status: str
+) -> Campaign:
+    current = await campaigns.transition(campaign_id, allowed, status)
+    if current is None:
+        raise NotFoundException(detail=f"Campaign {campaign_id} not found")
+    if current not in allowed:
+        raise ClientException(
+            detail=f"Campaign {campaign_id} is {current}, it cannot be set to {status}",
+            status_code=status_codes.HTTP_409_CONFLICT,
         )
+    return await _get_campaign(campaigns, campaign_id)
@@ -0,0 +1,130 @@
+"""Dead-letter store for notifications that could not be delivered."""
+
+import asyncio
+import json
+import time
+from datetime import UTC, datetime
+from uuid import uuid4
+
+from litestar.stores.base import Store
+from redis.asyncio import Redis
+
+from config import RetrySettings
+from schemas import DeadLetterEntry, EmailInput
+
+INDEX_KEY = "index"
+
+
+class DeadLetterStore:
+    """Keeps undeliverable notifications for inspection and replay.
+
+    Entries live in a Litestar store (memory or Redis, from the store
+    registry) with a TTL. The store API cannot enumerate keys, so the ids of
+    the most recent ``dead_letter_max_entries`` entries are kept in an index
+    entry, newest first, updated under a lock of this process: fit for the
+    memory store only, see :class:`RedisDeadLetterStore`.
+    """
+
+    def __init__(self, store: Store, retry_settings: RetrySettings) -> None:
+        self.store = store
+        self.settings = retry_settings
+        self._index_lock = asyncio.Lock()
+
+    async def add(
+        self,
+        message_id: str,
+        payload: EmailInput,
+        attempts: int,
+        reason: str,
+        error: str,
+    ) -> DeadLetterEntry:
+        entry = DeadLetterEntry(
+            id=uuid4().hex,
+            message_id=message_id,
+            attempts=attempts,
+            reason=reason,
+            error=error,
+            failed_at=datetime.now(UTC),
+            payload=payload,
+        )
+        await self.store.set(
+            f"entry:{entry.id}",
+            entry.model_dump_json(by_alias=True),
+            expires_in=self.settings.dead_letter_ttl,
+        )
+        await self._index_add(entry.id, entry.failed_at.timestamp())
+        return entry
+
+    async def get(self, entry_id: str) -> DeadLetterEntry | None:
+        raw = await self.store.get(f"entry:{entry_id}")
+        return DeadLetterEntry.model_validate_json(raw) if raw else None
+
+    async def recent(self, limit: int) -> list[DeadLetterEntry]:
+        """Most recent entries first; ids whose entry has expired are skipped."""
+        entries = []
+        for entry_id in await self._index_ids():
+            if len(entries) >= limit:
+                break
+            if entry := await self.get(entry_id):
+                entries.append(entry)
+        return entries
+
+    async def delete(self, entry_id: str) -> None:
+        await self.store.delete(f"entry:{entry_id}")
+        await self._index_remove(entry_id)
+
+    async def _index_add(self, entry_id: str, failed_at: float) -> None:
+        async with self._index_lock:
+            ids = await self._index_ids()
+            ids.insert(0, entry_id)
+            await self._save_index(ids[: self.settings.dead_letter_max_entries])
+
+    async def _index_remove(self, entry_id: str) -> None:
+        async with self._index_lock:
+            ids = await self._index_ids()
+            if entry_id in ids:
+                ids.remove(entry_id)
+                await self._save_index(ids)
+
+    async def _index_ids(self) -> list[str]:
+        raw = await self.store.get(INDEX_KEY)
+        return json.loads(raw) if raw else []
+
+    async def _save_index(self, ids: list[str]) -> None:
+        await self.store.set(
+            INDEX_KEY, json.dumps(ids), expires_in=self.settings.dead_letter_ttl
+        )
+
+
+class RedisDeadLetterStore(DeadLetterStore):
+    """Dead letters shared by every process, indexed by a Redis sorted set.
+
+    Ids are scored by failure time, so adding and removing one are single
+    commands that concurrent processes cannot overwrite each other with;
+    ids past ``dead_letter_max_entries`` or older than the TTL are trimmed
+    on each add.
+    """
+
+    def __init__(self, store: Store, retry_settings: RetrySettings, redis: Redis) -> None:
+        super().__init__(store, retry_settings)
+        self.redis = redis
+        self.index_key = retry_settings.dead_letter_index_key
+
+    async def _index_add(self, entry_id: str, failed_at: float) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.index_key, {entry_id: failed_at})
+            pipe.zremrangebyscore(
+                self.index_key, "-inf", time.time() - self.settings.dead_letter_ttl
+            )
+            pipe.zremrangebyrank(
+                self.index_key, 0, -self.settings.dead_letter_max_entries - 1
+            )
+            pipe.expire(self.index_key, self.settings.dead_letter_ttl)
+            await pipe.execute()
+
+    async def _index_remove(self, entry_id: str) -> None:
+        await self.redis.zrem(self.index_key, entry_id)
+
+    async def _index_ids(self) -> list[str]:
+        ids = await self.redis.zrevrange(self.index_key, 0, -1)
+        return [entry_id.decode() for entry_id in ids]
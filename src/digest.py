@@ -0,0 +1,215 @@
+"""Coalescing of notification bursts into digest emails.
+
+The first notification for a (recipient, template) pair is sent right away
+and opens a window of ``DIGEST_WINDOW`` seconds. Notifications for the same
+pair arriving within the window are held, and when it closes they go out
+as a single email rendered with the ``digest`` template, or unchanged if only
+one arrived.
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from config import DigestSettings, QueueSettings, settings
+from metrics import DIGEST_AVOIDED, DIGEST_BUFFERED
+from outbox import Outbox, OutboxMessage
+from schemas import DigestItem, DigestTemplateVariables, EmailInput
+
+logger = logging.getLogger(__name__)
+
+DIGEST_TEMPLATE = "digest"
+
+
+@dataclass
+class _Window:
+    messages: list[OutboxMessage] = field(default_factory=list)
+    timer: asyncio.TimerHandle | None = None
+
+
+def digest_payload(payloads: list[EmailInput]) -> EmailInput:
+    """A single ``digest`` notification listing ``payloads``, addressed like the first."""
+    first = payloads[0]
+    count = len(payloads)
+    items = [
+        DigestItem(
+            subject=payload.subject,
+            headline=getattr(payload.template_variables, "headline", None),
+            body=getattr(payload.template_variables, "body", None),
+            action_url=getattr(payload.template_variables, "action_url", None),
+            action_label=getattr(payload.template_variables, "action_label", None),
+        )
+        for payload in payloads
+    ]
+    return EmailInput(
+        subject=f"{count} notifications: {first.subject}"[:200],
+        template=DIGEST_TEMPLATE,
+        template_variables=DigestTemplateVariables(
+            headline=f"You have {count} new notifications",
+            body=(
+                f"{count} notifications arrived in quick succession "
+                "and were combined into this email."
+            ),
+            items=items,
+        ),
+        to=first.to,
+        cc=first.cc,
+        bcc=first.bcc,
+    )
+
+
+class DigestCoalescer:
+    """Merges bursts of queued notifications to the same recipient into digests.
+
+    The worker pool offers every received message to :meth:`hold` before
+    sending it. Only notifications with a single recipient, no per-recipient
+    variables and a template listed in ``DIGEST_TEMPLATES`` are coalesced;
+    anything else, and the first notification of a window, is left to the
+    worker. Neither are campaign messages: a campaign counts each of its
+    recipients' messages as it is delivered. Windows are kept in process
+    memory, and held notifications are passed to ``on_hold``, if given.
+
+    Held notifications stay unacknowledged on the outbox. When a window
+    closes, its digest, listing their ids in ``members``, is handed to
+    ``deliver``, which sends it like a worker would: the delivery hooks,
+    retries and dead letters then apply to the digest as a whole. The held
+    notifications are acknowledged once ``deliver`` allows it. If the process
+    dies first, they are redelivered when their claim expires, which is also
+    why ``DIGEST_WINDOW`` must be shorter than ``QUEUE_CLAIM_IDLE_AFTER``.
+
+    Memory is bounded by ``DIGEST_MAX_KEYS`` open windows and
+    ``DIGEST_MAX_BUFFERED`` held notifications in total; past either,
+    notifications are sent without coalescing. A window holding
+    ``DIGEST_MAX_ITEMS`` notifications is flushed early.
+    """
+
+    def __init__(
+        self,
+        digest_settings: DigestSettings,
+        queue_settings: QueueSettings,
+        outbox: Outbox,
+        deliver: Callable[[OutboxMessage], Awaitable[bool]],
+        on_hold: Callable[[OutboxMessage], Awaitable[None]] | None = None,
+    ) -> None:
+        self.settings = digest_settings
+        self.outbox = outbox
+        self.deliver = deliver
+        self.on_hold = on_hold
+        self._windows: dict[tuple[str, str], _Window] = {}
+        self._buffered = 0
+        self._flushes: set[asyncio.Task[None]] = set()
+        if digest_settings.digest_window >= queue_settings.queue_claim_idle_after:
+            logger.warning(
+                "DIGEST_WINDOW is not shorter than QUEUE_CLAIM_IDLE_AFTER: held "
+                "notifications will be redelivered, and sent twice",
+                extra={
+                    "digest_window": digest_settings.digest_window,
+                    "claim_idle_after": queue_settings.queue_claim_idle_after,
+                },
+            )
+
+    async def close(self) -> None:
+        """Send every held notification now."""
+        for key in list(self._windows):
+            self._close_window(key)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def hold(self, message: OutboxMessage) -> bool:
+        """Whether ``message`` was held for a digest rather than left to the worker."""
+        key = self._key(message)
+        if key is None:
+            return False
+
+        window = self._windows.get(key)
+        if window is None:
+            if len(self._windows) < self.settings.digest_max_keys:
+                window = self._windows[key] = _Window()
+                window.timer = asyncio.get_running_loop().call_later(
+                    self.settings.digest_window, self._close_window, key
+                )
+            return False
+
+        if self._buffered >= self.settings.digest_max_buffered:
+            return False
+
+        window.messages.append(message)
+        self._buffered += 1
+        DIGEST_BUFFERED.inc()
+        if len(window.messages) >= self.settings.digest_max_items:
+            self._flush(window.messages)
+            window.messages = []
+        if self.on_hold is not None:
+            # The message is held by now; a failing hook must not get it sent twice.
+            try:
+                await self.on_hold(message)
+            except Exception as e:
+                logger.error(
+                    "Failed to record coalesced notification",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+        return True
+
+    def _key(self, message: OutboxMessage) -> tuple[str, str] | None:
+        payload = message.payload
+        if (
+            self.settings.digest_window <= 0
+            or message.campaign_id
+            or payload.template not in self.settings.digest_templates
+            or payload.recipient_variables
+        ):
+            return None
+        recipients = [*payload.to, *payload.cc, *payload.bcc]
+        if len(recipients) > 1:
+            return None
+        recipient = recipients[0] if recipients else settings.email_recipient
+        return recipient.lower(), payload.template
+
+    def _close_window(self, key: tuple[str, str]) -> None:
+        window = self._windows.pop(key)
+        if window.timer is not None:
+            window.timer.cancel()
+        if window.messages:
+            self._flush(window.messages)
+
+    def _flush(self, messages: list[OutboxMessage]) -> None:
+        self._buffered -= len(messages)
+        DIGEST_BUFFERED.dec(len(messages))
+        task = asyncio.create_task(self._send_digest(messages), name="digest-flush")
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send_digest(self, messages: list[OutboxMessage]) -> None:
+        if len(messages) == 1:
+            digest = messages[0]
+        else:
+            DIGEST_AVOIDED.inc(len(messages) - 1)
+            logger.info(
+                "Sending digest",
+                extra={
+                    "notifications": len(messages),
+                    "template": messages[0].payload.template,
+                },
+            )
+            # A digest belongs to none of the requests it merges.
+            digest = OutboxMessage(
+                payload=digest_payload([message.payload for message in messages]),
+                request_id=None,
+                members=[message.id for message in messages],
+            )
+        # Left unacknowledged when it could not be sent nor rescheduled: the
+        # held notifications are then redelivered once their claim expires.
+        if not await self.deliver(digest):
+            return
+        try:
+            await self.outbox.ack_many(messages)
+        except Exception as e:
+            logger.error(
+                "Failed to acknowledge coalesced notifications",
+                extra={
+                    "message_id": digest.id,
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                },
+            )
@@ -0,0 +1,177 @@
+"""Idempotent request handling: replay the stored response of a repeated request.
+
+A request carrying an ``Idempotency-Key`` header gets the response of the
+first request made with that key, for ``IDEMPOTENCY_TTL`` seconds. Optionally,
+identical request bodies are also deduplicated within
+``IDEMPOTENCY_CONTENT_WINDOW`` seconds without a key. Both are scoped to the
+authenticated API key and stored in the ``idempotency`` store of the app's
+store registry.
+
+A key is reserved before the request is handled: a concurrent request with
+the same key gets 409 until the first one completes, then its response.
+The reservation is released if the request fails, and otherwise expires
+after ``IDEMPOTENCY_LOCK_TTL`` seconds, e.g. when the process dies mid-request.
+"""
+
+import hashlib
+import json
+import logging
+from typing import Any
+
+from litestar import Request, Response
+from litestar.exceptions import ClientException
+from litestar.stores.base import StorageObject
+from litestar.stores.memory import MemoryStore
+from litestar.stores.redis import RedisStore
+from litestar.types import Scope
+from pydantic import BaseModel
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+STORE_NAME = "idempotency"
+MAX_KEY_LENGTH = 255
+
+
+class MemoryIdempotencyStore(MemoryStore):
+    """Memory store that can also set a key only if it is absent."""
+
+    async def add(self, key: str, value: str | bytes, expires_in: int) -> bool:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        async with self._lock:
+            stored = self._store.get(key)
+            if stored is not None and not stored.expired:
+                return False
+            self._store[key] = StorageObject.new(data=value, expires_in=expires_in)
+            return True
+
+
+class RedisIdempotencyStore(RedisStore):
+    """Redis store that can also set a key only if it is absent (``SET NX``)."""
+
+    async def add(self, key: str, value: str | bytes, expires_in: int) -> bool:
+        return bool(await self._redis.set(self._make_key(key), value, nx=True, ex=expires_in))
+
+
+IdempotencyStore = MemoryIdempotencyStore | RedisIdempotencyStore
+
+
+def _store(request: Request) -> IdempotencyStore:
+    return request.app.stores.get(STORE_NAME)
+
+
+def _scope(request: Request) -> str:
+    return str(request.auth) if request.auth else "anonymous"
+
+
+def _replay(stored: dict[str, Any]) -> Response[Any]:
+    return Response(
+        content=stored["body"],
+        status_code=stored["status"],
+        headers={REPLAYED_HEADER: "true"},
+    )
+
+
+async def replay_stored_response(request: Request) -> Response[Any] | None:
+    """``before_request`` hook returning the stored response of a repeated request.
+
+    Runs before the body is validated, so a replay costs one store lookup.
+    Reusing a key with a different body is rejected with 422, and reusing
+    it while the first request is in progress with 409.
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    window = settings.idempotency_content_window
+    if key is None and not window:
+        return None
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise ClientException(
+            detail=f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters"
+        )
+
+    store = _store(request)
+    scope = _scope(request)
+    fingerprint = hashlib.sha256(await request.body()).hexdigest()
+    key_id = f"{scope}:key:{key}" if key is not None else None
+
+    if key_id is not None:
+        reservation = json.dumps({"fingerprint": fingerprint, "inFlight": True})
+        if not await store.add(key_id, reservation, settings.idempotency_lock_ttl):
+            raw = await store.get(key_id)
+            # Gone if the request holding the key failed in between: still a conflict.
+            stored = json.loads(raw) if raw else {"fingerprint": fingerprint, "inFlight": True}
+            if stored["fingerprint"] != fingerprint:
+                raise ClientException(
+                    detail=(
+                        f"{IDEMPOTENCY_HEADER} was already used "
+                        "with a different request body"
+                    ),
+                    status_code=422,
+                )
+            if stored.get("inFlight"):
+                raise ClientException(
+                    detail=f"A request with this {IDEMPOTENCY_HEADER} is still in progress",
+                    status_code=409,
+                    headers={"Retry-After": "1"},
+                )
+            logger.info("Replaying idempotent response", extra={"scope": scope})
+            return _replay(stored)
+    # Set once the key is reserved, so that only its holder stores or releases it.
+    request.state.idempotency = (key_id, fingerprint)
+
+    if window:
+        raw = await store.get(f"{scope}:content:{fingerprint}")
+        if raw is not None:
+            logger.info("Suppressed duplicate request", extra={"scope": scope})
+            if key_id is not None:
+                await store.set(key_id, raw, expires_in=settings.idempotency_ttl)
+            request.state.idempotency = None
+            return _replay(json.loads(raw))
+    return None
+
+
+async def store_response(request: Request, status_code: int, body: BaseModel) -> None:
+    """Remember the response of a request checked by :func:`replay_stored_response`.
+
+    Replaces the reservation of its key, which is then no longer released on error.
+    """
+    state = request.state.get("idempotency")
+    if state is None:
+        return
+    request.state.idempotency = None
+    key_id, fingerprint = state
+    store = _store(request)
+    scope = _scope(request)
+    stored = json.dumps(
+        {
+            "status": status_code,
+            "body": body.model_dump(mode="json", by_alias=True),
+            "fingerprint": fingerprint,
+        }
+    )
+    if key_id is not None:
+        await store.set(key_id, stored, expires_in=settings.idempotency_ttl)
+    if settings.idempotency_content_window:
+        await store.set(
+            f"{scope}:content:{fingerprint}",
+            stored,
+            expires_in=settings.idempotency_content_window,
+        )
+
+
+async def release_reservation(exception: Exception, scope: Scope) -> None:
+    """``after_exception`` hook freeing the key of a request that failed, for its retry."""
+    state = scope.get("state", {}).get("idempotency")
+    if state is None or state[0] is None:
+        return
+    store: IdempotencyStore = scope["litestar_app"].stores.get(STORE_NAME)
+    try:
+        await store.delete(state[0])
+    except Exception as e:
+        logger.error(
+            "Failed to release idempotency key",
+            extra={"error_type": type(e).__name__, "error_message": str(e)},
+        )
@@ -0,0 +1,337 @@
+"""Structured logging written by a background thread.
+
+Records are put on a bounded queue by :class:`QueueLogHandler` and formatted
+and written in batches by a writer thread, so logging never blocks the event
+loop on stderr. Each record carries the id of the HTTP request and of the
+queued message it was logged for, and the fields passed as ``extra``.
+Repetitive loggers can be sampled or rate limited with ``LOG_SAMPLE_RATES``
+and ``LOG_RATE_LIMITS``.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from typing import IO, Any
+from uuid import uuid4
+
+from litestar.datastructures import MutableScopeHeaders
+from litestar.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import LogSettings, settings
+from metrics import LOG_RECORDS_DROPPED
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+message_id_var: ContextVar[str | None] = ContextVar("message_id", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+_REQUEST_ID_STATE = "request_id"
+
+# Attributes every LogRecord has; anything else on a record came from ``extra``.
+# uvicorn adds an ANSI-colored copy of some messages, which is left out.
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "taskName",
+    "color_message",
+}
+
+_STOP = object()
+
+
+@contextmanager
+def correlation(
+    message_id: str | None = None, request_id: str | None = None
+) -> Iterator[None]:
+    """Attach ``message_id`` and ``request_id`` to records logged in this block."""
+    message_token = message_id_var.set(message_id)
+    request_token = request_id_var.set(request_id)
+    try:
+        yield
+    finally:
+        request_id_var.reset(request_token)
+        message_id_var.reset(message_token)
+
+
+def correlation_middleware(app: ASGIApp) -> ASGIApp:
+    """Give each HTTP request an id, taken from ``X-Request-ID`` when the client sent a valid one.
+
+    The id is attached to every record logged while handling the request and
+    to the notifications it queues; :func:`add_request_id_header` returns it.
+    """
+    header = REQUEST_ID_HEADER.lower().encode()
+
+    async def middleware(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == header:
+                candidate = value.decode("latin-1")
+                if _VALID_REQUEST_ID.fullmatch(candidate):
+                    request_id = candidate
+                break
+        request_id = request_id or uuid4().hex
+        scope["state"][_REQUEST_ID_STATE] = request_id
+
+        token = request_id_var.set(request_id)
+        try:
+            await app(scope, receive, send)
+        finally:
+            request_id_var.reset(token)
+
+    return middleware
+
+
+async def add_request_id_header(message: Message, scope: Scope) -> None:
+    """``before_send`` hook; unlike middleware it also sees error responses."""
+    if message["type"] == "http.response.start":
+        if request_id := scope.get("state", {}).get(_REQUEST_ID_STATE):
+            MutableScopeHeaders.from_message(message)[REQUEST_ID_HEADER] = request_id
+
+
+class CorrelationFilter(logging.Filter):
+    """Copies the current request and message ids onto records that lack them."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id") and (request_id := request_id_var.get()):
+            record.request_id = request_id
+        if not hasattr(record, "message_id") and (message_id := message_id_var.get()):
+            record.message_id = message_id
+        return True
+
+
+def _setting_for(name: str, values: dict[str, float]) -> float | None:
+    """The value configured for logger ``name`` or its closest configured parent."""
+    while True:
+        if name in values:
+            return values[name]
+        if "." not in name:
+            return None
+        name = name.rsplit(".", 1)[0]
+
+
+class ThrottleFilter(logging.Filter):
+    """Samples and rate limits records per logger.
+
+    Records below WARNING from a logger in ``sample_rates`` are kept with
+    that probability. Records of any level from a logger in ``rate_limits``
+    are limited to that many per second for each message, with a burst of
+    one second's worth; the next record let through reports how many were
+    ``suppressed`` in between.
+    """
+
+    def __init__(self, sample_rates: dict[str, float], rate_limits: dict[str, float]) -> None:
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate_limits = rate_limits
+        self._buckets: dict[tuple[str, str], tuple[float, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and self.sample_rates:
+            rate = _setting_for(record.name, self.sample_rates)
+            if rate is not None and random.random() >= rate:
+                LOG_RECORDS_DROPPED.inc(reason="sampled")
+                return False
+
+        if not self.rate_limits:
+            return True
+        rate = _setting_for(record.name, self.rate_limits)
+        if rate is None:
+            return True
+        key = (record.name, str(record.msg))
+        burst = max(rate, 1.0)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, suppressed = self._buckets.get(key, (burst, now, 0))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                LOG_RECORDS_DROPPED.inc(reason="rate_limited")
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def record_fields(record: logging.LogRecord) -> dict[str, Any]:
+    """The ``extra`` fields of ``record``, plus its correlation ids."""
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, ``extra`` fields included."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        document: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+            **record_fields(record),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        if record.stack_info:
+            document["stack"] = record.stack_info
+        return json.dumps(document, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, followed by the ``extra`` fields as JSON."""
+
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if fields := record_fields(record):
+            first, newline, rest = line.partition("\n")
+            line = f"{first} {json.dumps(fields, default=str, ensure_ascii=False)}{newline}{rest}"
+        return line
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands records to a writer thread that formats and writes them in batches.
+
+    Logging only costs the caller a queue put. When the queue is full the
+    record is dropped and counted rather than blocking. The writer thread
+    starts with the first record; before a fork it writes out what is queued
+    and stops, so that no thread is running while forking, and it starts
+    again in both processes. Closing the handler writes out everything queued.
+    """
+
+    def __init__(
+        self,
+        formatter: logging.Formatter,
+        queue_size: int,
+        batch_size: int,
+        stream: IO[str] | None = None,
+    ) -> None:
+        super().__init__()
+        self.setFormatter(formatter)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stream = stream or sys.stderr
+        self._queue: queue.Queue[Any] = queue.Queue(queue_size)
+        self._writer: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        os.register_at_fork(before=self._stop_writer, after_in_child=self._after_fork)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._prepare(record)
+            if self._writer is None:
+                self._start_writer()
+            self._queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason="queue_full")
+        except Exception:
+            self.handleError(record)
+
+    def close(self) -> None:
+        self._stop_writer()
+        super().close()
+
+    def _prepare(self, record: logging.LogRecord) -> None:
+        # Resolve everything tied to the caller's state before another
+        # thread formats the record.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+
+    def _start_writer(self) -> None:
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_batches, name="log-writer", daemon=True
+                )
+                self._writer.start()
+
+    def _stop_writer(self) -> None:
+        with self._start_lock:
+            writer = self._writer
+            if writer is not None and writer.is_alive():
+                self._queue.put(_STOP)
+                writer.join(timeout=5)
+            self._writer = None
+
+    def _after_fork(self) -> None:
+        # Records queued by other threads while forking stay the parent's to write.
+        self._queue = queue.Queue(self.queue_size)
+        self._start_lock = threading.Lock()
+
+    def _write_batches(self) -> None:
+        records = self._queue
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is _STOP:
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+            if any(record is _STOP for record in batch):
+                return
+
+
+_handler: QueueLogHandler | None = None
+
+
+def configure_logging(log_settings: LogSettings = settings.log) -> None:
+    """Route every log record through the structured, non-blocking handler.
+
+    Safe to call more than once; only the first call installs the handler.
+    """
+    global _handler
+    if _handler is not None:
+        return
+    formatter = JSONFormatter() if log_settings.log_format == "json" else TextFormatter()
+    _handler = QueueLogHandler(
+        formatter, log_settings.log_queue_size, log_settings.log_batch_size
+    )
+    _handler.addFilter(
+        ThrottleFilter(log_settings.log_sample_rates, log_settings.log_rate_limits)
+    )
+    _handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(logging.DEBUG if settings.debug else log_settings.log_level)
@@ -7,32 +7,63 @@ warnings.filterwarnings(
 )
 
 import logging
+from typing import Any
+
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
 from litestar import Litestar
 from litestar.config.cors import CORSConfig
 from litestar.config.csrf import CSRFConfig
-from litestar.middleware.rate_limit import RateLimitConfig
+from litestar.contrib.pydantic import PydanticPlugin
 from litestar.openapi import OpenAPIConfig
 from litestar.openapi.plugins import RedocRenderPlugin, SwaggerRenderPlugin
 from litestar.openapi.spec import License
 
 from auth import APIKeyAuthMiddleware
 from config import settings
-from controllers import NotificationsRouter, HealthController
-from register_deps import DEPENDENCIES, create_stores
+from controllers import (
+    CampaignController,
+    DeadLetterController,
+    HealthController,
+    MetricsController,
+    NotificationsRouter,
+    ScheduledController,
+)
+from idempotency import release_reservation
+from logs import (
+    REQUEST_ID_HEADER,
+    add_request_id_header,
+    configure_logging,
+    correlation_middleware,
+)
+from register_deps import DEPENDENCIES, ON_SHUTDOWN, ON_STARTUP, rate_limiter, stores
 
-logging.basicConfig(
-    level=logging.INFO if not settings.debug else logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+configure_logging()
+
+# Longest prefix first, so the most specific route override wins.
+_route_sample_rates = sorted(
+    settings.sentry_route_sample_rates.items(), key=lambda item: len(item[0]), reverse=True
 )
 
+
+def traces_sampler(sampling_context: dict[str, Any]) -> float:
+    """Trace sample rate for a request, honouring upstream decisions and route overrides."""
+    parent_sampled = sampling_context.get("parent_sampled")
+    if parent_sampled is not None:
+        return float(parent_sampled)
+    path = sampling_context.get("asgi_scope", {}).get("path", "")
+    for prefix, rate in _route_sample_rates:
+        if path.startswith(prefix):
+            return rate
+    return settings.sentry_traces_sample_rate
+
+
 if settings.glitchtip_dsn:
     logging.info("Initializing Sentry/Glitchtip with DSN: %s", settings.glitchtip_dsn)
     sentry_sdk.init(
         dsn=settings.glitchtip_dsn,
         environment="development" if settings.debug else "production",
-        traces_sample_rate=1.0,
+        traces_sampler=traces_sampler,
         send_default_pii=False,
         integrations=[
             LoggingIntegration(
@@ -45,26 +76,21 @@ if settings.glitchtip_dsn:
 cors_config = CORSConfig(
     allow_origins=settings.security.cors_origins,
     allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "X-API-KEY", "X-CSRF-Token"],
+    allow_headers=[
+        "Content-Type",
+        "X-API-KEY",
+        "X-CSRF-Token",
+        "Idempotency-Key",
+        REQUEST_ID_HEADER,
+    ],
+    expose_headers=[REQUEST_ID_HEADER],
     allow_credentials=True,
     max_age=600,
 )
 
-rate_limit_config = RateLimitConfig(
-    rate_limit=(
-        settings.security.rate_limit_window,
-        settings.security.rate_limit_requests,
-    ),
-    exclude=[r"^/$", r"^/schema/?.*"],
-    identifier_for_request=lambda request: (
-        request.client.host if request.client else "unknown"
-    ),
-    store="rate_limit",  # Will use Redis/DragonflyDB if configured, otherwise memory
-)
-
 csrf_config = (
     CSRFConfig(
-        secret=settings.security.api_key,
+        secret=settings.security.csrf_secret,
         cookie_httponly=True,
         cookie_secure=not settings.debug,
     )
@@ -75,9 +101,23 @@ csrf_config = (
 app = Litestar(
     debug=settings.debug,
     dependencies=DEPENDENCIES,
-    stores=create_stores(),
-    route_handlers=[HealthController, NotificationsRouter],
-    middleware=[APIKeyAuthMiddleware, rate_limit_config.middleware],
+    stores=stores,
+    plugins=[PydanticPlugin(prefer_alias=True)],
+    on_startup=ON_STARTUP,
+    on_shutdown=ON_SHUTDOWN,
+    before_send=[add_request_id_header],
+    after_exception=[release_reservation],
+    # Logging is set up by configure_logging; keep Litestar's from replacing it.
+    logging_config=None,
+    route_handlers=[
+        HealthController,
+        MetricsController,
+        NotificationsRouter,
+        ScheduledController,
+        DeadLetterController,
+        CampaignController,
+    ],
+    middleware=[correlation_middleware, APIKeyAuthMiddleware, rate_limiter.middleware],
     cors_config=cors_config,
     csrf_config=csrf_config,
     openapi_config=OpenAPIConfig(
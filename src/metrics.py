@@ -0,0 +1,323 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Deliberately small: counters, gauges and histograms with fixed label names,
+enough to instrument the send pipeline without pulling in a client library.
+Values are per process; scrape every API and worker process. Updates may
+come from any thread (render executor, log writer), so each metric guards
+its values with a lock.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, TypeVar
+
+if TYPE_CHECKING:
+    from outbox import Outbox
+    from scheduler import DeliveryScheduler
+    from smtp_pool import SMTPConnectionPool
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers sub-millisecond sanitizing up to slow SMTP handshakes.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str | int]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+            *self.samples(),
+        ]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, optionally split by labels."""
+
+    type_name = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self._values[()] = 0.0
+
+    def inc(self, amount: float = 1.0, **labels: str | int) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str | int) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str | int) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str | int) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels: str | int) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: non-cumulative bucket counts (last one is +Inf), sum.
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str | int) -> None:
+        key = self._key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[bucket] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str | int) -> Iterator[None]:
+        """Observe the wall-clock duration of the block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            snapshot = [
+                (key, list(counts), self._sums[key]) for key, counts in self._counts.items()
+            ]
+        for key, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield (
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} "
+                    f"{cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.register(
+    Histogram(
+        "notifications_stage_duration_seconds",
+        "Time spent in each stage of the send pipeline.",
+        ["stage"],
+    )
+)
+RENDER_CACHE_LOOKUPS = registry.register(
+    Counter(
+        "notifications_render_cache_lookups_total",
+        "Rendered-message cache lookups, by result (hit or miss).",
+        ["result"],
+    )
+)
+RENDER_CACHE_BYTES = registry.register(
+    Gauge("notifications_render_cache_bytes", "Size of the messages in the render cache.")
+)
+QUEUE_DEPTH = registry.register(
+    Gauge("notifications_queue_depth", "Messages waiting in the outbound queue.")
+)
+SCHEDULED = registry.register(
+    Gauge(
+        "notifications_scheduled",
+        "Messages held by the scheduler until their due time, including retries.",
+    )
+)
+SMTP_IN_FLIGHT = registry.register(
+    Gauge("notifications_smtp_in_flight", "SMTP transactions currently in progress.")
+)
+SEND_LIMIT = registry.register(
+    Gauge(
+        "notifications_send_limit",
+        "Current cap on concurrent SMTP transactions, lowered when the relay pushes back.",
+    )
+)
+SEND_WAITING = registry.register(
+    Gauge("notifications_send_waiting", "SMTP transactions waiting for a send slot.")
+)
+SEND_THROTTLES = registry.register(
+    Counter(
+        "notifications_send_throttles_total",
+        "Times the send concurrency cap was lowered, by trigger.",
+        ["reason"],
+    )
+)
+SMTP_CONNECTIONS = registry.register(
+    Gauge("notifications_smtp_connections", "Open pooled SMTP connections.", ["state"])
+)
+DELIVERED = registry.register(
+    Counter("notifications_delivered_total", "Recipients a message was accepted for.")
+)
+DELIVERY_FAILURES = registry.register(
+    Counter(
+        "notifications_delivery_failures_total",
+        "Recipients a delivery attempt failed for, by SMTP reply code "
+        "(the error type when the server gave no reply).",
+        ["code"],
+    )
+)
+RETRIES = registry.register(
+    Counter("notifications_retries_total", "Delivery retries scheduled.")
+)
+DIGEST_BUFFERED = registry.register(
+    Gauge(
+        "notifications_digest_buffered",
+        "Notifications held in open digest windows.",
+    )
+)
+DIGEST_AVOIDED = registry.register(
+    Counter(
+        "notifications_digest_avoided_total",
+        "Sends avoided by merging notifications into digests.",
+    )
+)
+LOG_RECORDS_DROPPED = registry.register(
+    Counter(
+        "notifications_log_records_dropped_total",
+        "Log records not written, by reason (sampled, rate_limited or queue_full).",
+        ["reason"],
+    )
+)
+RATE_LIMIT_CHECKS = registry.register(
+    Counter(
+        "notifications_rate_limit_checks_total",
+        "Requests checked against their rate limit, by where they were answered "
+        "(local tokens or the store) and result.",
+        ["source", "result"],
+    )
+)
+STATUS_UPDATES_DROPPED = registry.register(
+    Counter(
+        "notifications_status_updates_dropped_total",
+        "Delivery status updates not saved, by reason (buffer_full or store_error).",
+        ["reason"],
+    )
+)
+AUTH_ATTEMPTS = registry.register(
+    Counter(
+        "notifications_auth_total",
+        "Authentication attempts by result and API key name.",
+        ["result", "key"],
+    )
+)
+DEAD_LETTERS = registry.register(
+    Counter(
+        "notifications_dead_letters_total",
+        "Notifications moved to the dead-letter store.",
+        ["reason"],
+    )
+)
+
+
+async def collect(
+    outbox: "Outbox", scheduler: "DeliveryScheduler", smtp_pool: "SMTPConnectionPool"
+) -> str:
+    """Refresh the gauges read from live components and render every metric."""
+    QUEUE_DEPTH.set(await outbox.depth())
+    SCHEDULED.set(await scheduler.pending())
+    SMTP_CONNECTIONS.set(smtp_pool.idle, state="idle")
+    SMTP_CONNECTIONS.set(smtp_pool.size - smtp_pool.idle, state="in_use")
+    return registry.render()
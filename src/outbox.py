@@ -0,0 +1,449 @@
+"""Outbound notification queue with pluggable backends and a consumer worker pool."""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Any
+from uuid import uuid4
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from config import QueueSettings, settings
+from logs import correlation, request_id_var
+from schemas import EmailInput
+from sender import DeliveryError, FailedDelivery, ISender
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the outbox refuses new messages to apply backpressure."""
+
+
+class UndeliverableError(Exception):
+    """A message was handed out ``QUEUE_MAX_DELIVERIES`` times and never acknowledged."""
+
+
+@dataclass
+class OutboxMessage:
+    """A queued notification and its delivery metadata."""
+
+    payload: EmailInput
+    id: str = field(default_factory=lambda: uuid4().hex)
+    attempt: int = 0
+    receipt: str | None = None  # Backend handle used to acknowledge delivery
+    # HTTP request that queued the message, for log correlation
+    request_id: str | None = field(default_factory=request_id_var.get)
+    campaign_id: str | None = None  # Campaign the message was queued for
+    members: list[str] = field(default_factory=list)  # Notifications a digest stands for
+    # Times the outbox handed the message out, this one included; not serialized
+    deliveries: int = 1
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "id": self.id,
+                "attempt": self.attempt,
+                "request_id": self.request_id,
+                "campaign_id": self.campaign_id,
+                "members": self.members,
+                "payload": self.payload.model_dump(mode="json", by_alias=True),
+            }
+        )
+
+    @classmethod
+    def loads(cls, raw: str | bytes, receipt: str | None = None) -> "OutboxMessage":
+        data = json.loads(raw)
+        return cls(
+            payload=EmailInput.model_validate(data["payload"]),
+            id=data["id"],
+            attempt=data["attempt"],
+            receipt=receipt,
+            request_id=data.get("request_id"),
+            campaign_id=data.get("campaign_id"),
+            members=data.get("members", []),
+        )
+
+
+class Outbox(ABC):
+    """Queue of notifications waiting to be sent.
+
+    Delivery is at-least-once: a received message stays owned by the consumer
+    until it is acknowledged, and is handed out again if that does not happen
+    within ``queue_claim_idle_after`` seconds.
+    """
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def enqueue(self, message: OutboxMessage) -> None:
+        """Add a message, raising :class:`QueueFullError` when at capacity."""
+
+    async def enqueue_many(self, messages: list[OutboxMessage]) -> int:
+        """Add messages in order until the outbox is full; returns how many fit."""
+        for accepted, message in enumerate(messages):
+            try:
+                await self.enqueue(message)
+            except QueueFullError:
+                return accepted
+        return len(messages)
+
+    @abstractmethod
+    async def receive(self, count: int, timeout: float) -> list[OutboxMessage]:
+        """Wait up to ``timeout`` seconds for at most ``count`` messages."""
+
+    @abstractmethod
+    async def ack(self, message: OutboxMessage) -> None:
+        """Mark a received message as delivered."""
+
+    async def ack_many(self, messages: list[OutboxMessage]) -> None:
+        for message in messages:
+            await self.ack(message)
+
+    @abstractmethod
+    async def depth(self) -> int:
+        """Number of messages queued or awaiting acknowledgement."""
+
+
+class MemoryOutbox(Outbox):
+    """In-process queue for development; its contents do not survive a restart."""
+
+    def __init__(self, queue_settings: QueueSettings) -> None:
+        self.settings = queue_settings
+        self._queue: asyncio.Queue[OutboxMessage] = asyncio.Queue()
+        self._in_flight: dict[str, tuple[OutboxMessage, float]] = {}
+
+    async def close(self) -> None:
+        pending = self._queue.qsize() + len(self._in_flight)
+        if pending:
+            logger.warning(
+                "Discarding undelivered notifications from memory outbox",
+                extra={"pending": pending},
+            )
+
+    async def enqueue(self, message: OutboxMessage) -> None:
+        if await self.depth() >= self.settings.queue_max_size:
+            raise QueueFullError("Outbox is full")
+        self._queue.put_nowait(message)
+
+    async def receive(self, count: int, timeout: float) -> list[OutboxMessage]:
+        messages = self._reclaim(count)
+        if not messages:
+            try:
+                messages.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except TimeoutError:
+                return []
+        while len(messages) < count and not self._queue.empty():
+            messages.append(self._queue.get_nowait())
+
+        deadline = time.monotonic() + self.settings.queue_claim_idle_after
+        for message in messages:
+            self._in_flight[message.id] = (message, deadline)
+        return messages
+
+    async def ack(self, message: OutboxMessage) -> None:
+        self._in_flight.pop(message.id, None)
+
+    async def depth(self) -> int:
+        return self._queue.qsize() + len(self._in_flight)
+
+    def _reclaim(self, count: int) -> list[OutboxMessage]:
+        now = time.monotonic()
+        expired = [m for m, deadline in self._in_flight.values() if deadline <= now]
+        for message in expired[:count]:
+            message.deliveries += 1
+        return expired[:count]
+
+
+class RedisStreamOutbox(Outbox):
+    """Durable queue backed by a Redis stream and a consumer group.
+
+    Acknowledged entries are deleted from the stream, so ``XLEN`` reflects the
+    backlog and doubles as the capacity check. Entries left unacknowledged by a
+    crashed consumer are taken over with ``XAUTOCLAIM``.
+    """
+
+    def __init__(self, redis: Redis, queue_settings: QueueSettings) -> None:
+        self.redis = redis
+        self.settings = queue_settings
+        self.stream = queue_settings.queue_stream
+        self.group = queue_settings.queue_consumer_group
+        # Named in start(): serve.py imports the app, then forks the web workers.
+        self.consumer = ""
+
+    async def start(self) -> None:
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def enqueue(self, message: OutboxMessage) -> None:
+        if await self.redis.xlen(self.stream) >= self.settings.queue_max_size:
+            raise QueueFullError("Outbox is full")
+        await self.redis.xadd(self.stream, {"data": message.dumps()})
+
+    async def enqueue_many(self, messages: list[OutboxMessage]) -> int:
+        free = self.settings.queue_max_size - await self.redis.xlen(self.stream)
+        accepted = messages[: max(free, 0)]
+        if accepted:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for message in accepted:
+                    pipe.xadd(self.stream, {"data": message.dumps()})
+                await pipe.execute()
+        return len(accepted)
+
+    async def receive(self, count: int, timeout: float) -> list[OutboxMessage]:
+        claimed = await self.redis.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=int(self.settings.queue_claim_idle_after * 1000),
+            count=count,
+        )
+        # Redis < 7 replies with two elements and may include deleted entries.
+        entries: list[tuple[Any, dict[bytes, bytes]]] = [
+            entry for entry in claimed[1] if entry[1]
+        ]
+        if entries:
+            # Taken over from a consumer that never acknowledged them, maybe repeatedly.
+            deliveries = await self._deliveries([entry_id for entry_id, _ in entries])
+            return [
+                self._decode(entry_id, fields, times)
+                for (entry_id, fields), times in zip(entries, deliveries)
+            ]
+        response = await self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=count,
+            block=int(timeout * 1000),
+        )
+        for _, stream_entries in response or []:
+            entries.extend(stream_entries)
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    async def ack(self, message: OutboxMessage) -> None:
+        await self.ack_many([message])
+
+    async def ack_many(self, messages: list[OutboxMessage]) -> None:
+        receipts = [message.receipt for message in messages]
+        if not receipts:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xack(self.stream, self.group, *receipts)
+            pipe.xdel(self.stream, *receipts)
+            await pipe.execute()
+
+    async def depth(self) -> int:
+        return await self.redis.xlen(self.stream)
+
+    async def _deliveries(self, entry_ids: list[Any]) -> list[int]:
+        """Delivery counts of claimed entries, from the group's pending entries list."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for entry_id in entry_ids:
+                pipe.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+            results = await pipe.execute()
+        return [pending[0]["times_delivered"] if pending else 1 for pending in results]
+
+    def _decode(
+        self, entry_id: Any, fields: dict[bytes, bytes], deliveries: int = 1
+    ) -> OutboxMessage:
+        receipt = entry_id.decode() if isinstance(entry_id, bytes) else str(entry_id)
+        message = OutboxMessage.loads(fields[b"data"], receipt=receipt)
+        message.deliveries = deliveries
+        return message
+
+
+class OutboxWorkerPool:
+    """Fixed pool of consumers draining the outbox into an :class:`ISender`.
+
+    The number of workers is the upper bound on concurrent sends from this
+    process, independently of how fast requests arrive. Delivery failures are
+    passed to ``on_failure`` (which reschedules or dead-letters them) and the
+    message is then acknowledged. Messages are passed to ``on_sending``
+    before each attempt and to ``on_delivered`` once delivered, if given.
+
+    Each received message is first offered to ``coalesce``, if given; one it
+    takes is neither sent nor acknowledged by the worker, but later by its
+    taker, through :meth:`deliver`.
+
+    A message handed out more than ``QUEUE_MAX_DELIVERIES`` times, because
+    every attempt crashed or failed unexpectedly, is not tried again: it goes
+    to ``on_failure`` as a permanent :class:`UndeliverableError`, which
+    dead-letters it, and is acknowledged.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        sender: ISender[EmailInput],
+        queue_settings: QueueSettings,
+        on_failure: Callable[[OutboxMessage, DeliveryError], Awaitable[None]],
+        on_delivered: Callable[[OutboxMessage], Awaitable[None]] | None = None,
+        on_sending: Callable[[OutboxMessage], Awaitable[None]] | None = None,
+        coalesce: Callable[[OutboxMessage], Awaitable[bool]] | None = None,
+    ) -> None:
+        self.outbox = outbox
+        self.sender = sender
+        self.settings = queue_settings
+        self.on_failure = on_failure
+        self.on_delivered = on_delivered
+        self.on_sending = on_sending
+        self.coalesce = coalesce
+        self._tasks: list[asyncio.Task[None]] = []
+        self._stopping = asyncio.Event()
+
+    async def start(self) -> None:
+        self._stopping.clear()
+        self._tasks = [
+            asyncio.create_task(self._consume(), name=f"outbox-worker-{i}")
+            for i in range(self.settings.queue_workers)
+        ]
+        logger.info(
+            "Started outbox workers", extra={"workers": self.settings.queue_workers}
+        )
+
+    async def close(self) -> None:
+        """Let in-progress sends finish, then stop the workers."""
+        self._stopping.set()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(
+            self._tasks, timeout=self.settings.queue_shutdown_timeout
+        )
+        for task in pending:
+            task.cancel()
+        for task in pending:
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    async def _consume(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                messages = await self.outbox.receive(
+                    count=self.settings.queue_batch_size,
+                    timeout=self.settings.queue_poll_timeout,
+                )
+            except Exception as e:
+                logger.error(
+                    "Failed to read from outbox",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+                await asyncio.sleep(self.settings.queue_poll_timeout)
+                continue
+
+            # Messages of a batch go out back to back over the same pooled
+            # connection and are acknowledged together.
+            delivered = [m for m in messages if await self._process(m)]
+            try:
+                await self.outbox.ack_many(delivered)
+            except Exception as e:
+                logger.error(
+                    "Failed to acknowledge delivered notifications",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+
+    async def _process(self, message: OutboxMessage) -> bool:
+        """Handle a received message; returns whether it can be acknowledged."""
+        if message.deliveries > self.settings.queue_max_deliveries:
+            payload = message.payload
+            error = UndeliverableError(
+                f"Handed out {message.deliveries} times without being acknowledged"
+            )
+            recipients = [*payload.to, *payload.cc, *payload.bcc] or [settings.email_recipient]
+            with correlation(message.id, message.request_id):
+                logger.error(
+                    "Giving up on a notification that is never acknowledged",
+                    extra={"message_id": message.id, "deliveries": message.deliveries},
+                )
+                return await self._handle_failure(
+                    message, DeliveryError([FailedDelivery(recipients, error)])
+                )
+        if await self._hold(message):
+            return False
+        return await self.deliver(message)
+
+    async def _hold(self, message: OutboxMessage) -> bool:
+        if self.coalesce is None:
+            return False
+        try:
+            return await self.coalesce(message)
+        except Exception as e:
+            logger.error(
+                "Failed to coalesce notification, sending it directly",
+                extra={
+                    "message_id": message.id,
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                },
+            )
+            return False
+
+    async def deliver(self, message: OutboxMessage) -> bool:
+        """Send one message; returns whether it can be acknowledged."""
+        with correlation(message.id, message.request_id):
+            if self.on_sending is not None:
+                await self._notify(self.on_sending, message)
+            try:
+                await self.sender.send(message.payload)
+            except DeliveryError as e:
+                return await self._handle_failure(message, e)
+            except Exception as e:
+                # Left unacknowledged on purpose: the message is redelivered once
+                # its claim expires.
+                logger.error(
+                    "Unexpected error while delivering queued notification",
+                    extra={
+                        "message_id": message.id,
+                        "error_type": type(e).__name__,
+                        "error_message": str(e),
+                    },
+                    exc_info=True,
+                )
+                return False
+            if self.on_delivered is not None:
+                await self._notify(self.on_delivered, message)
+            return True
+
+    async def _notify(
+        self, hook: Callable[[OutboxMessage], Awaitable[None]], message: OutboxMessage
+    ) -> None:
+        # Bookkeeping hooks never decide the fate of a message.
+        try:
+            await hook(message)
+        except Exception as e:
+            logger.error(
+                "Failed to record notification progress",
+                extra={"error_type": type(e).__name__, "error_message": str(e)},
+            )
+
+    async def _handle_failure(self, message: OutboxMessage, error: DeliveryError) -> bool:
+        try:
+            await self.on_failure(message, error)
+        except Exception as e:
+            logger.error(
+                "Failed to reschedule undelivered notification",
+                extra={
+                    "message_id": message.id,
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                },
+                exc_info=True,
+            )
+            return False
+        return True
@@ -0,0 +1,296 @@
+"""Request rate limiting per API key or tenant, shared by every worker through Redis.
+
+Requests are limited with GCRA (the generic cell rate algorithm): a quota of
+``limit`` requests per ``window`` admits one request every ``window / limit``
+seconds, with bursts of up to ``limit`` requests. A bucket's whole state is
+its theoretical arrival time, kept in memory or, with Redis, in one key
+updated by a Lua script.
+
+To spare a Redis round trip on most requests, each worker takes several
+tokens at once and spends them locally for up to ``RATE_LIMIT_LOCAL_SHARE``
+of the window. The number taken adapts to how fast the worker spends them:
+it doubles while batches run out in time and halves when tokens expire
+unused, up to the same share of the quota. Tokens are never handed back, so
+the limit can only be enforced early, by the tokens other workers still
+hold, and never exceeded.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+from litestar.exceptions import TooManyRequestsException
+from litestar.middleware.rate_limit import DURATION_VALUES
+from litestar.types import ASGIApp, Receive, Scope, Send
+from redis.asyncio import Redis
+
+from config import SecuritySettings
+from metrics import RATE_LIMIT_CHECKS
+
+logger = logging.getLogger(__name__)
+
+FORWARDED_FOR_HEADER = b"x-forwarded-for"
+# Buckets whose local tokens are remembered; the least recently used are dropped.
+_LOCAL_BUCKETS = 10_000
+
+
+class RateLimitStore(ABC):
+    """Shared GCRA state of every bucket."""
+
+    @abstractmethod
+    async def acquire(
+        self, bucket: str, interval: float, window: float, count: int
+    ) -> tuple[int, float]:
+        """Take up to ``count`` tokens from ``bucket``.
+
+        A token is emitted every ``interval`` seconds and at most ``window``
+        seconds' worth are available at once. Returns how many were taken,
+        and when none were, the seconds until the next one is emitted.
+        """
+
+
+def _gcra(
+    tat: float, now: float, interval: float, window: float, count: int
+) -> tuple[int, float, float]:
+    """Tokens granted, seconds until the next token, and the new arrival time."""
+    tat = max(tat, now)
+    # The small epsilon absorbs rounding, so a full bucket grants all its tokens.
+    granted = min(count, int((now + window - tat) / interval + 1e-9))
+    if granted < 1:
+        return 0, tat - window + interval - now, tat
+    return granted, 0.0, tat + granted * interval
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Buckets of this process only, for a single worker without Redis."""
+
+    def __init__(self) -> None:
+        self._buckets: OrderedDict[str, float] = OrderedDict()
+
+    async def acquire(
+        self, bucket: str, interval: float, window: float, count: int
+    ) -> tuple[int, float]:
+        now = time.time()
+        granted, retry_after, tat = _gcra(
+            self._buckets.pop(bucket, now), now, interval, window, count
+        )
+        self._buckets[bucket] = tat
+        # Buckets back at their arrival time are full, so forgetting them is exact.
+        while self._buckets:
+            oldest, oldest_tat = next(iter(self._buckets.items()))
+            if oldest_tat > now and len(self._buckets) <= _LOCAL_BUCKETS:
+                break
+            del self._buckets[oldest]
+        return granted, retry_after
+
+
+# Time is read from the Redis server, so that clock skew between workers
+# cannot hand out tokens early or hold them back.
+_ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local granted = math.min(count, math.floor((now + window - tat) / interval + 1e-9))
+if granted < 1 then
+    return {0, tostring(tat - window + interval - now)}
+end
+tat = tat + granted * interval
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000))
+return {granted, '0'}
+"""
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """Buckets in Redis, one key each, expiring once the bucket is full again."""
+
+    def __init__(self, redis: Redis, key_prefix: str) -> None:
+        self.key_prefix = key_prefix
+        self._acquire = redis.register_script(_ACQUIRE_SCRIPT)
+
+    async def acquire(
+        self, bucket: str, interval: float, window: float, count: int
+    ) -> tuple[int, float]:
+        granted, retry_after = await self._acquire(
+            keys=[f"{self.key_prefix}:{bucket}"],
+            args=[repr(interval), repr(window), count],
+        )
+        return int(granted), float(retry_after)
+
+
+@dataclass
+class _LocalTokens:
+    tokens: int = 0
+    expires: float = 0.0
+    batch: int = 1
+    blocked_until: float = 0.0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+@dataclass(frozen=True)
+class Quota:
+    bucket: str
+    limit: int
+
+
+class TrustedProxies:
+    """Finds the client address of a request that came through trusted proxies."""
+
+    def __init__(self, proxies: Iterable[str]) -> None:
+        self.networks = [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+    def trusts(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.networks)
+
+    def client_address(self, scope: Scope) -> str:
+        """The peer address, or the ``X-Forwarded-For`` entry a trusted proxy got the request from.
+
+        Entries are read right to left, as each proxy appends the address it
+        received the request from, up to the first one that is not a trusted
+        proxy. Entries a client sent itself come first, so they are only
+        reached if every proxy after them is trusted.
+        """
+        client = scope.get("client")
+        address = client[0] if client else "unknown"
+        if not self.networks or not self.trusts(address):
+            return address
+        forwarded = ",".join(
+            value.decode("latin-1")
+            for name, value in scope["headers"]
+            if name == FORWARDED_FOR_HEADER
+        )
+        for entry in reversed(forwarded.split(",")):
+            entry = entry.strip()
+            if not entry:
+                continue
+            address = entry
+            if not self.trusts(entry):
+                break
+        return address
+
+
+class RateLimiter:
+    """Applies quotas per API key, per tenant, or per client IP for anonymous requests.
+
+    Used as ASGI middleware after authentication, which leaves the name of
+    the API key in ``scope["auth"]``. A quota of 0 is not limited.
+    """
+
+    def __init__(self, store: RateLimitStore, security: SecuritySettings) -> None:
+        self.store = store
+        self.window = float(DURATION_VALUES[security.rate_limit_window])
+        self.default_limit = security.rate_limit_requests
+        self.max_batch_share = security.rate_limit_local_share
+        # How long tokens taken from the store may be spent locally.
+        self.horizon = self.window * security.rate_limit_local_share
+        self.proxies = TrustedProxies(security.rate_limit_trusted_proxies)
+        self.exclude = (
+            re.compile("|".join(f"(?:{pattern})" for pattern in security.rate_limit_exclude))
+            if security.rate_limit_exclude
+            else None
+        )
+        self.quotas = {
+            name: Quota(
+                f"tenant:{spec.tenant}" if spec.tenant else f"key:{name}",
+                spec.rate_limit if spec.rate_limit is not None else self.default_limit,
+            )
+            for name, spec in security.api_keys.items()
+        }
+        self._local: OrderedDict[str, _LocalTokens] = OrderedDict()
+
+    def quota(self, scope: Scope) -> Quota:
+        key = scope.get("auth")
+        if key is None:
+            return Quota(f"ip:{self.proxies.client_address(scope)}", self.default_limit)
+        return self.quotas.get(key) or Quota(f"key:{key}", self.default_limit)
+
+    def _tokens(self, bucket: str) -> _LocalTokens:
+        local = self._local.get(bucket)
+        if local is None:
+            local = self._local[bucket] = _LocalTokens()
+            if len(self._local) > _LOCAL_BUCKETS:
+                self._local.popitem(last=False)
+        else:
+            self._local.move_to_end(bucket)
+        return local
+
+    async def hit(self, quota: Quota) -> float | None:
+        """Count a request; returns the seconds to wait when it is over the quota."""
+        local = self._tokens(quota.bucket)
+        now = time.monotonic()
+        if local.tokens and now < local.expires:
+            local.tokens -= 1
+            RATE_LIMIT_CHECKS.inc(source="local", result="allowed")
+            return None
+        if now < local.blocked_until:
+            RATE_LIMIT_CHECKS.inc(source="local", result="limited")
+            return local.blocked_until - now
+
+        async with local.lock:
+            # Another request may have refilled the tokens while this one waited.
+            now = time.monotonic()
+            if local.tokens and now < local.expires:
+                local.tokens -= 1
+                RATE_LIMIT_CHECKS.inc(source="local", result="allowed")
+                return None
+            if local.tokens:
+                local.batch = max(local.batch // 2, 1)
+            else:
+                local.batch = min(local.batch * 2, self._max_batch(quota.limit))
+
+            interval = self.window / quota.limit
+            try:
+                granted, retry_after = await self.store.acquire(
+                    quota.bucket, interval, self.window, local.batch
+                )
+            except Exception as e:
+                # Failing open: an unavailable store must not take the API down.
+                logger.error(
+                    "Rate limit store unavailable, request allowed",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+                return None
+            now = time.monotonic()
+            if not granted:
+                local.tokens = 0
+                local.blocked_until = now + retry_after
+                RATE_LIMIT_CHECKS.inc(source="store", result="limited")
+                return retry_after
+            local.tokens = granted - 1
+            local.expires = now + self.horizon
+            RATE_LIMIT_CHECKS.inc(source="store", result="allowed")
+            return None
+
+    def _max_batch(self, limit: int) -> int:
+        return max(int(limit * self.max_batch_share), 1)
+
+    def middleware(self, app: ASGIApp) -> ASGIApp:
+        async def middleware(scope: Scope, receive: Receive, send: Send) -> None:
+            if scope["type"] == "http" and not (
+                self.exclude is not None and self.exclude.search(scope["path"])
+            ):
+                quota = self.quota(scope)
+                retry_after = await self.hit(quota) if quota.limit > 0 else None
+                if retry_after is not None:
+                    raise TooManyRequestsException(
+                        detail="Rate limit exceeded",
+                        headers={"Retry-After": str(max(round(retry_after), 1))},
+                    )
+            await app(scope, receive, send)
+
+        return middleware
@@ -1,41 +1,282 @@
 import logging
+from collections.abc import Awaitable, Callable
+from pathlib import Path
 from typing import Any
 
 from litestar.di import Provide
 from litestar.stores.redis import RedisStore
 from litestar.stores.registry import StoreRegistry
+from redis.asyncio import Redis
 
+from campaigns import CampaignRunner, CampaignStore, MemoryCampaignStore, RedisCampaignStore
 from config import settings
-from sender import EmailSender
+from dead_letters import DeadLetterStore, RedisDeadLetterStore
+from digest import DigestCoalescer
+from idempotency import STORE_NAME as IDEMPOTENCY_STORE
+from idempotency import MemoryIdempotencyStore, RedisIdempotencyStore
+from outbox import MemoryOutbox, Outbox, OutboxMessage, OutboxWorkerPool, RedisStreamOutbox
+from rate_limit import MemoryRateLimitStore, RateLimiter, RateLimitStore, RedisRateLimitStore
+from retry import RetryScheduler
+from scheduler import DeliveryScheduler, MemoryScheduler, RedisScheduler
+from send_limiter import SendLimiter
+from sender import EmailSender, FailedDelivery
+from smtp_pool import SMTPConnectionPool
+from status import MemoryStatusStore, RedisStatusStore, StatusStore
+from transports import FileTransport, HTTPTransport, NullTransport, Transport
 
 logger = logging.getLogger(__name__)
 
 
-def create_stores() -> StoreRegistry:
+def create_redis() -> Redis | None:
     """
-    Create store registry with optional Redis/DragonflyDB support.
-    Falls back to memory store if Redis is unavailable.
+    Create the Redis/DragonflyDB client shared by the stores and the outbox.
+    Returns None when Redis is not configured or the URL is invalid.
     """
-    stores: dict[str, Any] = {}
     if not settings.security.redis_url:
-        return StoreRegistry()
-    
+        return None
+
     try:
-        redis_store = RedisStore.with_client(url=settings.security.redis_url)
-        stores["rate_limit"] = redis_store
-        logger.info(
-            "Rate limiting configured with Redis/DragonflyDB store",
-            extra={"redis_url": settings.security.redis_url.split("@")[-1]},
-        )
+        return Redis.from_url(settings.security.redis_url)
     except Exception as e:
         logger.warning(
             "Failed to connect to Redis/DragonflyDB, falling back to memory store",
             extra={"error": str(e), "error_type": type(e).__name__},
         )
+        return None
+
+
+redis_client = create_redis()
+
+
+def create_stores() -> StoreRegistry:
+    """
+    Create store registry with optional Redis/DragonflyDB support.
+    Falls back to memory store if Redis is unavailable.
+    """
+    stores: dict[str, Any] = {}
+    if redis_client is None:
+        if settings.web_workers > 1:
+            logger.warning(
+                "Running several web workers without REDIS_URL: rate limits, "
+                "idempotency keys, delivery statuses and the queue are kept per worker",
+                extra={"web_workers": settings.web_workers},
+            )
+        return StoreRegistry({IDEMPOTENCY_STORE: MemoryIdempotencyStore()})
+
+    redis_store = RedisStore(redis_client)
+    logger.info(
+        "Stores configured with Redis/DragonflyDB",
+        extra={"redis_url": settings.security.redis_url.split("@")[-1]},
+    )
 
-    return StoreRegistry(stores) if stores else StoreRegistry()
+    # Every named store (dead letters, ...) gets its own namespace.
+    stores[IDEMPOTENCY_STORE] = RedisIdempotencyStore(redis_client).with_namespace(
+        IDEMPOTENCY_STORE
+    )
+    return StoreRegistry(stores, default_factory=redis_store.with_namespace)
+
+
+def create_outbox() -> Outbox:
+    """
+    Create the outbound queue for the configured backend.
+    Falls back to the in-memory outbox if Redis is not available.
+    """
+    # Several web workers must share one queue, whatever the configured backend.
+    if settings.queue.queue_backend == "redis" or settings.web_workers > 1:
+        if redis_client is not None:
+            logger.info("Outbox configured with Redis/DragonflyDB stream")
+            return RedisStreamOutbox(redis_client, settings.queue)
+        logger.warning("Redis outbox not available without REDIS_URL, using memory outbox")
+    return MemoryOutbox(settings.queue)
+
+
+def create_scheduler(outbox: Outbox) -> DeliveryScheduler:
+    """Create the delayed-delivery scheduler matching the outbox backend."""
+    if isinstance(outbox, RedisStreamOutbox):
+        return RedisScheduler(outbox.redis, settings.queue)
+    return MemoryScheduler(outbox, settings.queue)
+
+
+def create_dead_letter_store() -> DeadLetterStore:
+    """Create the dead-letter store, indexed in Redis when it is configured."""
+    store = stores.get("dead_letter")
+    if redis_client is not None:
+        return RedisDeadLetterStore(store, settings.retry, redis_client)
+    return DeadLetterStore(store, settings.retry)
+
+
+def create_campaign_store() -> CampaignStore:
+    """Create the campaign store; campaigns are shared through Redis when it is configured."""
+    if redis_client is not None:
+        return RedisCampaignStore(redis_client, settings.campaign)
+    return MemoryCampaignStore(settings.campaign)
+
+
+def create_status_store() -> StatusStore:
+    """Create the delivery status store; records are shared through Redis when it is configured."""
+    if redis_client is not None:
+        return RedisStatusStore(redis_client, settings.status)
+    return MemoryStatusStore(settings.status)
+
+
+def create_rate_limiter() -> RateLimiter:
+    """Create the request rate limiter, sharing quotas through Redis when it is configured."""
+    if redis_client is not None:
+        store: RateLimitStore = RedisRateLimitStore(
+            redis_client, settings.security.rate_limit_key_prefix
+        )
+    else:
+        store = MemoryRateLimitStore()
+    return RateLimiter(store, settings.security)
+
+
+def create_transport() -> Transport:
+    """Create the transport messages are delivered through."""
+    backend = settings.transport.transport_backend
+    if backend == "http":
+        logger.info(
+            "Delivering through HTTP provider API",
+            extra={"url": settings.transport.transport_http_url},
+        )
+        return HTTPTransport(settings.transport)
+    if backend == "file":
+        return FileTransport(
+            Path(settings.transport.transport_file_path),
+            settings.transport.transport_file_format,
+        )
+    if backend == "null":
+        logger.warning("Null transport configured, messages are discarded")
+        return NullTransport()
+    return smtp_pool
+
+
+async def close_redis() -> None:
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+stores = create_stores()
+rate_limiter = create_rate_limiter()
+send_limiter = SendLimiter(settings.smtp)
+smtp_pool = SMTPConnectionPool(settings.smtp, send_limiter)
+transport = create_transport()
+email_sender = EmailSender(transport)
+outbox = create_outbox()
+scheduler = create_scheduler(outbox)
+dead_letters = create_dead_letter_store()
+campaigns = create_campaign_store()
+campaign_runner = CampaignRunner(campaigns, outbox, settings.queue, settings.campaign)
+statuses = create_status_store()
+
+
+async def on_delivered(message: OutboxMessage) -> None:
+    await statuses.delivered(message)
+    await campaigns.delivered(message)
+
+
+async def on_dead_letter(message: OutboxMessage, failures: list[FailedDelivery]) -> None:
+    await statuses.dead_lettered(message, failures)
+    await campaigns.dead_lettered(message, failures)
+
+
+retries = RetryScheduler(
+    scheduler,
+    dead_letters,
+    settings.retry,
+    on_dead_letter=on_dead_letter,
+    on_retry=statuses.retrying,
+)
+
+
+async def deliver_digest(message: OutboxMessage) -> bool:
+    # Digests go through the pool for its hooks and retries; looked up late, as
+    # the pool is created after the coalescer.
+    return await worker_pool.deliver(message)
+
+
+coalescer = DigestCoalescer(
+    settings.digest,
+    settings.queue,
+    outbox,
+    deliver=deliver_digest,
+    on_hold=statuses.coalesced,
+)
+worker_pool = OutboxWorkerPool(
+    outbox,
+    email_sender,
+    settings.queue,
+    on_failure=retries.handle_failure,
+    on_delivered=on_delivered,
+    on_sending=statuses.sending,
+    coalesce=coalescer.hold,
+)
+
+
+def provide_outbox() -> Outbox:
+    return outbox
+
+
+def provide_dead_letters() -> DeadLetterStore:
+    return dead_letters
+
+
+def provide_scheduler() -> DeliveryScheduler:
+    return scheduler
+
+
+def provide_campaigns() -> CampaignStore:
+    return campaigns
+
+
+def provide_campaign_runner() -> CampaignRunner:
+    return campaign_runner
+
+
+def provide_statuses() -> StatusStore:
+    return statuses
+
+
+def provide_smtp_pool() -> SMTPConnectionPool:
+    return smtp_pool
+
+
+def provide_send_limiter() -> SendLimiter:
+    return send_limiter
 
 
 DEPENDENCIES: dict[str, Provide] = {
-    "email_sender": Provide(EmailSender, sync_to_thread=False),
+    "outbox": Provide(provide_outbox, sync_to_thread=False),
+    "dead_letters": Provide(provide_dead_letters, sync_to_thread=False),
+    "scheduler": Provide(provide_scheduler, sync_to_thread=False),
+    "campaigns": Provide(provide_campaigns, sync_to_thread=False),
+    "campaign_runner": Provide(provide_campaign_runner, sync_to_thread=False),
+    "statuses": Provide(provide_statuses, sync_to_thread=False),
+    "smtp_pool": Provide(provide_smtp_pool, sync_to_thread=False),
+    "send_limiter": Provide(provide_send_limiter, sync_to_thread=False),
 }
+
+# What a process that drains the outbox starts on top of ON_STARTUP.
+CONSUMER_STARTUP: list[Callable[[], Awaitable[None]]] = [worker_pool.start, scheduler.start]
+
+ON_STARTUP: list[Callable[[], Awaitable[None]]] = [
+    email_sender.start,
+    transport.start,
+    outbox.start,
+    campaigns.start,
+    statuses.start,
+]
+if settings.queue.queue_consume:
+    ON_STARTUP.extend(CONSUMER_STARTUP)
+
+ON_SHUTDOWN: list[Callable[[], Awaitable[None]]] = [
+    campaign_runner.close,
+    scheduler.close,
+    worker_pool.close,
+    coalescer.close,
+    campaigns.close,
+    statuses.close,
+    outbox.close,
+    email_sender.close,
+    transport.close,
+    close_redis,
+]
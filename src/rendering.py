@@ -0,0 +1,257 @@
+"""Message rendering: templates and MIME assembly, serialized to wire bytes.
+
+Only the text and HTML parts are built with :mod:`email` for each message;
+the headers are folded directly and inline images are copied in from parts
+serialized once by :class:`assets.StaticAssetCache`, so a message is
+assembled from byte segments joined once.
+
+Rendering is CPU-bound, so :class:`RenderExecutor` can run it in a thread or
+process pool and keep the event loop free for I/O, and keeps recently
+rendered messages in a :class:`RenderCache` so identical ones are not
+rendered again.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import sys
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from email.message import Message
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Any, Literal
+
+from assets import STATIC_DIR, StaticAssetCache
+from config import settings
+from metrics import RENDER_CACHE_BYTES, RENDER_CACHE_LOOKUPS, STAGE_SECONDS
+from templating import TemplateRegistry, create_environment
+
+
+@dataclass(frozen=True)
+class RenderJob:
+    """Everything needed to render one message; plain data so it can cross processes."""
+
+    template: str
+    subject: str
+    preview_text: str | None
+    variables: dict[str, Any]
+    to: list[str]
+    cc: list[str]
+
+
+class MessageRenderer:
+    """Renders a :class:`RenderJob` to the bytes handed to ``sendmail``."""
+
+    def __init__(self, templates: TemplateRegistry, assets: StaticAssetCache) -> None:
+        self.templates = templates
+        self.assets = assets
+
+    @classmethod
+    def create(cls) -> "MessageRenderer":
+        return cls(
+            TemplateRegistry(create_environment()),
+            StaticAssetCache(
+                STATIC_DIR,
+                settings.inline_assets,
+                settings.inline_assets_reload_interval,
+            ),
+        )
+
+    def load(self) -> None:
+        """Compile every template; a no-op once they are loaded."""
+        if not self.templates.names:
+            self.templates.load()
+
+    def render(self, job: RenderJob) -> bytes:
+        with STAGE_SECONDS.time(stage="render"):
+            html_body = self.templates.render(job.template, self._template_variables(job))
+            text_body = job.preview_text or job.variables.get("body") or ""
+
+        with STAGE_SECONDS.time(stage="mime_build"):
+            # Only the headers of the multipart/related container are built;
+            # its parts are framed below as the email generator would.
+            boundary = _make_boundary()
+            message = MIMEMultipart("related", boundary=boundary)
+            message["From"] = settings.email_sender
+            if job.to:
+                message["To"] = ", ".join(job.to)
+            if job.cc:
+                message["Cc"] = ", ".join(job.cc)
+            message["Subject"] = job.subject
+
+            message_alternative = MIMEMultipart("alternative")
+            message_alternative.attach(MIMEText(text_body, "plain", "utf-8"))
+            message_alternative.attach(MIMEText(html_body, "html", "utf-8"))
+
+            delimiter = f"\n--{boundary}\n".encode()
+            segments = [_headers(message), delimiter[1:], message_alternative.as_bytes()]
+            for asset in self.assets.referenced_by(html_body):
+                segments += (delimiter, asset.encoded)
+            segments.append(f"\n--{boundary}--\n".encode())
+            return b"".join(segments)
+
+    def cache_key(self, job: RenderJob) -> str | None:
+        """Digest of everything that shapes the bytes of ``job``'s message.
+
+        Returns None in debug mode, where templates can change on disk at
+        any time, so rendered messages are not reused.
+        """
+        if self.templates.env.auto_reload:
+            return None
+        content = json.dumps(
+            [
+                self.templates.version,
+                self.assets.version(),
+                settings.email_sender,
+                job.template,
+                job.subject,
+                job.preview_text,
+                job.variables,
+                job.to,
+                job.cc,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _template_variables(self, job: RenderJob) -> dict[str, Any]:
+        template_vars = dict(job.variables)
+        template_vars["subject"] = job.subject
+        if job.preview_text:
+            template_vars["preview_text"] = job.preview_text
+        return {k: v if v is not None else "" for k, v in template_vars.items()}
+
+
+def _make_boundary() -> str:
+    # Same shape as the email generator's boundaries. Every part is base64
+    # encoded, so no line of the content can start with the boundary.
+    return f"{'=' * 15}{random.randrange(sys.maxsize):019d}=="
+
+
+def _headers(message: Message) -> bytes:
+    """The header block of ``message``, folded and encoded as the email generator does."""
+    policy = message.policy
+    return (
+        b"".join(policy.fold_binary(name, value) for name, value in message.raw_items())
+        + policy.linesep.encode()
+    )
+
+
+class RenderCache:
+    """Rendered messages by content digest, least recently used evicted first.
+
+    Bounded by the total size of the cached messages rather than their
+    count, since one message with inline images can weigh as much as
+    hundreds without. Messages larger than the whole cache are not kept.
+    Used from the event loop only.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._messages: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, key: str) -> bytes | None:
+        message = self._messages.get(key)
+        if message is not None:
+            self._messages.move_to_end(key)
+        return message
+
+    def put(self, key: str, message: bytes) -> None:
+        if len(message) > self.max_bytes or key in self._messages:
+            return
+        self._messages[key] = message
+        self.size += len(message)
+        while self.size > self.max_bytes:
+            _, evicted = self._messages.popitem(last=False)
+            self.size -= len(evicted)
+        RENDER_CACHE_BYTES.set(self.size)
+
+
+# Renderer of a render pool process, created by the pool initializer.
+_process_renderer: MessageRenderer | None = None
+
+
+def _init_process() -> None:
+    global _process_renderer
+    _process_renderer = MessageRenderer.create()
+    _process_renderer.load()
+
+
+def _render_in_process(job: RenderJob) -> bytes:
+    assert _process_renderer is not None
+    return _process_renderer.render(job)
+
+
+class RenderExecutor:
+    """Runs :meth:`MessageRenderer.render` inline, in threads or in processes.
+
+    ``thread`` keeps the event loop responsive while a large message is
+    rendered; ``process`` also spreads rendering over several cores, at the
+    cost of pickling each job and its bytes. Stage metrics recorded inside
+    pool processes are not visible in this process.
+
+    With a ``cache``, a job identical to a recently rendered one is answered
+    from it without rendering at all, and identical jobs arriving while one
+    is being rendered wait for its result.
+    """
+
+    def __init__(
+        self,
+        renderer: MessageRenderer,
+        mode: Literal["inline", "thread", "process"],
+        workers: int,
+        cache: RenderCache | None = None,
+    ) -> None:
+        self.renderer = renderer
+        self.mode = mode
+        self.workers = workers
+        self.cache = cache
+        self._executor: Executor | None = None
+        self._rendering: dict[str, asyncio.Future[bytes]] = {}
+
+    def start(self) -> None:
+        if self.mode == "thread":
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+        elif self.mode == "process":
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_init_process)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, job: RenderJob) -> bytes:
+        cache = self.cache
+        key = self.renderer.cache_key(job) if cache is not None else None
+        if cache is None or key is None:
+            return await self._render(job)
+
+        if (message := cache.get(key)) is not None:
+            RENDER_CACHE_LOOKUPS.inc(result="hit")
+            return message
+        if (rendering := self._rendering.get(key)) is not None:
+            RENDER_CACHE_LOOKUPS.inc(result="hit")
+            return await asyncio.shield(rendering)
+        RENDER_CACHE_LOOKUPS.inc(result="miss")
+
+        rendering = self._rendering[key] = asyncio.ensure_future(self._render(job))
+        try:
+            message = await asyncio.shield(rendering)
+        finally:
+            if rendering.done():
+                del self._rendering[key]
+            else:
+                rendering.add_done_callback(lambda _: self._rendering.pop(key, None))
+        cache.put(key, message)
+        return message
+
+    async def _render(self, job: RenderJob) -> bytes:
+        if self._executor is None:
+            return self.renderer.render(job)
+        fn = _render_in_process if self.mode == "process" else self.renderer.render
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, job)
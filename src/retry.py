@@ -0,0 +1,156 @@
+"""Retry scheduling for failed deliveries, with exponential backoff and a dead-letter fallback."""
+
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+
+from aiosmtplib import (
+    SMTPConnectError,
+    SMTPResponseException,
+    SMTPServerDisconnected,
+    SMTPTimeoutError,
+)
+
+from config import RetrySettings
+from dead_letters import DeadLetterStore
+from metrics import DEAD_LETTERS, RETRIES
+from outbox import OutboxMessage
+from scheduler import DeliveryScheduler
+from schemas import EmailInput
+from sender import DeliveryError, FailedDelivery
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a delivery error is worth retrying.
+
+    SMTP replies are classified by code (4xx transient, 5xx permanent), and
+    connection-level failures are transient. Anything else, such as a
+    template error, would fail the same way again.
+    """
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.code < 500
+    return isinstance(
+        error,
+        (SMTPServerDisconnected, SMTPConnectError, SMTPTimeoutError, OSError, TimeoutError),
+    )
+
+
+def payload_for(payload: EmailInput, recipients: set[str]) -> EmailInput:
+    """Copy of ``payload`` addressed only to ``recipients``."""
+    if not (payload.to or payload.cc or payload.bcc):
+        # Sent to the configured default recipient, nothing to narrow down.
+        return payload
+    return payload.model_copy(
+        update={
+            "to": [r for r in payload.to if r in recipients],
+            "cc": [r for r in payload.cc if r in recipients],
+            "bcc": [r for r in payload.bcc if r in recipients],
+            "recipient_variables": {
+                r: v for r, v in payload.recipient_variables.items() if r in recipients
+            },
+        }
+    )
+
+
+def _describe(failures: list[FailedDelivery]) -> str:
+    return "; ".join(f"{type(f.error).__name__}: {f.error}" for f in failures)
+
+
+class RetryScheduler:
+    """Reschedules the transiently failed part of a notification, dead-letters the rest.
+
+    Retries are handed to the :class:`DeliveryScheduler` with a due time, so a
+    worker never sleeps on a failing relay. Rescheduled messages are passed
+    to ``on_retry`` with their due time, and dead-lettered ones to
+    ``on_dead_letter``, each with the failures that caused it, if given.
+    """
+
+    def __init__(
+        self,
+        scheduler: DeliveryScheduler,
+        dead_letters: DeadLetterStore,
+        retry_settings: RetrySettings,
+        on_dead_letter: (
+            Callable[[OutboxMessage, list[FailedDelivery]], Awaitable[None]] | None
+        ) = None,
+        on_retry: (
+            Callable[[OutboxMessage, float, list[FailedDelivery]], Awaitable[None]] | None
+        ) = None,
+    ) -> None:
+        self.scheduler = scheduler
+        self.dead_letters = dead_letters
+        self.settings = retry_settings
+        self.on_dead_letter = on_dead_letter
+        self.on_retry = on_retry
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retry number ``attempt`` (1-based)."""
+        delay = min(
+            self.settings.retry_base_delay * 2 ** (attempt - 1),
+            self.settings.retry_max_delay,
+        )
+        jitter = self.settings.retry_jitter
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    async def handle_failure(self, message: OutboxMessage, error: DeliveryError) -> None:
+        transient = [f for f in error.failures if is_transient(f.error)]
+        permanent = [f for f in error.failures if not is_transient(f.error)]
+        attempt = message.attempt + 1
+
+        if permanent:
+            await self._dead_letter(message, permanent, "permanent_failure")
+
+        if not transient:
+            return
+        if attempt >= self.settings.retry_max_attempts:
+            await self._dead_letter(message, transient, "retries_exhausted")
+            return
+
+        retry = OutboxMessage(
+            payload=payload_for(message.payload, {r for f in transient for r in f.recipients}),
+            id=message.id,
+            attempt=attempt,
+            request_id=message.request_id,
+            campaign_id=message.campaign_id,
+            members=message.members,
+        )
+        delay = self.backoff(attempt)
+        due = time.time() + delay
+        await self.scheduler.schedule(retry, due)
+        RETRIES.inc()
+        if self.on_retry is not None:
+            await self.on_retry(retry, due, transient)
+        logger.info(
+            "Delivery failed temporarily, retry scheduled",
+            extra={
+                "message_id": message.id,
+                "attempt": attempt,
+                "delay": round(delay, 1),
+                "error": _describe(transient),
+            },
+        )
+
+    async def _dead_letter(
+        self, message: OutboxMessage, failures: list[FailedDelivery], reason: str
+    ) -> None:
+        entry = await self.dead_letters.add(
+            message_id=message.id,
+            payload=payload_for(message.payload, {r for f in failures for r in f.recipients}),
+            attempts=message.attempt + 1,
+            reason=reason,
+            error=_describe(failures),
+        )
+        DEAD_LETTERS.inc(reason=reason)
+        if self.on_dead_letter is not None:
+            await self.on_dead_letter(message, failures)
+        logger.warning(
+            "Notification moved to dead-letter store",
+            extra={
+                "message_id": message.id,
+                "dead_letter_id": entry.id,
+                "reason": reason,
+            },
+        )
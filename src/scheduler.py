@@ -0,0 +1,238 @@
+"""Delayed delivery: holds queued notifications until they are due, then releases them to the outbox."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import suppress
+
+from redis.asyncio import Redis
+
+from config import QueueSettings
+from outbox import Outbox, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryScheduler(ABC):
+    """Holds messages until a wall-clock due time.
+
+    :meth:`schedule` may be called from any process; the release loop started
+    by :meth:`start` only needs to run where the outbox is consumed.
+    """
+
+    def __init__(self, queue_settings: QueueSettings) -> None:
+        self.settings = queue_settings
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="delivery-scheduler")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    @abstractmethod
+    async def schedule(self, message: OutboxMessage, due: float) -> None:
+        """Hold ``message`` until the UNIX timestamp ``due``.
+
+        Scheduling a message id that is already held replaces it.
+        """
+
+    async def schedule_many(self, entries: list[tuple[OutboxMessage, float]]) -> None:
+        """Hold several ``(message, due)`` pairs."""
+        for message, due in entries:
+            await self.schedule(message, due)
+
+    @abstractmethod
+    async def cancel(self, message_id: str) -> bool:
+        """Drop a held message; returns whether it was still waiting."""
+
+    @abstractmethod
+    async def pending(self) -> int:
+        """Number of messages waiting for their due time."""
+
+    @abstractmethod
+    async def release_due(self) -> int:
+        """Move up to one batch of due messages to the outbox; returns how many moved."""
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                released = await self.release_due()
+            except Exception as e:
+                logger.error(
+                    "Failed to release scheduled notifications",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+                released = 0
+            # Keep draining without sleeping while full batches are due.
+            if released < self.settings.queue_scheduler_batch_size:
+                await self._wait()
+
+    async def _wait(self) -> None:
+        await asyncio.sleep(self.settings.queue_scheduler_poll_interval)
+
+
+class MemoryScheduler(DeliveryScheduler):
+    """In-process heap of scheduled messages, for use with :class:`MemoryOutbox`.
+
+    Cancelled or replaced messages leave a stale heap entry behind that is
+    skipped when it surfaces; the heap is rebuilt once most entries are stale.
+    Its contents do not survive a restart.
+    """
+
+    def __init__(self, outbox: Outbox, queue_settings: QueueSettings) -> None:
+        super().__init__(queue_settings)
+        self.outbox = outbox
+        self._heap: list[tuple[float, int, str]] = []
+        self._entries: dict[str, tuple[float, int, OutboxMessage]] = {}
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+        # Set when due messages were left behind because the outbox was full.
+        self._backlogged = False
+
+    async def close(self) -> None:
+        await super().close()
+        if self._entries:
+            logger.warning(
+                "Discarding scheduled notifications from memory scheduler",
+                extra={"pending": len(self._entries)},
+            )
+
+    async def schedule(self, message: OutboxMessage, due: float) -> None:
+        self._push(due, next(self._sequence), message)
+        if self._heap[0][2] == message.id:
+            self._changed.set()
+
+    async def cancel(self, message_id: str) -> bool:
+        if self._entries.pop(message_id, None) is None:
+            return False
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [
+                (due, sequence, message_id)
+                for message_id, (due, sequence, _) in self._entries.items()
+            ]
+            heapq.heapify(self._heap)
+        return True
+
+    async def pending(self) -> int:
+        return len(self._entries)
+
+    async def release_due(self) -> int:
+        now = time.time()
+        batch: list[tuple[float, int, OutboxMessage]] = []
+        while (
+            self._heap
+            and self._heap[0][0] <= now
+            and len(batch) < self.settings.queue_scheduler_batch_size
+        ):
+            _, sequence, message_id = heapq.heappop(self._heap)
+            entry = self._entries.get(message_id)
+            if entry is not None and entry[1] == sequence:
+                batch.append(self._entries.pop(message_id))
+
+        accepted = await self.outbox.enqueue_many([entry[2] for entry in batch])
+        # Whatever did not fit stays scheduled and is retried on the next tick.
+        for due, sequence, message in batch[accepted:]:
+            self._push(due, sequence, message)
+        self._backlogged = accepted < len(batch)
+        return accepted
+
+    def _push(self, due: float, sequence: int, message: OutboxMessage) -> None:
+        self._entries[message.id] = (due, sequence, message)
+        heapq.heappush(self._heap, (due, sequence, message.id))
+
+    async def _wait(self) -> None:
+        """Sleep until the earliest due time, or until an earlier message arrives.
+
+        While the outbox is full, due messages are only retried every poll
+        interval rather than immediately.
+        """
+        self._changed.clear()
+        timeout = self.settings.queue_scheduler_poll_interval
+        if self._heap and not self._backlogged:
+            timeout = min(timeout, max(self._heap[0][0] - time.time(), 0))
+        with suppress(TimeoutError):
+            await asyncio.wait_for(self._changed.wait(), timeout)
+
+
+# Atomically pops due ids from the schedule and appends their messages to the
+# outbox stream, so a crash can never lose or duplicate a released message.
+# Members scheduled before messages were kept in the hash are the message itself.
+# Only as many as the stream has room for under QUEUE_MAX_SIZE are released; the
+# rest stay scheduled until a later tick.
+_RELEASE_DUE_SCRIPT = """
+local count = math.min(tonumber(ARGV[2]), tonumber(ARGV[3]) - redis.call('XLEN', KEYS[2]))
+if count <= 0 then
+    return 0
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, count)
+for _, member in ipairs(due) do
+    local data = redis.call('HGET', KEYS[3], member) or member
+    redis.call('XADD', KEYS[2], '*', 'data', data)
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('HDEL', KEYS[3], member)
+end
+return #due
+"""
+
+_CANCEL_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+class RedisScheduler(DeliveryScheduler):
+    """Schedule kept in Redis, for :class:`RedisStreamOutbox`.
+
+    A sorted set of message ids scored by due time orders the schedule, and a
+    hash holds each message by id, so that a message can be cancelled without
+    scanning the set. Both survive restarts of the service.
+    """
+
+    def __init__(self, redis: Redis, queue_settings: QueueSettings) -> None:
+        super().__init__(queue_settings)
+        self.redis = redis
+        self.key = queue_settings.queue_schedule_key
+        self.messages_key = f"{self.key}:messages"
+        self._release_due = redis.register_script(_RELEASE_DUE_SCRIPT)
+        self._cancel = redis.register_script(_CANCEL_SCRIPT)
+
+    async def schedule(self, message: OutboxMessage, due: float) -> None:
+        await self.schedule_many([(message, due)])
+
+    async def schedule_many(self, entries: list[tuple[OutboxMessage, float]]) -> None:
+        if not entries:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self.messages_key,
+                mapping={message.id: message.dumps() for message, _ in entries},
+            )
+            pipe.zadd(self.key, {message.id: due for message, due in entries})
+            await pipe.execute()
+
+    async def cancel(self, message_id: str) -> bool:
+        return bool(await self._cancel(keys=[self.key, self.messages_key], args=[message_id]))
+
+    async def pending(self) -> int:
+        return await self.redis.zcard(self.key)
+
+    async def release_due(self) -> int:
+        return await self._release_due(
+            keys=[self.key, self.settings.queue_stream, self.messages_key],
+            args=[
+                time.time(),
+                self.settings.queue_scheduler_batch_size,
+                self.settings.queue_max_size,
+            ],
+        )
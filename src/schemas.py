@@ -1,12 +1,114 @@
-from pydantic import BaseModel, ConfigDict, Field, field_validator
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Literal, Self
+
+from pydantic import (
+    AwareDatetime,
+    BaseModel,
+    ConfigDict,
+    EmailStr,
+    Field,
+    ModelWrapValidatorHandler,
+    SerializeAsAny,
+    ValidationInfo,
+    create_model,
+    field_validator,
+    model_validator,
+)
 from pydantic.alias_generators import to_camel
 import bleach
 
+from config import settings
+from metrics import STAGE_SECONDS
+
+
+# Anything bleach would do more to than escape ``>``: markup, character
+# references, and the control characters html5lib drops or replaces.
+_NEEDS_PARSING = re.compile(r"[<&\x00-\x08\x0b-\x1f]")
+
+
+def _bleach_clean(value: str) -> str:
+    with STAGE_SECONDS.time(stage="sanitize"):
+        return bleach.clean(value, tags=[], strip=True)
+
+
+# Short values (badges, labels, footers) repeat across requests.
+_bleach_clean_cached = lru_cache(maxsize=settings.sanitize_cache_size)(_bleach_clean)
+
+
+def strip_html(value: str) -> str:
+    """Strip all HTML tags and attributes to prevent XSS.
+
+    Same output as ``bleach.clean(value, tags=[], strip=True)``. Plain text
+    skips the HTML parser, and only values that need parsing are timed as
+    the ``sanitize`` stage.
+    """
+    if not _NEEDS_PARSING.search(value):
+        return value.replace(">", "&gt;")
+    if len(value) <= settings.sanitize_cache_max_length:
+        return _bleach_clean_cached(value)
+    return _bleach_clean(value)
+
 
 class CamelModel(BaseModel):
     model_config = ConfigDict(alias_generator=to_camel, populate_by_name=True)
 
 
+class TemplateVariables(CamelModel):
+    """Base for variable models declared by ``<template>.schema.json`` files."""
+
+    @field_validator("*")
+    @classmethod
+    def sanitize_html(cls, v: Any) -> Any:
+        """Sanitize HTML to prevent XSS attacks in email content."""
+        if not isinstance(v, str):
+            return v
+        return strip_html(v)
+
+
+_JSON_SCHEMA_TYPES: dict[str, type] = {
+    "string": str,
+    "integer": int,
+    "number": float,
+    "boolean": bool,
+}
+
+
+def template_variables_model(
+    template: str, schema: dict[str, Any]
+) -> type[TemplateVariables]:
+    """Build a variables model from a JSON Schema object with flat scalar properties.
+
+    Supported keywords are ``type``, ``description``, ``default``,
+    ``minLength`` and ``maxLength`` on each property, plus ``required``.
+    """
+    required = set(schema.get("required", []))
+    fields: dict[str, Any] = {}
+    for name, spec in schema.get("properties", {}).items():
+        annotation: Any = _JSON_SCHEMA_TYPES[spec.get("type", "string")]
+        if name in required:
+            default = ...
+        else:
+            default = spec.get("default")
+            if default is None:
+                annotation = annotation | None
+        fields[name] = (
+            annotation,
+            Field(
+                default,
+                description=spec.get("description"),
+                min_length=spec.get("minLength"),
+                max_length=spec.get("maxLength"),
+            ),
+        )
+    model_name = "".join(part.title() for part in template.split("_"))
+    return create_model(
+        f"{model_name}TemplateVariables", __base__=TemplateVariables, **fields
+    )
+
+
 class NotificationTemplateVariables(CamelModel):
     """Variables for the notification email template."""
 
@@ -25,6 +127,7 @@ class NotificationTemplateVariables(CamelModel):
             "We've detected unusual activity on your account.",
         ],
         min_length=1,
+        max_length=settings.notification_body_max_length,
     )
     badge: str = Field(
         default="Notification",
@@ -59,8 +162,43 @@ class NotificationTemplateVariables(CamelModel):
         """Sanitize HTML to prevent XSS attacks in email content."""
         if v is None:
             return v
-        # Strip all HTML tags and attributes to prevent XSS
-        return bleach.clean(v, tags=[], strip=True)
+        return strip_html(v)
+
+
+class DigestItem(CamelModel):
+    """One of the notifications merged into a digest."""
+
+    subject: str
+    headline: str | None = None
+    body: str | None = None
+    action_url: str | None = None
+    action_label: str | None = None
+
+    @field_validator("subject", "headline", "body", "action_label")
+    @classmethod
+    def sanitize_html(cls, v: str | None) -> str | None:
+        """Sanitize HTML to prevent XSS attacks in email content."""
+        if v is None:
+            return v
+        return strip_html(v)
+
+
+class DigestTemplateVariables(TemplateVariables):
+    """Variables of the ``digest`` template, which lists several notifications in one email."""
+
+    headline: str = Field(..., max_length=200)
+    body: str = Field(..., description="Summary line, also used as the plain-text part")
+    badge: str | None = Field(default="Digest", max_length=50)
+    items: list[DigestItem] = Field(..., min_length=1)
+
+
+# Variable model of every selectable template, keyed by template name. Built-in
+# models are declared here; the template registry adds the ones loaded from
+# ``<template>.schema.json`` files at startup.
+template_variable_models: dict[str, type[CamelModel]] = {
+    "notification": NotificationTemplateVariables,
+    "digest": DigestTemplateVariables,
+}
 
 
 class EmailInput(CamelModel):
@@ -73,9 +211,20 @@ class EmailInput(CamelModel):
         min_length=1,
         max_length=200,
     )
-    template_variables: NotificationTemplateVariables = Field(
+    template: str = Field(
+        default="notification",
+        description="Name of the template in `src/templates` to render, without the `.html` extension",
+        examples=["notification"],
+    )
+    template_variables: SerializeAsAny[
+        NotificationTemplateVariables | TemplateVariables
+    ] = Field(
         ...,
-        description="Variables to populate the notification template",
+        description=(
+            "Variables to populate the selected template. "
+            "The default `notification` template accepts the fields below; "
+            "other templates declare theirs in `<template>.schema.json`."
+        ),
     )
     preview_text: str | None = Field(
         default=None,
@@ -83,6 +232,45 @@ class EmailInput(CamelModel):
         examples=["Your account has been verified successfully"],
         max_length=200,
     )
+    to: list[EmailStr] = Field(
+        default_factory=list,
+        description="Primary recipients. Defaults to the configured EMAIL_RECIPIENT when no recipient is given",
+        examples=[["jane@example.com", "john@example.com"]],
+    )
+    cc: list[EmailStr] = Field(
+        default_factory=list,
+        description="Carbon-copy recipients",
+    )
+    bcc: list[EmailStr] = Field(
+        default_factory=list,
+        description="Blind carbon-copy recipients, delivered without appearing in the headers",
+    )
+    recipient_variables: dict[
+        EmailStr, SerializeAsAny[NotificationTemplateVariables | TemplateVariables]
+    ] = Field(
+        default_factory=dict,
+        description=(
+            "Per-recipient overrides of the template variables, keyed by a recipient from "
+            "`to`, `cc` or `bcc`. Each listed recipient receives an individually rendered email "
+            "addressed only to them; all other recipients share a single email."
+        ),
+        examples=[{"jane@example.com": {"headline": "Welcome, Jane!"}}],
+    )
+    send_at: AwareDatetime | None = Field(
+        default=None,
+        description=(
+            "Deliver at this time instead of immediately. "
+            "ISO 8601 with a timezone; a time in the past sends immediately"
+        ),
+        examples=["2030-01-15T09:00:00Z"],
+    )
+    delay_seconds: float | None = Field(
+        default=None,
+        description="Deliver this many seconds after the request instead of immediately",
+        examples=[3600],
+        ge=0,
+        le=settings.queue.queue_schedule_max_delay,
+    )
 
     @field_validator("subject", "preview_text")
     @classmethod
@@ -90,12 +278,301 @@ class EmailInput(CamelModel):
         """Sanitize HTML to prevent XSS attacks in email content."""
         if v is None:
             return v
-        # Strip all HTML tags and attributes to prevent XSS
-        return bleach.clean(v, tags=[], strip=True)
+        return strip_html(v)
+
+    @field_validator("template")
+    @classmethod
+    def check_template(cls, v: str) -> str:
+        if v not in template_variable_models:
+            raise ValueError(
+                f"Unknown template '{v}', expected one of: "
+                + ", ".join(sorted(template_variable_models))
+            )
+        return v
+
+    @field_validator("template_variables", mode="before")
+    @classmethod
+    def validate_template_variables(cls, v: Any, info: ValidationInfo) -> Any:
+        """Validate the variables against the schema of the selected template."""
+        template = info.data.get("template")
+        if template is None:
+            raise ValueError("Cannot validate variables of an unknown template")
+        model = template_variable_models[template]
+        if isinstance(v, model):
+            return v
+        return model.model_validate(v)
+
+    @field_validator("recipient_variables", mode="before")
+    @classmethod
+    def merge_recipient_variables(cls, v: Any, info: ValidationInfo) -> Any:
+        """Apply each recipient's overrides on top of the shared variables and validate them."""
+        if not v or not isinstance(v, dict):
+            return v
+        base = info.data.get("template_variables")
+        if base is None:
+            raise ValueError("Cannot validate recipient variables without valid template variables")
+        model = type(base)
+        shared = base.model_dump(by_alias=True)
+        merged = {}
+        for recipient, overrides in v.items():
+            if isinstance(overrides, model):
+                merged[recipient] = overrides
+                continue
+            if not isinstance(overrides, dict):
+                raise ValueError(f"Variables for recipient '{recipient}' must be an object")
+            merged[recipient] = model.model_validate(
+                {**shared, **{to_camel(k): value for k, value in overrides.items()}}
+            )
+        return merged
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def timed(cls, data: Any, handler: ModelWrapValidatorHandler[Self]) -> Self:
+        with STAGE_SECONDS.time(stage="validation"):
+            return handler(data)
+
+    @model_validator(mode="after")
+    def check_recipients(self) -> "EmailInput":
+        total = len(self.to) + len(self.cc) + len(self.bcc)
+        if total > settings.max_recipients:
+            raise ValueError(
+                f"Too many recipients: {total}, the maximum is {settings.max_recipients}"
+            )
+        unknown = set(self.recipient_variables) - {*self.to, *self.cc, *self.bcc}
+        if unknown:
+            raise ValueError(
+                "recipientVariables contains addresses that are not recipients: "
+                + ", ".join(sorted(unknown))
+            )
+        return self
+
+    @model_validator(mode="after")
+    def check_schedule(self) -> "EmailInput":
+        if self.send_at is not None and self.delay_seconds is not None:
+            raise ValueError("Use either sendAt or delaySeconds, not both")
+        if (
+            self.send_at is not None
+            and self.send_at.timestamp() - time.time()
+            > settings.queue.queue_schedule_max_delay
+        ):
+            raise ValueError(
+                "sendAt is too far in the future, the maximum delay is "
+                f"{settings.queue.queue_schedule_max_delay:.0f} seconds"
+            )
+        return self
+
+    def due(self, accepted_at: float) -> float | None:
+        """UNIX time at which to deliver a notification accepted at ``accepted_at``.
+
+        ``None`` when it should be sent right away.
+        """
+        if self.send_at is not None:
+            due = self.send_at.timestamp()
+        elif self.delay_seconds:
+            due = accepted_at + self.delay_seconds
+        else:
+            return None
+        return due if due > accepted_at else None
 
 
 class SuccessResponse(CamelModel):
     message: str
+    id: str | None = Field(default=None, description="Message id of the queued notification")
+
+
+class BatchItemResult(CamelModel):
+    """Outcome of a single item in a batch request."""
+
+    index: int = Field(..., description="Position of the item in the submitted batch")
+    status: Literal["accepted", "rejected"]
+    id: str | None = Field(
+        default=None, description="Message id assigned to an accepted item"
+    )
+    errors: list[dict[str, Any]] | None = Field(
+        default=None, description="Validation or queueing errors for a rejected item"
+    )
+
+
+class BatchResponse(CamelModel):
+    """Per-item results of a batch send request."""
+
+    accepted: int
+    rejected: int
+    results: list[BatchItemResult]
+
+
+class DeadLetterEntry(CamelModel):
+    """A notification that could not be delivered."""
+
+    id: str = Field(..., description="Dead-letter entry id")
+    message_id: str = Field(..., description="Id of the original queued message")
+    attempts: int = Field(..., description="Delivery attempts made")
+    reason: Literal["permanent_failure", "retries_exhausted"]
+    error: str = Field(..., description="Last delivery error")
+    failed_at: datetime
+    payload: EmailInput = Field(
+        ..., description="The notification, narrowed to the recipients that failed"
+    )
+
+
+class CampaignInput(CamelModel):
+    """A notification to send to every recipient of an uploaded list."""
+
+    subject: str = Field(
+        ...,
+        description="Email subject line",
+        examples=["Our November newsletter"],
+        min_length=1,
+        max_length=200,
+    )
+    template: str = Field(
+        default="notification",
+        description="Name of the template in `src/templates` to render",
+        examples=["notification"],
+    )
+    template_variables: dict[str, Any] = Field(
+        default_factory=dict,
+        description=(
+            "Variables shared by every recipient. Each recipient row can override them; "
+            "the merged variables are validated against the template per recipient"
+        ),
+        examples=[{"headline": "What's new this month", "body": "Here is what we shipped."}],
+    )
+    preview_text: str | None = Field(
+        default=None,
+        description="Preview text for email clients (plain text fallback)",
+        max_length=200,
+    )
+
+    @field_validator("subject", "preview_text")
+    @classmethod
+    def sanitize_html(cls, v: str | None) -> str | None:
+        """Sanitize HTML to prevent XSS attacks in email content."""
+        if v is None:
+            return v
+        return strip_html(v)
+
+    @field_validator("template")
+    @classmethod
+    def check_template(cls, v: str) -> str:
+        return EmailInput.check_template(v)
+
+
+class CampaignRecipient(CamelModel):
+    """A row of a campaign's recipient list."""
+
+    model_config = ConfigDict(extra="forbid")
+
+    email: str = Field(..., examples=["jane@example.com"])
+    variables: dict[str, Any] = Field(
+        default_factory=dict,
+        description="Overrides of the campaign's template variables for this recipient",
+        examples=[{"headline": "Hi Jane, here is what's new"}],
+    )
+
+
+class CampaignRowError(CamelModel):
+    """Why a row of an uploaded recipient list was skipped."""
+
+    row: int = Field(..., description="1-based row number, not counting a CSV header")
+    errors: list[dict[str, Any]]
+
+
+class Campaign(CampaignInput):
+    """A campaign and its progress."""
+
+    id: str
+    status: Literal["draft", "running", "paused", "cancelled", "finished"] = Field(
+        ...,
+        description=(
+            "`draft` until recipients are uploaded, then `running` while they are queued. "
+            "`finished` once every recipient was queued; `sent` and `failed` keep "
+            "counting until they add up to `queued`"
+        ),
+    )
+    created_at: datetime
+    recipients: int = Field(default=0, description="Valid rows of the uploaded list")
+    rejected: int = Field(default=0, description="Rows skipped as invalid")
+    queued: int = Field(default=0, description="Recipients put on the outbound queue")
+    sent: int = Field(default=0, description="Recipients delivered to")
+    failed: int = Field(
+        default=0, description="Recipients that failed permanently or ran out of retries"
+    )
+    errors: list[CampaignRowError] = Field(
+        default_factory=list, description="The first rejected rows and why"
+    )
+
+
+class DeliveryStatus(CamelModel):
+    """Where an accepted notification is in its delivery."""
+
+    id: str = Field(..., description="Message id returned when the notification was accepted")
+    status: Literal[
+        "queued", "deferred", "coalesced", "sending", "sent", "failed", "cancelled"
+    ] = Field(
+        ...,
+        description=(
+            "`deferred` while waiting for `sendAt` or for a retry, at `nextAttemptAt`. "
+            "`coalesced` while held for a digest, whose status it then follows. "
+            "`sent` once an attempt was accepted for every recipient it was made for; "
+            "`failed` once recipients were dead-lettered, counted in `failedRecipients`"
+        ),
+    )
+    attempts: int = Field(default=0, description="Delivery attempts started")
+    recipients: int | None = Field(default=None, description="Recipients of the notification")
+    failed_recipients: int = Field(
+        default=0, description="Recipients that failed permanently or ran out of retries"
+    )
+    smtp_code: int | None = Field(
+        default=None, description="SMTP reply code of the last failed attempt, if any"
+    )
+    smtp_response: str | None = Field(
+        default=None, description="Reply or error of the last failed attempt"
+    )
+    queued_at: datetime | None = None
+    updated_at: datetime | None = None
+    sent_at: datetime | None = None
+    next_attempt_at: datetime | None = None
+    digest_id: str | None = Field(
+        default=None, description="Id of the digest email the notification was merged into"
+    )
+
+
+class StatusQuery(CamelModel):
+    """Message ids whose delivery status is requested."""
+
+    ids: list[str] = Field(
+        ...,
+        min_length=1,
+        max_length=settings.status.status_query_max_ids,
+        examples=[["3f0c0e0b9a8d4c1f8f3f8e2d1c0b9a8d"]],
+    )
+
+
+class StatusQueryResponse(CamelModel):
+    """Delivery status of the requested notifications."""
+
+    statuses: list[DeliveryStatus] = Field(..., description="In the order of the request")
+    missing: list[str] = Field(
+        default_factory=list, description="Ids that are unknown or whose record expired"
+    )
+
+
+class SendingHealth(CamelModel):
+    """State of the outbound SMTP send limiter."""
+
+    in_flight: int = Field(..., description="SMTP transactions in progress")
+    waiting: int = Field(..., description="SMTP transactions waiting for a slot")
+    limit: int = Field(
+        ..., description="Current concurrency cap, lowered while the relay pushes back"
+    )
+    max_in_flight: int = Field(..., description="Configured concurrency cap")
+    rate_limit: float = Field(..., description="Messages per second, 0 when unlimited")
+    latency: float | None = Field(
+        default=None, description="Moving average of SMTP transaction latency, in seconds"
+    )
+    throttled: bool = Field(..., description="The cap is below its configured maximum")
+    saturated: bool = Field(..., description="Transactions are queueing for a slot")
 
 
 class HealthResponse(CamelModel):
@@ -106,3 +583,6 @@ class HealthResponse(CamelModel):
         description="Current status of the service",
         examples=["healthy"],
     )
+    sending: SendingHealth | None = Field(
+        default=None, description="Outbound SMTP concurrency and throttling state"
+    )
@@ -0,0 +1,165 @@
+"""Process-wide limiter for outbound SMTP transactions with AIMD backoff."""
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Iterable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from config import SMTPSettings
+from metrics import SEND_LIMIT, SEND_THROTTLES, SEND_WAITING
+
+logger = logging.getLogger(__name__)
+
+# Replies with which relays ask senders to slow down: service not available,
+# local error in processing, insufficient storage / too many recipients.
+THROTTLE_CODES = frozenset({421, 451, 452})
+
+# Weight of the newest sample in the latency moving average.
+_LATENCY_SMOOTHING = 0.2
+
+
+@dataclass(frozen=True)
+class SendLimiterState:
+    in_flight: int
+    waiting: int
+    limit: int
+    max_in_flight: int
+    rate_limit: float
+    latency: float | None
+
+    @property
+    def throttled(self) -> bool:
+        """The relay pushed back and the cap is below its configured maximum."""
+        return self.limit < self.max_in_flight
+
+    @property
+    def saturated(self) -> bool:
+        """Transactions are queueing for a slot."""
+        return self.waiting > 0
+
+
+class SendLimiter:
+    """Bounds concurrent SMTP transactions and paces them with a token bucket.
+
+    The concurrency cap follows AIMD: it is multiplied by
+    ``smtp_backoff_factor`` when the relay answers 421/451/452 or a
+    transaction takes ``smtp_latency_spike_factor`` times longer than the
+    moving average, and grows back by one slot per cap's worth of healthy
+    transactions. Limits are per process.
+    """
+
+    def __init__(self, smtp_settings: SMTPSettings) -> None:
+        self.settings = smtp_settings
+        self._limit = float(smtp_settings.smtp_max_in_flight)
+        self._in_flight = 0
+        self._waiting = 0
+        self._available = asyncio.Condition()
+        self._latency: float | None = None
+        self._last_backoff = 0.0
+        self._tokens = float(smtp_settings.smtp_rate_burst)
+        self._refilled = time.monotonic()
+        self._pacing = asyncio.Lock()
+        SEND_LIMIT.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        return max(int(self._limit), self.settings.smtp_min_in_flight)
+
+    def state(self) -> SendLimiterState:
+        return SendLimiterState(
+            in_flight=self._in_flight,
+            waiting=self._waiting,
+            limit=self.limit,
+            max_in_flight=self.settings.smtp_max_in_flight,
+            rate_limit=self.settings.smtp_rate_limit,
+            latency=self._latency,
+        )
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one of the in-flight slots, waiting for a free one and a rate token."""
+        async with self._available:
+            self._waiting += 1
+            SEND_WAITING.inc()
+            try:
+                await self._available.wait_for(lambda: self._in_flight < self.limit)
+            finally:
+                self._waiting -= 1
+                SEND_WAITING.dec()
+            self._in_flight += 1
+        try:
+            await self._take_token()
+            yield
+        finally:
+            async with self._available:
+                self._in_flight -= 1
+                self._available.notify(max(self.limit - self._in_flight, 0))
+
+    def record(
+        self, latency: float, codes: Iterable[int] = (), failed: bool = False
+    ) -> None:
+        """Feed back the duration and SMTP reply codes of a finished transaction.
+
+        ``failed`` marks a transaction that ended without a reply, such as a
+        dropped connection or a timeout: it can only lower the cap.
+        """
+        throttled = [code for code in codes if code in THROTTLE_CODES]
+        spike = (
+            self._latency is not None
+            and latency > self.settings.smtp_latency_spike_min
+            and latency > self._latency * self.settings.smtp_latency_spike_factor
+        )
+        if not throttled and not failed:
+            # Throttle replies come back fast and would drag the average down.
+            self._latency = (
+                latency
+                if self._latency is None
+                else self._latency + _LATENCY_SMOOTHING * (latency - self._latency)
+            )
+
+        if throttled:
+            self._back_off(f"smtp_{throttled[0]}")
+        elif spike:
+            self._back_off("latency")
+        elif not failed:
+            self._limit = min(
+                self._limit + 1 / self._limit, float(self.settings.smtp_max_in_flight)
+            )
+        SEND_LIMIT.set(self.limit)
+
+    def _back_off(self, reason: str) -> None:
+        now = time.monotonic()
+        # One backoff per cooldown: a burst of replies to transactions that
+        # were already in flight reflects a single congestion event.
+        if now - self._last_backoff < self.settings.smtp_backoff_cooldown:
+            return
+        self._last_backoff = now
+        self._limit = max(
+            self._limit * self.settings.smtp_backoff_factor,
+            float(self.settings.smtp_min_in_flight),
+        )
+        SEND_THROTTLES.inc(reason=reason)
+        logger.warning(
+            "SMTP relay pushing back, lowering send concurrency",
+            extra={"reason": reason, "limit": self.limit},
+        )
+
+    async def _take_token(self) -> None:
+        rate = self.settings.smtp_rate_limit
+        if rate <= 0:
+            return
+        # Serialized so that waiters are paced one after another.
+        async with self._pacing:
+            now = time.monotonic()
+            self._tokens = min(
+                self._tokens + (now - self._refilled) * rate,
+                float(self.settings.smtp_rate_burst),
+            )
+            self._refilled = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / rate)
+                self._tokens = 1.0
+                self._refilled = time.monotonic()
+            self._tokens -= 1
@@ -1,18 +1,22 @@
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from typing import Generic, TypeVar
+import asyncio
 import logging
 
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from pathlib import Path
-
-from aiosmtplib import SMTP, SMTPException
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from jinja2.exceptions import TemplateNotFound, TemplateError
+from aiosmtplib import (
+    SMTPException,
+    SMTPRecipientRefused,
+    SMTPRecipientsRefused,
+    SMTPResponseException,
+)
+from pydantic import BaseModel
 
 from config import settings
+from metrics import DELIVERED, DELIVERY_FAILURES, STAGE_SECONDS
+from rendering import MessageRenderer, RenderCache, RenderExecutor, RenderJob
 from schemas import EmailInput
+from transports import Transport
 
 logger = logging.getLogger(__name__)
 
@@ -25,141 +29,173 @@ class ISender(ABC, Generic[T]):
         pass
 
 
+@dataclass
+class FailedDelivery:
+    """Recipients that did not receive a message, and why."""
+
+    recipients: list[str]
+    error: Exception
+
+
+class DeliveryError(Exception):
+    """Raised when a notification could not be delivered to some of its recipients."""
+
+    def __init__(self, failures: list[FailedDelivery]) -> None:
+        self.failures = failures
+        count = sum(len(f.recipients) for f in failures)
+        super().__init__(f"Delivery failed for {count} recipient(s)")
+
+
+def _failure_code(error: Exception) -> str:
+    """Metrics label for a failed delivery: the SMTP reply code, else the error type."""
+    if isinstance(error, SMTPResponseException):
+        return str(error.code)
+    return type(error).__name__
+
+
 class EmailSender(ISender[EmailInput]):
-    def __init__(self) -> None:
-        templates_dir = Path(__file__).resolve().parent / "templates"
-        self.jinja_env = Environment(
-            loader=FileSystemLoader(templates_dir),
-            autoescape=select_autoescape(["html", "xml"]),
+    """Renders notifications and delivers them through a :class:`Transport`."""
+
+    def __init__(self, transport: Transport) -> None:
+        self.transport = transport
+        self.renderer = MessageRenderer.create()
+        self.render_executor = RenderExecutor(
+            self.renderer,
+            settings.render_executor,
+            settings.render_workers,
+            RenderCache(settings.render_cache_max_bytes)
+            if settings.render_cache_max_bytes > 0
+            else None,
         )
-        self.logo_path = Path(__file__).resolve().parent / "static" / "zozbit.png"
+        # Bounds how many personalized messages are rendered and in flight at
+        # once, so a large fan-out does not build every message up front.
+        self._fan_out = asyncio.Semaphore(settings.smtp.smtp_pool_max_size)
+
+    def warm(self) -> None:
+        """Compile every template up front so a broken one fails startup.
+
+        ``serve.py`` calls this before forking workers, which then share the
+        compiled templates; it is a no-op once templates are loaded.
+        """
+        self.renderer.load()
+
+    async def start(self) -> None:
+        self.warm()
+        self.render_executor.start()
+
+    async def close(self) -> None:
+        self.render_executor.close()
 
     async def send(self, payload: EmailInput) -> None:
+        """Deliver one notification to all of its recipients.
+
+        Recipients without personalized variables receive a single shared
+        message, sent in as few SMTP transactions as the relay's recipient
+        limit allows. Each personalized recipient gets an individually
+        rendered message; those are sent concurrently over the pool.
+
+        Raises:
+            DeliveryError: If any recipient could not be delivered to.
+        """
+        personalized = payload.recipient_variables
+        to = [r for r in payload.to if r not in personalized]
+        cc = [r for r in payload.cc if r not in personalized]
+        bcc = [r for r in payload.bcc if r not in personalized]
+        if not (payload.to or payload.cc or payload.bcc):
+            to = [settings.email_recipient]
+
+        deliveries = []
+        if to or cc or bcc:
+            deliveries.append(
+                self._deliver(payload, payload.template_variables, to, cc, bcc)
+            )
+        deliveries.extend(
+            self._deliver(payload, variables, [recipient], [], [])
+            for recipient, variables in personalized.items()
+        )
+        results = await asyncio.gather(*deliveries)
+        failures = [failure for result in results for failure in result]
+        for failure in failures:
+            DELIVERY_FAILURES.inc(len(failure.recipients), code=_failure_code(failure.error))
+        if failures:
+            raise DeliveryError(failures)
+
+    async def _deliver(
+        self,
+        payload: EmailInput,
+        variables: BaseModel,
+        to: list[str],
+        cc: list[str],
+        bcc: list[str],
+    ) -> list[FailedDelivery]:
         sender_email = settings.email_sender
-        recipient_email = settings.email_recipient
-
-        try:
-            html_body = self._render_html(payload)
-            text_body = self._render_text(payload)
-
-            message = MIMEMultipart("related")
-            message["From"] = sender_email
-            message["To"] = recipient_email
-            message["Subject"] = payload.subject
-
-            message_alternative = MIMEMultipart("alternative")
-            message.attach(message_alternative)
-
-            message_alternative.attach(MIMEText(text_body, "plain", "utf-8"))
-            message_alternative.attach(MIMEText(html_body, "html", "utf-8"))
-
-            if self.logo_path.exists():
-                with open(self.logo_path, "rb") as img_file:
-                    img_data = img_file.read()
-                    image = MIMEImage(img_data)
-                    image.add_header("Content-ID", "<zozbit_logo>")
-                    image.add_header(
-                        "Content-Disposition", "inline", filename="zozbit.png"
+        recipients = [*to, *cc, *bcc]
+        chunk_size = settings.smtp.smtp_max_recipients_per_message
+        failures: list[FailedDelivery] = []
+
+        async with self._fan_out:
+            try:
+                # Off the event loop: only transport I/O happens here.
+                with STAGE_SECONDS.time(stage="build"):
+                    message = await self.render_executor.render(
+                        RenderJob(
+                            template=payload.template,
+                            subject=payload.subject,
+                            preview_text=payload.preview_text,
+                            variables=variables.model_dump(),
+                            to=to,
+                            cc=cc,
+                        )
                     )
-                    message.attach(image)
-
-            smtp = settings.smtp
-            async with SMTP(
-                hostname=smtp.smtp_host,
-                port=smtp.smtp_port,
-                use_tls=smtp.smtp_use_tls,
-            ) as smtp_client:
-                await smtp_client.login(smtp.smtp_username, smtp.smtp_password)
-                await smtp_client.send_message(
-                    message, sender=sender_email, recipients=[recipient_email]
-                )
-
+            except Exception as e:
+                self._log_failure(payload, recipients, e)
+                return [FailedDelivery(recipients, e)]
+
+            # Identical content: one transaction per chunk of RCPT TO.
+            for start in range(0, len(recipients), chunk_size):
+                chunk = recipients[start : start + chunk_size]
+                try:
+                    refused = await self.transport.send(sender_email, chunk, message)
+                except SMTPRecipientsRefused as e:
+                    self._log_failure(payload, chunk, e)
+                    failures.extend(FailedDelivery([r.recipient], r) for r in e.recipients)
+                except Exception as e:
+                    self._log_failure(payload, chunk, e)
+                    failures.append(FailedDelivery(chunk, e))
+                else:
+                    for recipient, response in refused.items():
+                        error = SMTPRecipientRefused(
+                            response.code, response.message, recipient
+                        )
+                        self._log_failure(payload, [recipient], error)
+                        failures.append(FailedDelivery([recipient], error))
+
+        delivered = len(recipients) - sum(len(f.recipients) for f in failures)
+        if delivered:
+            DELIVERED.inc(delivered)
             logger.info(
                 "Email sent successfully",
                 extra={
-                    "recipient": recipient_email,
-                    "sender": sender_email,
-                    "subject": payload.subject,
-                },
-            )
-        except SMTPException as e:
-            logger.error(
-                "SMTP error while sending email",
-                extra={
-                    "recipient": recipient_email,
-                    "sender": sender_email,
-                    "subject": payload.subject,
-                    "error_type": type(e).__name__,
-                    "error_message": str(e),
-                },
-                exc_info=True,
-            )
-        except Exception as e:
-            logger.error(
-                "Unexpected error while sending email",
-                extra={
-                    "recipient": recipient_email,
+                    "recipients": delivered,
                     "sender": sender_email,
                     "subject": payload.subject,
-                    "error_type": type(e).__name__,
-                    "error_message": str(e),
                 },
-                exc_info=True,
             )
-
-    def _render_html(self, payload: EmailInput) -> str:
-        template_vars = self._template_variables(payload)
-
-        try:
-            template = self.jinja_env.get_template("notification.html")
-            return template.render(**template_vars)
-        except TemplateNotFound as e:
-            logger.warning(
-                "Template not found, using fallback HTML",
-                extra={
-                    "template_name": "notification.html",
-                    "error_type": "TemplateNotFound",
-                    "error_message": str(e),
-                },
-            )
-            body = template_vars.get("body", "")
-            return (
-                "<!DOCTYPE html>"
-                '<html lang="en">'
-                '<head><meta charset="utf-8"></head>'
-                '<body style="font-family: Arial, sans-serif; color: #0f172a;">'
-                f'<div style="max-width: 600px; margin: 0 auto;">{body}</div>'
-                "</body>"
-                "</html>"
-            )
-        except TemplateError as e:
-            logger.warning(
-                "Template rendering error, using fallback HTML",
-                extra={
-                    "template_name": "notification.html",
-                    "error_type": "TemplateError",
-                    "error_message": str(e),
-                },
-            )
-            body = template_vars.get("body", "")
-            return (
-                "<!DOCTYPE html>"
-                '<html lang="en">'
-                '<head><meta charset="utf-8"></head>'
-                '<body style="font-family: Arial, sans-serif; color: #0f172a;">'
-                f'<div style="max-width: 600px; margin: 0 auto;">{body}</div>'
-                "</body>"
-                "</html>"
-            )
-
-    def _render_text(self, payload: EmailInput) -> str:
-        if payload.preview_text:
-            return payload.preview_text
-        return payload.template_variables.body
-
-    def _template_variables(self, payload: EmailInput) -> dict[str, str]:
-        template_vars = payload.template_variables.model_dump()
-        template_vars["subject"] = payload.subject
-        if payload.preview_text:
-            template_vars["preview_text"] = payload.preview_text
-        return {k: str(v) if v is not None else "" for k, v in template_vars.items()}
+        return failures
+
+    def _log_failure(
+        self, payload: EmailInput, recipients: list[str], error: Exception
+    ) -> None:
+        logger.error(
+            "SMTP error while sending email"
+            if isinstance(error, SMTPException)
+            else "Unexpected error while sending email",
+            extra={
+                "recipients": len(recipients),
+                "sender": settings.email_sender,
+                "subject": payload.subject,
+                "error_type": type(error).__name__,
+                "error_message": str(error),
+            },
+            exc_info=error,
+        )
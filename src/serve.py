@@ -0,0 +1,128 @@
+"""Production HTTP server: preload the application code once, then fork uvicorn workers.
+
+Models, dependencies, compiled templates and inline images are loaded in the
+parent process, so every worker starts warm and shares those pages
+copy-on-write. The Litestar app itself is built in each worker. The log
+writer thread is stopped around each fork and restarted on the next record
+(see :class:`logs.QueueLogHandler`). Workers accept
+connections on one shared listening socket and run their own event loop,
+startup hooks and sending workers. A worker that dies is replaced; SIGTERM or
+SIGINT stops them all gracefully.
+
+With ``WEB_WORKERS=1`` the server runs in this process without forking.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from config import settings
+from logs import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def bind_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((settings.host, settings.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket) -> None:
+    from main import app
+
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            lifespan="on",
+            access_log=settings.web_access_log,
+            log_config=None,
+            proxy_headers=False,
+        )
+    )
+    server.run(sockets=[sock])
+
+
+def exit_worker(signum: int, frame: object) -> None:
+    raise SystemExit(0)
+
+
+def spawn(sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        # Child: uvicorn installs its own graceful shutdown handlers, then
+        # re-raises the signal once shut down. Exiting from it through
+        # SystemExit, rather than dying, lets queued log records be written.
+        signal.signal(signal.SIGTERM, exit_worker)
+        signal.signal(signal.SIGINT, exit_worker)
+        try:
+            run_worker(sock)
+        finally:
+            # os._exit skips atexit, so write out queued log records first.
+            logging.shutdown()
+            os._exit(0)
+    return pid
+
+
+def supervise(sock: socket.socket) -> None:
+    stopping = False
+    workers: set[int] = set()
+
+    def stop(signum: int, frame: object) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(settings.web_workers):
+        workers.add(spawn(sock))
+    logger.info(
+        "Serving with multiple workers",
+        extra={"workers": settings.web_workers, "port": settings.port},
+    )
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if stopping:
+            continue
+        logger.warning(
+            "Web worker exited, starting a new one",
+            extra={"pid": pid, "exit_code": os.waitstatus_to_exitcode(status)},
+        )
+        # Avoid a hot loop when workers crash on startup.
+        time.sleep(1)
+        workers.add(spawn(sock))
+
+
+def main() -> None:
+    configure_logging()
+    from register_deps import email_sender
+
+    # Compile templates before forking so no worker has to.
+    email_sender.warm()
+    sock = bind_socket()
+    if settings.web_workers <= 1:
+        signal.signal(signal.SIGTERM, exit_worker)
+        signal.signal(signal.SIGINT, exit_worker)
+        run_worker(sock)
+        return
+    supervise(sock)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
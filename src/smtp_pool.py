@@ -0,0 +1,215 @@
+"""Application-scoped pool of persistent, authenticated SMTP connections."""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Sequence
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
+
+from aiosmtplib import (
+    SMTP,
+    SMTPException,
+    SMTPRecipientsRefused,
+    SMTPResponse,
+    SMTPResponseException,
+    SMTPServerDisconnected,
+)
+
+from config import SMTPSettings
+from metrics import SMTP_IN_FLIGHT, STAGE_SECONDS
+from send_limiter import SendLimiter
+from transports import Transport
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PooledConnection:
+    """An open SMTP session plus the bookkeeping the pool needs to recycle it."""
+
+    client: SMTP
+    last_used: float = field(default_factory=time.monotonic)
+    messages_sent: int = 0
+
+    @property
+    def idle_for(self) -> float:
+        return time.monotonic() - self.last_used
+
+
+class SMTPConnectionPool(Transport):
+    """Keeps a bounded set of logged-in SMTP connections ready for reuse.
+
+    Connections are handed out LIFO so the hottest ones stay warm and the
+    surplus ages out through the idle reaper. A connection that has been idle
+    for a while is probed with ``NOOP`` before reuse, and a send that hits a
+    dropped connection is retried once on a fresh one. Every send first takes
+    a slot from the shared :class:`SendLimiter` and reports back to it.
+    """
+
+    def __init__(self, smtp_settings: SMTPSettings, limiter: SendLimiter) -> None:
+        self.settings = smtp_settings
+        self.limiter = limiter
+        self._idle: deque[PooledConnection] = deque()
+        self._slots = asyncio.Semaphore(smtp_settings.smtp_pool_max_size)
+        self._size = 0
+        self._reaper: asyncio.Task[None] | None = None
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        """Number of open connections, idle or in use."""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def start(self) -> None:
+        """Pre-open ``smtp_pool_min_size`` connections and start the idle reaper."""
+        self._closed = False
+        for _ in range(self.settings.smtp_pool_min_size - self._size):
+            try:
+                self._idle.append(await self._open())
+            except (SMTPException, OSError) as e:
+                # The relay being down must not keep the API from booting;
+                # connections are opened lazily on first use instead.
+                logger.warning(
+                    "Could not pre-open SMTP connection",
+                    extra={"error_type": type(e).__name__, "error_message": str(e)},
+                )
+                break
+        self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def close(self) -> None:
+        """Stop the reaper and politely ``QUIT`` every idle connection."""
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._reaper
+            self._reaper = None
+        while self._idle:
+            await self._discard(self._idle.pop(), graceful=True)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[PooledConnection]:
+        """Borrow a healthy connection for the duration of the block."""
+        async with self._slots:
+            conn = await self._checkout()
+            try:
+                yield conn
+            except (SMTPResponseException, SMTPRecipientsRefused):
+                # The server answered and aiosmtplib already RSET the envelope,
+                # so the session is still usable.
+                await self._checkin(conn)
+                raise
+            except BaseException:
+                await self._discard(conn)
+                raise
+            else:
+                await self._checkin(conn)
+
+    async def send(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> dict[str, SMTPResponse]:
+        """Send the serialized ``message`` over a pooled connection, reconnecting once if dropped."""
+        async with self.limiter.slot():
+            started = time.monotonic()
+            codes: list[int] = []
+            failed = False
+            try:
+                try:
+                    result = await self._send_once(sender, recipients, message)
+                except SMTPServerDisconnected:
+                    logger.info("SMTP connection dropped by server, reconnecting")
+                    result = await self._send_once(sender, recipients, message)
+                codes = [response.code for response in result[0].values()]
+                return result[0]
+            except SMTPResponseException as e:
+                codes = [e.code]
+                raise
+            except SMTPRecipientsRefused as e:
+                codes = [r.code for r in e.recipients]
+                raise
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self.limiter.record(time.monotonic() - started, codes, failed)
+
+    async def _send_once(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> tuple[dict[str, SMTPResponse], str]:
+        async with self.connection() as conn:
+            with SMTP_IN_FLIGHT.track_inprogress(), STAGE_SECONDS.time(stage="smtp_send"):
+                result = await conn.client.sendmail(sender, list(recipients), message)
+            conn.messages_sent += 1
+            return result
+
+    async def _checkout(self) -> PooledConnection:
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.client.is_connected:
+                await self._discard(conn)
+                continue
+            if conn.idle_for >= self.settings.smtp_pool_health_check_after:
+                try:
+                    await conn.client.noop()
+                except (SMTPException, OSError):
+                    await self._discard(conn)
+                    continue
+            return conn
+        return await self._open()
+
+    async def _checkin(self, conn: PooledConnection) -> None:
+        conn.last_used = time.monotonic()
+        if self._closed or conn.messages_sent >= self.settings.smtp_pool_max_messages:
+            await self._discard(conn, graceful=True)
+            return
+        self._idle.append(conn)
+
+    async def _open(self) -> PooledConnection:
+        smtp = self.settings
+        client = SMTP(
+            hostname=smtp.smtp_host,
+            port=smtp.smtp_port,
+            use_tls=smtp.smtp_use_tls,
+        )
+        with STAGE_SECONDS.time(stage="smtp_connect"):
+            await client.connect()
+        try:
+            with STAGE_SECONDS.time(stage="smtp_login"):
+                await client.login(smtp.smtp_username, smtp.smtp_password)
+        except BaseException:
+            client.close()
+            raise
+        self._size += 1
+        logger.debug("Opened SMTP connection", extra={"pool_size": self._size})
+        return PooledConnection(client=client)
+
+    async def _discard(self, conn: PooledConnection, graceful: bool = False) -> None:
+        self._size -= 1
+        if graceful and conn.client.is_connected:
+            with suppress(SMTPException, OSError):
+                await conn.client.quit()
+        conn.client.close()
+
+    async def _reap_idle(self) -> None:
+        """Close connections idle past the timeout, keeping ``min_size`` alive."""
+        timeout = self.settings.smtp_pool_idle_timeout
+        while True:
+            await asyncio.sleep(max(timeout / 2, 1.0))
+            for conn in [c for c in self._idle if c.idle_for >= timeout]:
+                self._idle.remove(conn)
+                if self._size > self.settings.smtp_pool_min_size:
+                    await self._discard(conn, graceful=True)
+                    continue
+                try:
+                    await conn.client.noop()
+                except (SMTPException, OSError):
+                    await self._discard(conn)
+                    continue
+                conn.last_used = time.monotonic()
+                self._idle.appendleft(conn)
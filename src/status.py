@@ -0,0 +1,390 @@
+"""Delivery status of accepted notifications.
+
+Every notification the API accepts gets a compact record of where it is in
+its delivery: ``queued``, ``deferred`` until its ``sendAt`` or next retry,
+``coalesced`` while held for a digest, ``sending``, then ``sent``, ``failed``
+once dead-lettered, or ``cancelled``, with the reply of the last failed
+attempt and timestamps. Records expire ``STATUS_TTL`` seconds after their
+last update. A coalesced notification then follows the status of its
+digest, whose id it records.
+
+Recording never waits on I/O: updates are applied to process memory right
+away, or buffered and written to Redis in bulk every
+``STATUS_FLUSH_INTERVAL`` seconds, so tracking adds nothing to the latency
+of a send. Recipients of a campaign are not tracked one by one; the
+campaign counts them.
+"""
+
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from typing import Any
+
+from aiosmtplib import SMTPResponseException
+from redis.asyncio import Redis
+
+from config import StatusSettings
+from metrics import STATUS_UPDATES_DROPPED
+from outbox import OutboxMessage
+from schemas import DeliveryStatus
+from sender import FailedDelivery
+
+logger = logging.getLogger(__name__)
+
+# Records written to Redis per pipeline.
+_FLUSH_BATCH = 500
+_MAX_RESPONSE_LENGTH = 500
+
+
+@dataclass(slots=True)
+class _Record:
+    """A status record; field names double as the fields of its Redis hash."""
+
+    status: str | None = None
+    attempts: int = 0
+    recipients: int | None = None
+    failed: int = 0
+    code: int | None = None
+    response: str | None = None
+    queued: float | None = None
+    updated: float | None = None
+    sent: float | None = None
+    next: float | None = None
+    digest: str | None = None
+
+    def apply(self, update: "_Update") -> None:
+        for name, value in update.defaults.items():
+            if getattr(self, name) is None:
+                setattr(self, name, value)
+        for name, value in update.fields.items():
+            setattr(self, name, value)
+        self.failed += update.failed
+
+    def to_status(self, message_id: str) -> DeliveryStatus:
+        return DeliveryStatus(
+            id=message_id,
+            status=self.status or "queued",
+            attempts=self.attempts,
+            recipients=self.recipients,
+            failed_recipients=self.failed,
+            smtp_code=self.code,
+            smtp_response=self.response,
+            queued_at=_datetime(self.queued),
+            updated_at=_datetime(self.updated),
+            sent_at=_datetime(self.sent),
+            next_attempt_at=_datetime(self.next),
+            digest_id=self.digest,
+        )
+
+
+_FIELD_TYPES: dict[str, type] = {
+    "status": str,
+    "attempts": int,
+    "recipients": int,
+    "failed": int,
+    "code": int,
+    "response": str,
+    "queued": float,
+    "updated": float,
+    "sent": float,
+    "next": float,
+    "digest": str,
+}
+
+
+@dataclass(slots=True)
+class _Update:
+    """Changes to a record.
+
+    ``fields`` are set, ``None`` clearing them; ``defaults`` only fill fields
+    the record does not have yet; ``failed`` is added to its count.
+    """
+
+    fields: dict[str, Any] = field(default_factory=dict)
+    defaults: dict[str, Any] = field(default_factory=dict)
+    failed: int = 0
+
+    def merge(self, later: "_Update") -> None:
+        """Combine with an update made after this one, as if both were applied in turn."""
+        for name, value in later.defaults.items():
+            if name not in self.fields:
+                self.defaults.setdefault(name, value)
+        self.fields.update(later.fields)
+        # A count set by the later update replaces the failures added before it.
+        self.failed = later.failed if "failed" in later.fields else self.failed + later.failed
+
+
+def _datetime(timestamp: float | None) -> datetime | None:
+    return datetime.fromtimestamp(timestamp, UTC) if timestamp is not None else None
+
+
+def _now() -> float:
+    return round(time.time(), 3)
+
+
+def _recipients(message: OutboxMessage) -> int:
+    payload = message.payload
+    # Without recipients, the notification goes to the configured EMAIL_RECIPIENT.
+    return len(payload.to) + len(payload.cc) + len(payload.bcc) or 1
+
+
+def _reply(failures: list[FailedDelivery]) -> dict[str, Any]:
+    """SMTP reply code and text of a failed attempt, from its last failure."""
+    error = failures[-1].error
+    if isinstance(error, SMTPResponseException):
+        code, response = error.code, error.message
+    else:
+        code, response = None, f"{type(error).__name__}: {error}"
+    return {"code": code, "response": response[:_MAX_RESPONSE_LENGTH]}
+
+
+class StatusStore(ABC):
+    """Delivery status records, updated as notifications move through the pipeline.
+
+    The methods named after events are called by the API and passed as hooks
+    to the worker pool and the retry scheduler; none of them waits on I/O.
+    """
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def record(self, message_id: str, update: _Update) -> None:
+        """Apply ``update`` to a record; stores may apply it later, in bulk."""
+
+    @abstractmethod
+    async def get_many(self, message_ids: list[str]) -> dict[str, DeliveryStatus]:
+        """The records of ``message_ids`` that exist, by message id."""
+
+    async def get(self, message_id: str) -> DeliveryStatus | None:
+        return (await self.get_many([message_id])).get(message_id)
+
+    async def accepted(self, message: OutboxMessage, due: float | None = None) -> None:
+        """A notification was queued, or scheduled for ``due``."""
+        now = _now()
+        # Defaults, so that a worker that got to the message first is not overwritten.
+        self.record(
+            message.id,
+            _Update(
+                defaults={
+                    "status": "queued" if due is None else "deferred",
+                    "recipients": _recipients(message),
+                    "queued": now,
+                    "updated": now,
+                    "next": round(due, 3) if due is not None else None,
+                }
+            ),
+        )
+
+    async def requeued(self, message: OutboxMessage) -> None:
+        """A dead-lettered notification was queued again."""
+        now = _now()
+        self.record(
+            message.id,
+            _Update(
+                fields={"status": "queued", "failed": 0, "next": None, "updated": now},
+                defaults={"recipients": _recipients(message), "queued": now},
+            ),
+        )
+
+    async def cancelled(self, message_id: str) -> None:
+        self.record(
+            message_id,
+            _Update(fields={"status": "cancelled", "next": None, "updated": _now()}),
+        )
+
+    async def coalesced(self, message: OutboxMessage) -> None:
+        """``on_hold`` hook of the digest coalescer."""
+        self._progress(message, {"status": "coalesced", "next": None, "updated": _now()})
+
+    async def sending(self, message: OutboxMessage) -> None:
+        """``on_sending`` hook of the worker pool."""
+        self._progress(
+            message,
+            {"status": "sending", "attempts": message.attempt + 1, "next": None, "updated": _now()},
+        )
+
+    async def delivered(self, message: OutboxMessage) -> None:
+        """``on_delivered`` hook of the worker pool."""
+        now = _now()
+        self._progress(message, {"status": "sent", "sent": now, "updated": now})
+
+    async def retrying(
+        self, message: OutboxMessage, due: float, failures: list[FailedDelivery]
+    ) -> None:
+        """``on_retry`` hook of the retry scheduler."""
+        self._progress(
+            message,
+            {"status": "deferred", "next": round(due, 3), "updated": _now(), **_reply(failures)},
+        )
+
+    async def dead_lettered(
+        self, message: OutboxMessage, failures: list[FailedDelivery]
+    ) -> None:
+        """``on_dead_letter`` hook of the retry scheduler."""
+        self._progress(
+            message,
+            {"status": "failed", "next": None, "updated": _now(), **_reply(failures)},
+            failed=sum(len(f.recipients) for f in failures),
+        )
+
+    def _progress(self, message: OutboxMessage, fields: dict[str, Any], failed: int = 0) -> None:
+        """Record a delivery event, on each notification merged into it if it is a digest."""
+        if message.campaign_id:
+            return
+        if message.members:
+            fields = {**fields, "digest": message.id}
+        for message_id in message.members or [message.id]:
+            # One update per record: buffered updates are merged in place.
+            self.record(message_id, _Update(fields=dict(fields), failed=failed))
+
+
+class MemoryStatusStore(StatusStore):
+    """Records of this process only, at most ``STATUS_MAX_ENTRIES`` of them.
+
+    Records are kept in the order they were last updated, so both the
+    expired ones and, past the limit, the least recently updated ones are
+    dropped from the front.
+    """
+
+    def __init__(self, status_settings: StatusSettings) -> None:
+        self.settings = status_settings
+        self._records: OrderedDict[str, _Record] = OrderedDict()
+
+    def record(self, message_id: str, update: _Update) -> None:
+        record = self._records.pop(message_id, None) or _Record()
+        record.apply(update)
+        self._records[message_id] = record
+        expired = time.time() - self.settings.status_ttl
+        while self._records:
+            oldest = next(iter(self._records.values()))
+            if (
+                len(self._records) <= self.settings.status_max_entries
+                and (oldest.updated or 0) > expired
+            ):
+                break
+            self._records.popitem(last=False)
+
+    async def get_many(self, message_ids: list[str]) -> dict[str, DeliveryStatus]:
+        expired = time.time() - self.settings.status_ttl
+        statuses = {}
+        for message_id in message_ids:
+            record = self._records.get(message_id)
+            if record is not None and (record.updated or 0) > expired:
+                statuses[message_id] = record.to_status(message_id)
+        return statuses
+
+
+class RedisStatusStore(StatusStore):
+    """Records kept in Redis, shared by every process, one hash per message.
+
+    Updates are buffered in process memory, merged per message, and written
+    every ``STATUS_FLUSH_INTERVAL`` seconds in pipelines, each write renewing
+    the record's expiry. A query overlays the updates this process has not
+    written yet. When Redis is unreachable, the buffered updates are dropped
+    rather than held, and at most ``STATUS_MAX_PENDING`` messages are buffered.
+    """
+
+    def __init__(self, redis: Redis, status_settings: StatusSettings) -> None:
+        self.redis = redis
+        self.settings = status_settings
+        self._pending: dict[str, _Update] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def _key(self, message_id: str) -> str:
+        return f"{self.settings.status_key_prefix}:{message_id}"
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_periodically(), name="status-flush")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def record(self, message_id: str, update: _Update) -> None:
+        pending = self._pending.get(message_id)
+        if pending is not None:
+            pending.merge(update)
+        elif len(self._pending) < self.settings.status_max_pending:
+            self._pending[message_id] = update
+        else:
+            STATUS_UPDATES_DROPPED.inc(reason="buffer_full")
+
+    async def flush(self) -> None:
+        """Write the updates buffered since the last flush."""
+        pending, self._pending = self._pending, {}
+        updates = list(pending.items())
+        for start in range(0, len(updates), _FLUSH_BATCH):
+            batch = updates[start : start + _FLUSH_BATCH]
+            try:
+                await self._write(batch)
+            except Exception as e:
+                dropped = len(updates) - start
+                STATUS_UPDATES_DROPPED.inc(dropped, reason="store_error")
+                logger.error(
+                    "Failed to save delivery statuses",
+                    extra={
+                        "dropped": dropped,
+                        "error_type": type(e).__name__,
+                        "error_message": str(e),
+                    },
+                )
+                return
+
+    async def _write(self, updates: list[tuple[str, _Update]]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for message_id, update in updates:
+                key = self._key(message_id)
+                for name, value in update.defaults.items():
+                    if value is not None:
+                        pipe.hsetnx(key, name, value)
+                values = {name: v for name, v in update.fields.items() if v is not None}
+                if values:
+                    pipe.hset(key, mapping=values)
+                cleared = [name for name, v in update.fields.items() if v is None]
+                if cleared:
+                    pipe.hdel(key, *cleared)
+                if update.failed:
+                    pipe.hincrby(key, "failed", update.failed)
+                pipe.expire(key, self.settings.status_ttl)
+            await pipe.execute()
+
+    async def get_many(self, message_ids: list[str]) -> dict[str, DeliveryStatus]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for message_id in message_ids:
+                pipe.hgetall(self._key(message_id))
+            results = await pipe.execute()
+
+        statuses = {}
+        for message_id, stored in zip(message_ids, results):
+            pending = self._pending.get(message_id)
+            if not stored and pending is None:
+                continue
+            record = _Record(
+                **{
+                    name.decode(): _FIELD_TYPES[name.decode()](value.decode())
+                    for name, value in stored.items()
+                    if name.decode() in _FIELD_TYPES
+                }
+            )
+            if pending is not None:
+                record.apply(pending)
+            statuses[message_id] = record.to_status(message_id)
+        return statuses
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.status_flush_interval)
+            await self.flush()
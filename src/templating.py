@@ -0,0 +1,166 @@
+"""Jinja environment setup and ahead-of-time template compilation.
+
+Run ``python templating.py compile [target]`` at image build time to write
+the templates as Python modules, and point ``TEMPLATE_PRECOMPILED_DIR`` at
+the target so that production workers never parse template sources.
+"""
+
+import hashlib
+import json
+import logging
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from jinja2 import (
+    BaseLoader,
+    BytecodeCache,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    ModuleLoader,
+    Template,
+    select_autoescape,
+)
+
+from config import Settings, settings
+from schemas import CamelModel, template_variable_models, template_variables_model
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+
+
+def template_names() -> list[str]:
+    """Names of all templates shipped in ``src/templates``."""
+    return sorted(
+        path.relative_to(TEMPLATES_DIR).as_posix()
+        for path in TEMPLATES_DIR.rglob("*.html")
+    )
+
+
+def templates_digest() -> str:
+    """Digest of every file in ``src/templates``, as the templates' version."""
+    digest = hashlib.sha256()
+    for path in sorted(p for p in TEMPLATES_DIR.rglob("*") if p.is_file()):
+        digest.update(path.relative_to(TEMPLATES_DIR).as_posix().encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def create_environment(app_settings: Settings = settings) -> Environment:
+    """Build the template environment for the current mode.
+
+    In debug mode templates are loaded from source and reloaded when they
+    change on disk. Otherwise precompiled modules are used when available,
+    and templates are never re-checked once loaded.
+    """
+    loader: BaseLoader
+    bytecode_cache: BytecodeCache | None = None
+    precompiled_dir = app_settings.template_precompiled_dir
+
+    if precompiled_dir and not app_settings.debug and Path(precompiled_dir).is_dir():
+        loader = ModuleLoader(precompiled_dir)
+        logger.info("Using precompiled templates", extra={"path": precompiled_dir})
+    else:
+        loader = FileSystemLoader(TEMPLATES_DIR)
+        if app_settings.template_bytecode_cache_dir:
+            Path(app_settings.template_bytecode_cache_dir).mkdir(
+                parents=True, exist_ok=True
+            )
+            bytecode_cache = FileSystemBytecodeCache(
+                app_settings.template_bytecode_cache_dir
+            )
+
+    return Environment(
+        loader=loader,
+        autoescape=select_autoescape(["html", "xml"]),
+        auto_reload=app_settings.debug,
+        bytecode_cache=bytecode_cache,
+    )
+
+
+@dataclass(frozen=True)
+class NotificationTemplate:
+    """A compiled template together with the model validating its variables."""
+
+    name: str
+    template: Template
+    variables: type[CamelModel]
+
+
+class TemplateRegistry:
+    """Every selectable template in ``src/templates``, compiled once at startup.
+
+    Each ``<name>.html`` is selectable as ``name``. Its variables are validated
+    by the built-in model registered in :mod:`schemas`, or by the model built
+    from ``<name>.schema.json`` next to it. Templates whose name starts with
+    an underscore are layouts or partials: they are compiled but not selectable.
+    """
+
+    def __init__(self, env: Environment) -> None:
+        self.env = env
+        self._templates: dict[str, NotificationTemplate] = {}
+        self.version = ""
+
+    @property
+    def names(self) -> list[str]:
+        return sorted(self._templates)
+
+    def load(self) -> None:
+        """Compile all templates and register their variable models.
+
+        Raises:
+            jinja2.TemplateError: If a template does not compile.
+            ValueError: If a selectable template has no variable schema.
+        """
+        self.version = templates_digest()
+        for filename in template_names():
+            template = self.env.get_template(filename)
+            name = filename.removesuffix(".html")
+            if Path(name).name.startswith("_"):
+                continue
+            variables = template_variable_models.get(name) or self._load_schema(name)
+            template_variable_models[name] = variables
+            self._templates[name] = NotificationTemplate(name, template, variables)
+        logger.info("Templates loaded", extra={"templates": self.names})
+
+    def get(self, name: str) -> NotificationTemplate:
+        return self._templates[name]
+
+    def render(self, name: str, variables: dict[str, Any]) -> str:
+        template = self._templates[name].template
+        if self.env.auto_reload:
+            # Debug mode: let Jinja pick up edits to the template source.
+            template = self.env.get_template(template.name)
+        return template.render(**variables)
+
+    def _load_schema(self, name: str) -> type[CamelModel]:
+        schema_path = TEMPLATES_DIR / f"{name}.schema.json"
+        if not schema_path.is_file():
+            raise ValueError(
+                f"Template '{name}' has no variable schema, expected {schema_path}"
+            )
+        return template_variables_model(name, json.loads(schema_path.read_text()))
+
+
+def compile_templates(target: Path) -> None:
+    """Compile every template in ``src/templates`` to Python modules in ``target``."""
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATES_DIR),
+        autoescape=select_autoescape(["html", "xml"]),
+    )
+    env.compile_templates(
+        target, zip=None, ignore_errors=False, log_function=logger.info
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) < 2 or sys.argv[1] != "compile":
+        sys.exit("usage: python templating.py compile [target]")
+    target = sys.argv[2] if len(sys.argv) > 2 else settings.template_precompiled_dir
+    if not target:
+        sys.exit("No target given and TEMPLATE_PRECOMPILED_DIR is not set")
+    compile_templates(Path(target))
@@ -0,0 +1,273 @@
+"""Transports that hand rendered messages to their destination.
+
+:class:`Transport` is what :class:`sender.EmailSender` delivers through. The
+pooled SMTP transport lives in :mod:`smtp_pool`; this module adds an HTTP
+provider API, a local maildir/mbox sink and a null transport.
+
+Failures are raised as aiosmtplib exceptions whatever the transport, so that
+retries and dead letters classify them by SMTP reply code.
+"""
+
+import asyncio
+import base64
+import logging
+import mailbox
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from contextlib import suppress
+from pathlib import Path
+from typing import Any
+
+import httpx
+from aiosmtplib import SMTPResponse, SMTPResponseException
+
+from config import TransportSettings
+
+logger = logging.getLogger(__name__)
+
+
+class Transport(ABC):
+    """Delivers a serialized message to a list of envelope recipients."""
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def send(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> dict[str, SMTPResponse]:
+        """Deliver ``message``; returns the recipients that were refused.
+
+        Raises:
+            SMTPResponseException: If the whole message was rejected.
+            OSError: If the destination could not be reached.
+        """
+
+
+class NullTransport(Transport):
+    """Accepts and discards every message, to measure everything but delivery."""
+
+    async def send(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> dict[str, SMTPResponse]:
+        return {}
+
+
+def _envelope_headers(sender: str, recipients: Sequence[str]) -> bytes:
+    # Bcc recipients only exist in the envelope, so record it in the stored copy.
+    # Line feeds only, like the rendered message, which the mailbox module
+    # writes out with the platform's line separator.
+    return (
+        f"X-Envelope-From: {sender}\n"
+        f"X-Envelope-To: {', '.join(recipients)}\n"
+    ).encode()
+
+
+class FileTransport(Transport):
+    """Stores messages in a local maildir or mbox instead of sending them.
+
+    Meant for development and high-volume tests without a relay; any mail
+    client can open the result. Writes happen in a thread, one at a time.
+    """
+
+    def __init__(self, path: Path, file_format: str) -> None:
+        self.path = path
+        self.format = file_format
+        self._mailbox: mailbox.Mailbox | None = None
+        self._lock = threading.Lock()
+
+    async def start(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.format == "mbox":
+            self._mailbox = mailbox.mbox(self.path)
+        else:
+            self._mailbox = mailbox.Maildir(self.path, create=True)
+        logger.info(
+            "Messages are written to a local mailbox, nothing is sent",
+            extra={"path": str(self.path), "format": self.format},
+        )
+
+    async def close(self) -> None:
+        if self._mailbox is not None:
+            self._mailbox.close()
+            self._mailbox = None
+
+    async def send(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> dict[str, SMTPResponse]:
+        await asyncio.to_thread(self._write, sender, recipients, message)
+        return {}
+
+    def _write(self, sender: str, recipients: Sequence[str], message: bytes) -> None:
+        data = _envelope_headers(sender, recipients) + message
+        with self._lock:
+            assert self._mailbox is not None, "FileTransport used before start()"
+            if isinstance(self._mailbox, mailbox.mbox):
+                entry = mailbox.mboxMessage(data)
+                entry.set_from(sender, True)
+                self._mailbox.add(entry)
+                self._mailbox.flush()
+            else:
+                self._mailbox.add(data)
+
+
+def _http_error(status_code: int, detail: str) -> SMTPResponseException:
+    """The SMTP reply equivalent to a provider's HTTP status.
+
+    Rate limiting and server errors are temporary (451), so they are
+    retried; other client errors are permanent (550).
+    """
+    code = 451 if status_code == 429 or status_code >= 500 else 550
+    return SMTPResponseException(code, f"HTTP {status_code}: {detail}"[:500])
+
+
+class HTTPTransport(Transport):
+    """Posts messages to an email provider's HTTP API over kept-alive connections.
+
+    Each request carries up to ``transport_http_batch_size`` messages sent
+    within ``transport_http_linger`` seconds of each other::
+
+        POST <transport_http_url>
+        Authorization: Bearer <transport_http_token>
+        {"messages": [{"from": "...", "to": ["..."], "raw": "<base64 MIME>"}]}
+
+    A 2xx response accepts every message, unless its body holds a
+    ``results`` list with a ``status`` (and optional ``error``) per message,
+    in order; any other response rejects the whole batch.
+    """
+
+    def __init__(self, transport_settings: TransportSettings) -> None:
+        self.settings = transport_settings
+        self._client: httpx.AsyncClient | None = None
+        self._pending: list[tuple[dict[str, Any], asyncio.Future[None]]] = []
+        self._linger: asyncio.TimerHandle | None = None
+        self._requests: set[asyncio.Task[None]] = set()
+
+    async def start(self) -> None:
+        if not self.settings.transport_http_url:
+            raise ValueError("TRANSPORT_HTTP_URL is required with the http transport")
+        headers = {}
+        if self.settings.transport_http_token:
+            headers["Authorization"] = f"Bearer {self.settings.transport_http_token}"
+        connections = self.settings.transport_http_max_connections
+        self._client = httpx.AsyncClient(
+            headers=headers,
+            timeout=self.settings.transport_http_timeout,
+            limits=httpx.Limits(
+                max_connections=connections, max_keepalive_connections=connections
+            ),
+        )
+
+    async def close(self) -> None:
+        if self._pending:
+            self._flush()
+        if self._requests:
+            await asyncio.gather(*self._requests, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(
+        self, sender: str, recipients: Sequence[str], message: bytes
+    ) -> dict[str, SMTPResponse]:
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._pending.append(
+            (
+                {
+                    "from": sender,
+                    "to": list(recipients),
+                    "raw": base64.b64encode(message).decode("ascii"),
+                },
+                future,
+            )
+        )
+        if len(self._pending) >= self.settings.transport_http_batch_size:
+            self._flush()
+        elif self._linger is None:
+            self._linger = asyncio.get_running_loop().call_later(
+                self.settings.transport_http_linger, self._flush
+            )
+        await future
+        return {}
+
+    def _flush(self) -> None:
+        if self._linger is not None:
+            self._linger.cancel()
+            self._linger = None
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._post(batch), name="http-transport")
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+
+    async def _post(self, batch: list[tuple[dict[str, Any], asyncio.Future[None]]]) -> None:
+        error = SMTPResponseException(451, "HTTP transport request was interrupted")
+        try:
+            await self._request(batch)
+        except Exception as e:
+            logger.error(
+                "HTTP transport request failed",
+                extra={"error_type": type(e).__name__, "error_message": str(e)},
+            )
+            error = SMTPResponseException(451, f"{type(e).__name__}: {e}"[:500])
+        finally:
+            # No sender may be left waiting, whatever stopped the request.
+            for _, future in batch:
+                _settle(future, error)
+
+    async def _request(
+        self, batch: list[tuple[dict[str, Any], asyncio.Future[None]]]
+    ) -> None:
+        assert self._client is not None, "HTTPTransport used before start()"
+        try:
+            response = await self._client.post(
+                self.settings.transport_http_url,
+                json={"messages": [message for message, _ in batch]},
+            )
+        except httpx.TransportError as e:
+            for _, future in batch:
+                _settle(future, ConnectionError(f"{type(e).__name__}: {e}"))
+            return
+
+        if not response.is_success:
+            for _, future in batch:
+                _settle(future, _http_error(response.status_code, response.text))
+            return
+
+        results = None
+        with suppress(ValueError):
+            body = response.json()
+            if isinstance(body, dict):
+                results = body.get("results")
+        if not isinstance(results, list):
+            results = []
+        for index, (_, future) in enumerate(batch):
+            result = results[index] if index < len(results) else {}
+            _settle(future, _result_error(result, response.status_code))
+
+
+def _result_error(result: Any, status_code: int) -> SMTPResponseException | None:
+    """The error for one entry of a provider's ``results``, ``None`` if it was accepted.
+
+    An entry without a status takes the response's. A malformed entry is
+    treated as a temporary failure: the message is retried rather than lost.
+    """
+    if not isinstance(result, dict):
+        return SMTPResponseException(451, f"Unexpected HTTP transport result: {result!r}"[:500])
+    try:
+        status = int(result.get("status", status_code))
+    except (TypeError, ValueError):
+        return SMTPResponseException(451, f"Unexpected HTTP transport result: {result!r}"[:500])
+    return None if status < 400 else _http_error(status, str(result.get("error", "")))
+
+
+def _settle(future: asyncio.Future[None], error: BaseException | None) -> None:
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
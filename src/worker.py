@@ -0,0 +1,80 @@
+"""Standalone sending tier that drains the outbox without serving HTTP.
+
+Run API instances with ``QUEUE_CONSUME=false`` and scale this process
+separately; both sides need ``QUEUE_BACKEND=redis`` to share the queue.
+"""
+
+import asyncio
+import logging
+import signal
+
+from config import settings
+from logs import configure_logging
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, collect as collect_metrics
+from register_deps import (
+    CONSUMER_STARTUP,
+    ON_SHUTDOWN,
+    ON_STARTUP,
+    outbox,
+    scheduler,
+    smtp_pool,
+)
+
+configure_logging()
+
+logger = logging.getLogger(__name__)
+
+
+async def serve_metrics(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Answer any HTTP request with the metrics page; the worker serves nothing else."""
+    try:
+        # Request line and headers are not needed, just drain them.
+        while (await reader.readline()).strip():
+            pass
+        body = (await collect_metrics(outbox, scheduler, smtp_pool)).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            + f"Content-Type: {METRICS_CONTENT_TYPE}\r\n".encode()
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def run() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # The same components as the web app, plus the consumers even where the
+    # shared configuration sets QUEUE_CONSUME=false for API instances.
+    startup = [*ON_STARTUP, *(h for h in CONSUMER_STARTUP if h not in ON_STARTUP)]
+    for hook in startup:
+        await hook()
+    metrics_server = None
+    if settings.worker_metrics_port:
+        metrics_server = await asyncio.start_server(
+            serve_metrics, port=settings.worker_metrics_port
+        )
+        logger.info(
+            "Serving worker metrics", extra={"port": settings.worker_metrics_port}
+        )
+    logger.info("Sending worker running, waiting for notifications")
+
+    await stop.wait()
+
+    logger.info("Shutting down sending worker")
+    if metrics_server is not None:
+        metrics_server.close()
+    for hook in ON_SHUTDOWN:
+        await hook()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+"""Helpers shared by the tests: payloads, a scripted sender and polling."""
+
+import asyncio
+import inspect
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from schemas import EmailInput
+from sender import ISender
+
+
+def payload(**fields: Any) -> EmailInput:
+    return EmailInput.model_validate(
+        {
+            "subject": "Subject",
+            "templateVariables": {"headline": "Headline", "body": "Body"},
+            **fields,
+        }
+    )
+
+
+class ScriptedSender(ISender[EmailInput]):
+    """Records what it is asked to send, raising ``errors`` in turn first."""
+
+    def __init__(self, *errors: Exception) -> None:
+        self.errors = list(errors)
+        self.sent: list[EmailInput] = []
+        self.attempts = 0
+
+    async def send(self, payload: EmailInput) -> None:
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(payload)
+
+
+async def eventually(
+    predicate: Callable[[], bool | Awaitable[bool]], timeout: float = 2.0
+) -> None:
+    """Wait until ``predicate`` holds, failing the test after ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.005)
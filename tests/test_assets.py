@@ -0,0 +1,59 @@
+"""Lossless PNG optimization of the inline assets."""
+
+import struct
+import zlib
+
+from assets import PNG_SIGNATURE, _png_chunk, _png_chunks, _unfilter, optimize_png
+
+WIDTH, HEIGHT = 64, 32
+
+
+def pixels() -> list[bytes]:
+    return [
+        bytes(channel for x in range(WIDTH) for channel in (x * 4, y * 8, 128, 255))
+        for y in range(HEIGHT)
+    ]
+
+
+def encode(rows: list[bytes], *extra: bytes) -> bytes:
+    """An unfiltered, barely compressed RGBA PNG with ``extra`` chunks."""
+    header = struct.pack(">IIBBBBB", WIDTH, HEIGHT, 8, 6, 0, 0, 0)
+    raw = b"".join(b"\x00" + row for row in rows)
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", header),
+            *extra,
+            _png_chunk(b"IDAT", zlib.compress(raw, 1)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def decode(data: bytes) -> list[bytes]:
+    idat = b"".join(body for kind, body in _png_chunks(data) if kind == b"IDAT")
+    return _unfilter(zlib.decompress(idat), WIDTH * 4, 4)
+
+
+def test_optimized_png_is_smaller_with_the_same_pixels() -> None:
+    original = encode(pixels())
+
+    optimized = optimize_png(original)
+
+    assert len(optimized) < len(original)
+    assert decode(optimized) == pixels()
+
+
+def test_optimize_keeps_rendering_chunks_and_drops_metadata() -> None:
+    gamma = _png_chunk(b"gAMA", struct.pack(">I", 45455))
+    text = _png_chunk(b"tEXt", b"Comment\x00made by hand")
+
+    kinds = [kind for kind, _ in _png_chunks(optimize_png(encode(pixels(), gamma, text)))]
+
+    assert kinds == [b"IHDR", b"gAMA", b"IDAT", b"IEND"]
+
+
+def test_already_optimized_png_is_returned_unchanged() -> None:
+    optimized = optimize_png(encode(pixels()))
+
+    assert optimize_png(optimized) is optimized
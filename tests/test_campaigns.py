@@ -0,0 +1,248 @@
+"""Campaigns: recipient list parsers, per-recipient payloads and queue pacing."""
+
+import asyncio
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import Any
+
+import pytest
+from litestar.exceptions import ClientException
+
+from campaigns import (
+    MAX_ROW_BYTES,
+    CampaignRunner,
+    MemoryCampaignStore,
+    campaign_payload,
+    iter_csv_rows,
+    iter_ndjson_rows,
+    new_campaign,
+    parse_recipient,
+)
+from config import CampaignSettings, QueueSettings
+from outbox import MemoryOutbox, OutboxMessage
+from schemas import Campaign, CampaignInput
+from support import eventually
+
+pytestmark = pytest.mark.anyio
+
+
+async def stream(*chunks: bytes) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(rows: AsyncIterator[Any]) -> list[Any]:
+    return [row async for row in rows]
+
+
+async def test_csv_maps_columns_to_email_and_variables() -> None:
+    rows = iter_csv_rows(
+        stream(b"\xef\xbb\xbfemail, headline ,body\n", b"a@x.com,Hi A,\n", b"b@x.com,Hi B,Body B\n")
+    )
+
+    assert await collect(rows) == [
+        {"email": "a@x.com", "variables": {"headline": "Hi A"}},
+        {"email": "b@x.com", "variables": {"headline": "Hi B", "body": "Body B"}},
+    ]
+
+
+async def test_csv_quoted_fields_may_span_chunks_and_lines() -> None:
+    rows = iter_csv_rows(
+        stream(b'email,body\na@x.com,"Line one', b'\nLine ""two"""\n', b"b@x.com,B")
+    )
+
+    assert await collect(rows) == [
+        {"email": "a@x.com", "variables": {"body": 'Line one\nLine "two"'}},
+        {"email": "b@x.com", "variables": {"body": "B"}},
+    ]
+
+
+async def test_csv_reports_columns_past_the_header() -> None:
+    [row] = await collect(iter_csv_rows(stream(b"email\na@x.com,extra\n")))
+
+    assert row["unnamedColumns"] == ["extra"]
+    with pytest.raises(ValueError):
+        parse_recipient(row)
+
+
+async def test_csv_requires_an_email_column() -> None:
+    with pytest.raises(ClientException, match="'email' column"):
+        await collect(iter_csv_rows(stream(b"address\na@x.com\n")))
+
+
+async def test_csv_rejects_a_record_longer_than_the_limit() -> None:
+    rows = iter_csv_rows(stream(b'email,body\na@x.com,"', b"x" * MAX_ROW_BYTES, b'"\n'))
+
+    with pytest.raises(ClientException, match="exceeds the maximum size"):
+        await collect(rows)
+
+
+async def test_ndjson_joins_lines_split_across_chunks() -> None:
+    rows = iter_ndjson_rows(stream(b'{"a"', b": 1}\n{", b'"b": 2}\n'))
+
+    assert await collect(rows) == [b'{"a": 1}', b'{"b": 2}']
+
+
+async def test_ndjson_skips_blank_lines_and_keeps_an_unterminated_last_line() -> None:
+    rows = iter_ndjson_rows(stream(b"\n1\n  \n\r\n2\n", b"3"))
+
+    assert await collect(rows) == [b"1", b"2", b"3"]
+
+
+async def test_ndjson_rejects_a_line_longer_than_the_limit() -> None:
+    rows = iter_ndjson_rows(stream(b"1\n", b"x" * MAX_ROW_BYTES, b"x\n2\n"))
+
+    with pytest.raises(ClientException, match="exceeds the maximum size"):
+        await collect(rows)
+
+
+async def test_ndjson_rejects_an_over_long_line_within_one_chunk() -> None:
+    rows = iter_ndjson_rows(stream(b"x" * (MAX_ROW_BYTES + 1) + b"\n2\n"))
+
+    with pytest.raises(ClientException):
+        await collect(rows)
+
+
+def test_recipient_variables_override_the_campaign_variables() -> None:
+    campaign = CampaignInput(
+        subject="News",
+        templateVariables={"headline": "Hello", "body": "Shared body"},
+    )
+    recipient = parse_recipient(b'{"email": "a@x.com", "variables": {"headline": "Hi A"}}')
+
+    email = campaign_payload(campaign, recipient)
+
+    assert email.to == ["a@x.com"]
+    assert email.template_variables.headline == "Hi A"
+    assert email.template_variables.body == "Shared body"
+
+
+class Campaigns:
+    """A campaign runner over memory backends with room for ``capacity`` campaign messages."""
+
+    def __init__(self, tmp_path: Path, capacity: int = 2, **overrides: object) -> None:
+        queue_settings = QueueSettings(queue_max_size=capacity * 2)
+        self.settings = CampaignSettings(
+            **{
+                "campaign_queue_share": 0.5,
+                "campaign_chunk_size": 2,
+                "campaign_poll_interval": 0.01,
+                "campaign_spool_dir": str(tmp_path),
+                **overrides,
+            }
+        )
+        self.store = MemoryCampaignStore(self.settings)
+        self.outbox = MemoryOutbox(queue_settings)
+        self.runner = CampaignRunner(self.store, self.outbox, queue_settings, self.settings)
+
+    async def create(self) -> Campaign:
+        campaign = new_campaign(
+            CampaignInput(subject="News", templateVariables={"headline": "Hi", "body": "Body"})
+        )
+        await self.store.create(campaign)
+        return campaign
+
+    async def drain(self) -> list[OutboxMessage]:
+        messages = await self.outbox.receive(count=100, timeout=0.01)
+        await self.outbox.ack_many(messages)
+        return messages
+
+    async def status(self, campaign_id: str) -> str | None:
+        return await self.store.status(campaign_id)
+
+    async def queued(self) -> bool:
+        return await self.outbox.depth() > 0
+
+
+async def rows(*emails: str) -> AsyncIterator[dict[str, Any]]:
+    for email in emails:
+        yield {"email": email}
+
+
+async def test_campaign_is_queued_no_faster_than_its_share_of_the_queue(
+    tmp_path: Path,
+) -> None:
+    campaigns = Campaigns(tmp_path)
+    campaign = await campaigns.create()
+    emails = [f"r{i}@x.com" for i in range(5)]
+
+    ingested = await campaigns.runner.ingest(campaign, rows(*emails))
+    assert (ingested.status, ingested.recipients) == ("running", 5)
+
+    queued: list[OutboxMessage] = []
+    while len(queued) < len(emails):
+        await asyncio.sleep(0.05)
+        assert await campaigns.outbox.depth() <= 2
+        queued += await campaigns.drain()
+
+    assert [m.payload.to[0] for m in queued] == emails
+    assert {m.campaign_id for m in queued} == {campaign.id}
+
+    async def finished() -> bool:
+        return await campaigns.status(campaign.id) == "finished"
+
+    await eventually(finished)
+    stored = await campaigns.store.get(campaign.id)
+    assert stored is not None and stored.queued == 5
+    assert list(tmp_path.iterdir()) == []
+
+
+async def test_paused_campaign_queues_nothing_until_resumed(tmp_path: Path) -> None:
+    campaigns = Campaigns(tmp_path, capacity=1)
+    campaign = await campaigns.create()
+    await campaigns.runner.ingest(campaign, rows("a@x.com", "b@x.com"))
+    await eventually(campaigns.queued)
+
+    await campaigns.store.transition(campaign.id, {"running"}, "paused")
+    assert len(await campaigns.drain()) == 1
+    await asyncio.sleep(0.05)
+    assert await campaigns.outbox.depth() == 0
+
+    await campaigns.store.transition(campaign.id, {"paused"}, "running")
+    await eventually(campaigns.queued)
+    [message] = await campaigns.drain()
+    assert message.payload.to == ["b@x.com"]
+    await campaigns.runner.close()
+
+
+async def test_invalid_rows_are_rejected_with_their_errors(tmp_path: Path) -> None:
+    campaigns = Campaigns(tmp_path)
+    campaign = await campaigns.create()
+
+    ingested = await campaigns.runner.ingest(
+        campaign, rows("a@x.com", "not-an-address", "b@x.com")
+    )
+
+    assert (ingested.recipients, ingested.rejected) == (2, 1)
+    [error] = ingested.errors
+    assert error.row == 2
+    await campaigns.runner.close()
+
+
+async def test_recipients_can_only_be_uploaded_once(tmp_path: Path) -> None:
+    campaigns = Campaigns(tmp_path)
+    campaign = await campaigns.create()
+    await campaigns.runner.ingest(campaign, rows("a@x.com"))
+
+    with pytest.raises(ClientException) as error:
+        await campaigns.runner.ingest(campaign, rows("b@x.com"))
+
+    assert error.value.status_code == 409
+    await campaigns.runner.close()
+
+
+@pytest.mark.parametrize(
+    ("emails", "detail"),
+    [((), "empty"), (("a@x.com", "b@x.com", "c@x.com"), "maximum of 2 rows")],
+)
+async def test_rejected_upload_returns_the_campaign_to_draft(
+    tmp_path: Path, emails: tuple[str, ...], detail: str
+) -> None:
+    campaigns = Campaigns(tmp_path, campaign_max_recipients=2)
+    campaign = await campaigns.create()
+
+    with pytest.raises(ClientException, match=detail):
+        await campaigns.runner.ingest(campaign, rows(*emails))
+
+    assert await campaigns.status(campaign.id) == "draft"
+    assert list(tmp_path.iterdir()) == []
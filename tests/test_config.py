@@ -0,0 +1,16 @@
+"""Settings validation."""
+
+import pytest
+from pydantic import ValidationError
+
+from config import SecuritySettings
+
+
+def test_csrf_requires_a_secret() -> None:
+    with pytest.raises(ValidationError, match="CSRF_SECRET must be set"):
+        SecuritySettings(enable_csrf=True, csrf_secret=None)
+
+
+def test_csrf_secret_is_optional_without_csrf() -> None:
+    assert SecuritySettings(enable_csrf=False, csrf_secret=None).csrf_secret is None
+    assert SecuritySettings(enable_csrf=True, csrf_secret="s3cret").enable_csrf
@@ -0,0 +1,161 @@
+"""Digest coalescing: which notifications are held, and when they are acknowledged."""
+
+import pytest
+
+from config import DigestSettings, QueueSettings
+from digest import DIGEST_TEMPLATE, DigestCoalescer
+from outbox import MemoryOutbox, OutboxMessage
+from support import eventually, payload
+
+pytestmark = pytest.mark.anyio
+
+
+class Digests:
+    """A coalescer over a memory outbox whose ``deliver`` records what it is given.
+
+    ``depth_at_delivery`` is the outbox depth seen by each delivery, to check
+    that held notifications are still unacknowledged while their digest is sent.
+    """
+
+    def __init__(self, delivered: bool = True, **overrides: object) -> None:
+        self.settings = DigestSettings(**{"digest_window": 0.05, **overrides})
+        self.outbox = MemoryOutbox(QueueSettings())
+        self.delivered = delivered
+        self.deliveries: list[OutboxMessage] = []
+        self.depth_at_delivery: list[int] = []
+        self.held: list[OutboxMessage] = []
+        self.coalescer = DigestCoalescer(
+            self.settings, QueueSettings(), self.outbox, self.deliver, self.on_hold
+        )
+
+    async def deliver(self, message: OutboxMessage) -> bool:
+        self.deliveries.append(message)
+        self.depth_at_delivery.append(await self.outbox.depth())
+        return self.delivered
+
+    async def on_hold(self, message: OutboxMessage) -> None:
+        self.held.append(message)
+
+    async def receive(self, *messages: OutboxMessage) -> list[OutboxMessage]:
+        """Queue and receive ``messages``, as a worker would before offering them."""
+        for message in messages:
+            await self.outbox.enqueue(message)
+        return await self.outbox.receive(count=len(messages), timeout=0.1)
+
+
+def notification(to: str = "a@x.com", **fields: object) -> OutboxMessage:
+    return OutboxMessage(payload=payload(to=[to], **fields))
+
+
+async def test_burst_is_sent_as_one_digest_then_acknowledged() -> None:
+    digests = Digests()
+    first, second, third = await digests.receive(
+        notification(subject="One"), notification(subject="Two"), notification(subject="Three")
+    )
+
+    assert not await digests.coalescer.hold(first)
+    assert await digests.coalescer.hold(second)
+    assert await digests.coalescer.hold(third)
+    assert digests.held == [second, third]
+
+    await eventually(lambda: len(digests.deliveries) == 1)
+    [digest] = digests.deliveries
+    assert digest.members == [second.id, third.id]
+    assert digest.payload.template == DIGEST_TEMPLATE
+    assert digest.payload.to == ["a@x.com"]
+    assert [item.subject for item in digest.payload.template_variables.items] == [
+        "Two",
+        "Three",
+    ]
+    # All three were unacknowledged when the digest was delivered; only the
+    # first, left to the worker, is afterwards.
+    assert digests.depth_at_delivery == [3]
+
+    async def acknowledged() -> bool:
+        return await digests.outbox.depth() == 1
+
+    await eventually(acknowledged)
+
+
+async def test_held_notifications_stay_unacknowledged_when_delivery_fails() -> None:
+    digests = Digests(delivered=False)
+    first, second, third = await digests.receive(
+        notification(), notification(), notification()
+    )
+    for message in (first, second, third):
+        await digests.coalescer.hold(message)
+
+    await eventually(lambda: len(digests.deliveries) == 1)
+    await digests.coalescer.close()
+    assert await digests.outbox.depth() == 3
+
+
+async def test_single_held_notification_is_delivered_unchanged() -> None:
+    digests = Digests()
+    first, second = await digests.receive(notification(), notification())
+    await digests.coalescer.hold(first)
+    await digests.coalescer.hold(second)
+
+    await eventually(lambda: len(digests.deliveries) == 1)
+    assert digests.deliveries == [second]
+
+
+async def test_full_window_is_flushed_early() -> None:
+    digests = Digests(digest_window=60.0, digest_max_items=2)
+    messages = await digests.receive(*(notification() for _ in range(3)))
+    for message in messages:
+        await digests.coalescer.hold(message)
+
+    await eventually(lambda: len(digests.deliveries) == 1)
+    assert digests.deliveries[0].members == [messages[1].id, messages[2].id]
+    await digests.coalescer.close()
+
+
+async def test_close_sends_open_windows() -> None:
+    digests = Digests(digest_window=60.0)
+    first, second = await digests.receive(notification(), notification())
+    await digests.coalescer.hold(first)
+    await digests.coalescer.hold(second)
+
+    await digests.coalescer.close()
+
+    assert digests.deliveries == [second]
+    assert await digests.outbox.depth() == 1
+
+
+async def test_windows_are_kept_per_recipient() -> None:
+    digests = Digests(digest_window=60.0)
+    a, b = await digests.receive(notification("a@x.com"), notification("B@x.com"))
+
+    assert not await digests.coalescer.hold(a)
+    assert not await digests.coalescer.hold(b)
+    assert await digests.coalescer.hold(notification("b@x.com"))
+    await digests.coalescer.close()
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        OutboxMessage(payload=payload(to=["a@x.com", "b@x.com"])),
+        OutboxMessage(payload=payload(to=["a@x.com"]), campaign_id="c1"),
+        OutboxMessage(
+            payload=payload(
+                to=["a@x.com"], recipientVariables={"a@x.com": {"headline": "Hi"}}
+            )
+        ),
+    ],
+    ids=["several-recipients", "campaign", "recipient-variables"],
+)
+async def test_is_not_coalesced(message: OutboxMessage) -> None:
+    digests = Digests(digest_window=60.0)
+
+    assert not await digests.coalescer.hold(message)
+    assert not await digests.coalescer.hold(message)
+    await digests.coalescer.close()
+
+
+async def test_disabled_without_a_window() -> None:
+    digests = Digests(digest_window=0)
+
+    assert not await digests.coalescer.hold(notification())
+    assert not await digests.coalescer.hold(notification())
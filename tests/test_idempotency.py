@@ -0,0 +1,147 @@
+"""Idempotency keys: reservation, replay, conflicts and release after a failure."""
+
+import asyncio
+from collections.abc import AsyncIterator
+
+import httpx
+import pytest
+from litestar import Litestar, Request, post
+from litestar.types import ASGIApp, Receive, Scope, Send
+
+from idempotency import (
+    IDEMPOTENCY_HEADER,
+    REPLAYED_HEADER,
+    STORE_NAME,
+    MemoryIdempotencyStore,
+    release_reservation,
+    replay_stored_response,
+    store_response,
+)
+from schemas import SuccessResponse
+
+pytestmark = pytest.mark.anyio
+
+
+class Handler:
+    """Counts the requests it handles; ``gate`` holds them, ``fail`` makes them raise."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.gate: asyncio.Event | None = None
+        self.entered = asyncio.Event()
+        self.fail = False
+
+    async def __call__(self, request: Request) -> SuccessResponse:
+        self.calls += 1
+        self.entered.set()
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("Handler failed")
+        content = SuccessResponse(message="Sent", id=str(self.calls))
+        await store_response(request, 201, content)
+        return content
+
+
+def authenticated(app: ASGIApp) -> ASGIApp:
+    """Stands in for the API key middleware, which sets the key name as ``auth``."""
+
+    async def middleware(scope: Scope, receive: Receive, send: Send) -> None:
+        scope["auth"] = "default"
+        await app(scope, receive, send)
+
+    return middleware
+
+
+@pytest.fixture
+def handler() -> Handler:
+    return Handler()
+
+
+@pytest.fixture
+async def client(handler: Handler) -> AsyncIterator[httpx.AsyncClient]:
+    @post("/send", before_request=replay_stored_response)
+    async def send(request: Request) -> SuccessResponse:
+        return await handler(request)
+
+    app = Litestar(
+        [send],
+        stores={STORE_NAME: MemoryIdempotencyStore()},
+        after_exception=[release_reservation],
+        middleware=[authenticated],
+    )
+    # Served in the test's event loop, so that requests can overlap.
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        yield client
+
+
+async def test_repeated_key_replays_the_first_response(
+    client: httpx.AsyncClient, handler: Handler
+) -> None:
+    headers = {IDEMPOTENCY_HEADER: "k1"}
+    first = await client.post("/send", json={"a": 1}, headers=headers)
+    second = await client.post("/send", json={"a": 1}, headers=headers)
+
+    assert first.status_code == second.status_code == 201
+    assert second.json() == first.json()
+    assert second.headers[REPLAYED_HEADER] == "true"
+    assert REPLAYED_HEADER not in first.headers
+    assert handler.calls == 1
+
+
+async def test_key_reused_with_another_body_is_rejected(
+    client: httpx.AsyncClient, handler: Handler
+) -> None:
+    headers = {IDEMPOTENCY_HEADER: "k1"}
+    await client.post("/send", json={"a": 1}, headers=headers)
+    response = await client.post("/send", json={"a": 2}, headers=headers)
+
+    assert response.status_code == 422
+    assert handler.calls == 1
+
+
+async def test_key_in_use_by_a_request_in_progress_conflicts(
+    client: httpx.AsyncClient, handler: Handler
+) -> None:
+    handler.gate = asyncio.Event()
+    headers = {IDEMPOTENCY_HEADER: "k1"}
+    first = asyncio.create_task(client.post("/send", json={"a": 1}, headers=headers))
+    await handler.entered.wait()
+
+    conflict = await client.post("/send", json={"a": 1}, headers=headers)
+    handler.gate.set()
+
+    assert conflict.status_code == 409
+    assert conflict.headers["Retry-After"] == "1"
+    assert (await first).status_code == 201
+    assert handler.calls == 1
+
+
+async def test_key_is_released_when_the_request_fails(
+    client: httpx.AsyncClient, handler: Handler
+) -> None:
+    headers = {IDEMPOTENCY_HEADER: "k1"}
+    handler.fail = True
+    assert (await client.post("/send", json={"a": 1}, headers=headers)).status_code == 500
+
+    handler.fail = False
+    retry = await client.post("/send", json={"a": 1}, headers=headers)
+
+    assert retry.status_code == 201
+    assert REPLAYED_HEADER not in retry.headers
+    assert handler.calls == 2
+
+
+async def test_keys_must_not_be_too_long(client: httpx.AsyncClient) -> None:
+    response = await client.post("/send", json={}, headers={IDEMPOTENCY_HEADER: "k" * 256})
+
+    assert response.status_code == 400
+
+
+async def test_memory_store_add_only_sets_absent_keys() -> None:
+    store = MemoryIdempotencyStore()
+
+    assert await store.add("key", "first", expires_in=60)
+    assert not await store.add("key", "second", expires_in=60)
+    assert await store.get("key") == b"first"
@@ -0,0 +1,184 @@
+"""Memory outbox: capacity, at-least-once acknowledgement and reclaim; worker pool."""
+
+from collections.abc import Awaitable, Callable
+
+import pytest
+from aiosmtplib import SMTPResponseException
+
+from config import QueueSettings
+from outbox import MemoryOutbox, OutboxMessage, OutboxWorkerPool, QueueFullError
+from sender import DeliveryError, FailedDelivery
+from support import ScriptedSender, eventually, payload
+
+pytestmark = pytest.mark.anyio
+
+
+def outbox_is_empty(outbox: MemoryOutbox) -> Callable[[], Awaitable[bool]]:
+    async def check() -> bool:
+        return await outbox.depth() == 0
+
+    return check
+
+
+def queue_settings(**overrides: object) -> QueueSettings:
+    defaults = {
+        "queue_workers": 1,
+        "queue_poll_timeout": 0.01,
+        "queue_claim_idle_after": 60.0,
+        "queue_shutdown_timeout": 1.0,
+    }
+    return QueueSettings(**{**defaults, **overrides})
+
+
+async def test_rejects_messages_past_max_size() -> None:
+    outbox = MemoryOutbox(queue_settings(queue_max_size=2))
+    await outbox.enqueue(OutboxMessage(payload=payload()))
+    await outbox.enqueue(OutboxMessage(payload=payload()))
+
+    with pytest.raises(QueueFullError):
+        await outbox.enqueue(OutboxMessage(payload=payload()))
+    assert await outbox.enqueue_many([OutboxMessage(payload=payload())]) == 0
+
+
+async def test_enqueue_many_accepts_what_fits() -> None:
+    outbox = MemoryOutbox(queue_settings(queue_max_size=3))
+    messages = [OutboxMessage(payload=payload()) for _ in range(5)]
+
+    assert await outbox.enqueue_many(messages) == 3
+    assert await outbox.depth() == 3
+
+
+async def test_received_messages_count_until_acknowledged() -> None:
+    outbox = MemoryOutbox(queue_settings())
+    await outbox.enqueue(OutboxMessage(payload=payload()))
+
+    [message] = await outbox.receive(count=10, timeout=0.1)
+    assert await outbox.depth() == 1
+    assert await outbox.receive(count=10, timeout=0.01) == []
+
+    await outbox.ack(message)
+    assert await outbox.depth() == 0
+
+
+async def test_unacknowledged_messages_are_redelivered() -> None:
+    outbox = MemoryOutbox(queue_settings(queue_claim_idle_after=0))
+    await outbox.enqueue(OutboxMessage(payload=payload()))
+
+    [first] = await outbox.receive(count=1, timeout=0.1)
+    [again] = await outbox.receive(count=1, timeout=0.1)
+
+    assert again.id == first.id
+    assert again.deliveries == 2
+
+
+async def test_pool_acknowledges_delivered_messages() -> None:
+    outbox = MemoryOutbox(queue_settings())
+    sender = ScriptedSender()
+    delivered: list[str] = []
+
+    async def on_delivered(message: OutboxMessage) -> None:
+        delivered.append(message.id)
+
+    async def on_failure(message: OutboxMessage, error: DeliveryError) -> None:
+        raise AssertionError("unexpected failure")
+
+    pool = OutboxWorkerPool(
+        outbox, sender, queue_settings(), on_failure=on_failure, on_delivered=on_delivered
+    )
+    message = OutboxMessage(payload=payload())
+    await outbox.enqueue(message)
+    await pool.start()
+    try:
+        await eventually(lambda: delivered == [message.id])
+        await eventually(outbox_is_empty(outbox))
+    finally:
+        await pool.close()
+    assert len(sender.sent) == 1
+
+
+async def test_pool_hands_delivery_errors_to_on_failure_and_acknowledges() -> None:
+    outbox = MemoryOutbox(queue_settings())
+    error = DeliveryError([FailedDelivery(["a@x.com"], SMTPResponseException(550, "No"))])
+    failures: list[DeliveryError] = []
+
+    async def on_failure(message: OutboxMessage, error: DeliveryError) -> None:
+        failures.append(error)
+
+    pool = OutboxWorkerPool(outbox, ScriptedSender(error), queue_settings(), on_failure)
+    await outbox.enqueue(OutboxMessage(payload=payload(to=["a@x.com"])))
+    await pool.start()
+    try:
+        await eventually(lambda: failures == [error])
+        await eventually(outbox_is_empty(outbox))
+    finally:
+        await pool.close()
+
+
+async def test_pool_leaves_message_unacknowledged_when_on_failure_raises() -> None:
+    outbox = MemoryOutbox(queue_settings())
+    error = DeliveryError([FailedDelivery(["a@x.com"], SMTPResponseException(451, "Later"))])
+    calls = 0
+
+    async def on_failure(message: OutboxMessage, error: DeliveryError) -> None:
+        nonlocal calls
+        calls += 1
+        raise RuntimeError("scheduler unavailable")
+
+    pool = OutboxWorkerPool(outbox, ScriptedSender(error), queue_settings(), on_failure)
+    await outbox.enqueue(OutboxMessage(payload=payload(to=["a@x.com"])))
+    await pool.start()
+    try:
+        await eventually(lambda: calls == 1)
+    finally:
+        await pool.close()
+    assert await outbox.depth() == 1
+
+
+async def test_pool_dead_letters_a_message_that_keeps_failing_unexpectedly() -> None:
+    settings = queue_settings(queue_claim_idle_after=0, queue_max_deliveries=3)
+    outbox = MemoryOutbox(settings)
+    sender = ScriptedSender(*(RuntimeError("template bug") for _ in range(10)))
+    failures: list[DeliveryError] = []
+
+    async def on_failure(message: OutboxMessage, error: DeliveryError) -> None:
+        failures.append(error)
+
+    pool = OutboxWorkerPool(outbox, sender, settings, on_failure)
+    await outbox.enqueue(OutboxMessage(payload=payload(to=["a@x.com"])))
+    await pool.start()
+    try:
+        await eventually(lambda: len(failures) == 1)
+        await eventually(outbox_is_empty(outbox))
+    finally:
+        await pool.close()
+
+    assert sender.attempts == 3
+    [failure] = failures[0].failures
+    assert failure.recipients == ["a@x.com"]
+    assert type(failure.error).__name__ == "UndeliverableError"
+
+
+async def test_pool_leaves_held_messages_to_their_taker() -> None:
+    outbox = MemoryOutbox(queue_settings())
+    sender = ScriptedSender()
+    held: list[OutboxMessage] = []
+
+    async def coalesce(message: OutboxMessage) -> bool:
+        held.append(message)
+        return True
+
+    async def on_failure(message: OutboxMessage, error: DeliveryError) -> None:
+        raise AssertionError("unexpected failure")
+
+    pool = OutboxWorkerPool(outbox, sender, queue_settings(), on_failure, coalesce=coalesce)
+    await outbox.enqueue(OutboxMessage(payload=payload()))
+    await pool.start()
+    try:
+        await eventually(lambda: len(held) == 1)
+    finally:
+        await pool.close()
+
+    assert sender.sent == []
+    assert await outbox.depth() == 1
+    assert await pool.deliver(held[0])
+    assert len(sender.sent) == 1
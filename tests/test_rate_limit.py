@@ -0,0 +1,120 @@
+"""GCRA arithmetic, the memory bucket store and local token batches."""
+
+import asyncio
+
+import pytest
+
+from config import SecuritySettings
+from rate_limit import MemoryRateLimitStore, Quota, RateLimiter, _gcra
+
+pytestmark = pytest.mark.anyio
+
+
+def test_gcra_full_bucket_grants_a_whole_window() -> None:
+    granted, retry_after, tat = _gcra(tat=0.0, now=100.0, interval=0.5, window=10.0, count=50)
+
+    assert (granted, retry_after, tat) == (20, 0.0, 110.0)
+
+
+def test_gcra_empty_bucket_waits_for_the_next_token() -> None:
+    granted, retry_after, tat = _gcra(tat=110.0, now=100.0, interval=0.5, window=10.0, count=1)
+
+    assert granted == 0
+    assert retry_after == pytest.approx(0.5)
+    assert tat == 110.0
+
+
+def test_gcra_emits_one_token_per_interval() -> None:
+    granted, _, tat = _gcra(tat=110.0, now=101.2, interval=0.5, window=10.0, count=5)
+
+    assert (granted, tat) == (2, 111.0)
+
+
+def test_gcra_grants_no_more_than_asked() -> None:
+    granted, _, tat = _gcra(tat=0.0, now=100.0, interval=0.5, window=10.0, count=3)
+
+    assert (granted, tat) == (3, 101.5)
+
+
+async def test_memory_store_keeps_buckets_apart() -> None:
+    store = MemoryRateLimitStore()
+
+    assert await store.acquire("a", 1.0, 3.0, 5) == (3, 0.0)
+    granted, retry_after = await store.acquire("a", 1.0, 3.0, 1)
+    assert granted == 0 and 0 < retry_after <= 1.0
+    assert await store.acquire("b", 1.0, 3.0, 5) == (3, 0.0)
+
+
+class CountingStore(MemoryRateLimitStore):
+    """Records the number of tokens each call to the store asks for."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.requested: list[int] = []
+
+    async def acquire(
+        self, bucket: str, interval: float, window: float, count: int
+    ) -> tuple[int, float]:
+        self.requested.append(count)
+        return await super().acquire(bucket, interval, window, count)
+
+
+def limiter(store: CountingStore, **overrides: object) -> RateLimiter:
+    security = SecuritySettings(
+        **{
+            "rate_limit_requests": 100,
+            "rate_limit_window": "minute",
+            "rate_limit_local_share": 0.1,
+            **overrides,
+        }
+    )
+    return RateLimiter(store, security)
+
+
+async def test_local_batches_grow_up_to_the_share_of_the_quota() -> None:
+    store = CountingStore()
+    rate_limiter = limiter(store)
+
+    for _ in range(40):
+        assert await rate_limiter.hit(Quota("key:a", 100)) is None
+
+    assert store.requested == [2, 4, 8, 10, 10, 10]
+
+
+async def test_quota_is_never_exceeded_by_local_tokens() -> None:
+    store = CountingStore()
+    rate_limiter = limiter(store)
+
+    results = [await rate_limiter.hit(Quota("key:a", 100)) for _ in range(150)]
+
+    assert results.count(None) == 100
+    assert all(0 < retry_after <= 0.6 for retry_after in results[100:])
+    # Limited requests are answered locally until the next token is due.
+    assert len(store.requested) < 20
+
+
+async def test_unused_local_tokens_halve_the_next_batch() -> None:
+    store = CountingStore()
+    # Tokens may be spent locally for 50 ms.
+    rate_limiter = limiter(store, rate_limit_window="second", rate_limit_local_share=0.05)
+    quota = Quota("key:a", 1000)
+
+    for _ in range(7):
+        await rate_limiter.hit(quota)
+    assert store.requested == [2, 4, 8]
+
+    await asyncio.sleep(0.06)
+    await rate_limiter.hit(quota)
+    assert store.requested[-1] == 4
+
+
+async def test_unreachable_store_lets_requests_through() -> None:
+    class FailingStore(CountingStore):
+        async def acquire(
+            self, bucket: str, interval: float, window: float, count: int
+        ) -> tuple[int, float]:
+            raise ConnectionError("Store down")
+
+    rate_limiter = limiter(FailingStore())
+
+    assert await rate_limiter.hit(Quota("key:a", 100)) is None
@@ -0,0 +1,157 @@
+"""Retry classification, backoff and dead-lettering."""
+
+import pytest
+from aiosmtplib import SMTPConnectError, SMTPResponseException, SMTPServerDisconnected
+from litestar.stores.memory import MemoryStore
+
+from config import QueueSettings, RetrySettings
+from dead_letters import DeadLetterStore
+from outbox import MemoryOutbox, OutboxMessage, UndeliverableError
+from retry import RetryScheduler, is_transient
+from scheduler import MemoryScheduler
+from sender import DeliveryError, FailedDelivery
+from support import payload
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize(
+    ("error", "transient"),
+    [
+        (SMTPResponseException(451, "Try again later"), True),
+        (SMTPResponseException(421, "Service not available"), True),
+        (SMTPResponseException(550, "No such user"), False),
+        (SMTPResponseException(554, "Rejected"), False),
+        (SMTPServerDisconnected("Connection lost"), True),
+        (SMTPConnectError("Connection refused"), True),
+        (TimeoutError(), True),
+        (ConnectionResetError(), True),
+        (ValueError("Bad template"), False),
+        (UndeliverableError("Delivered 5 times"), False),
+    ],
+)
+def test_is_transient(error: Exception, transient: bool) -> None:
+    assert is_transient(error) is transient
+
+
+class Retries:
+    """A retry scheduler over memory backends, recording what it reschedules."""
+
+    def __init__(self, **overrides: object) -> None:
+        self.settings = RetrySettings(
+            **{"retry_base_delay": 10.0, "retry_jitter": 0.0, **overrides}
+        )
+        self.scheduler = MemoryScheduler(MemoryOutbox(QueueSettings()), QueueSettings())
+        self.dead_letters = DeadLetterStore(MemoryStore(), self.settings)
+        self.retried: list[tuple[OutboxMessage, float]] = []
+        self.dead_lettered: list[OutboxMessage] = []
+        self.retry = RetryScheduler(
+            self.scheduler,
+            self.dead_letters,
+            self.settings,
+            on_dead_letter=self.record_dead_letter,
+            on_retry=self.record_retry,
+        )
+
+    async def record_retry(
+        self, message: OutboxMessage, due: float, failures: list[FailedDelivery]
+    ) -> None:
+        self.retried.append((message, due))
+
+    async def record_dead_letter(
+        self, message: OutboxMessage, failures: list[FailedDelivery]
+    ) -> None:
+        self.dead_lettered.append(message)
+
+
+def failure(code: int, *recipients: str) -> FailedDelivery:
+    return FailedDelivery(list(recipients), SMTPResponseException(code, "Reply"))
+
+
+def test_backoff_doubles_up_to_the_maximum() -> None:
+    retries = Retries(retry_max_delay=50.0)
+
+    assert [retries.retry.backoff(attempt) for attempt in (1, 2, 3, 4)] == [
+        10.0,
+        20.0,
+        40.0,
+        50.0,
+    ]
+
+
+async def test_transient_failure_is_rescheduled_for_the_failed_recipients() -> None:
+    retries = Retries()
+    message = OutboxMessage(payload=payload(to=["a@x.com", "b@x.com"], cc=["c@x.com"]))
+
+    await retries.retry.handle_failure(message, DeliveryError([failure(451, "b@x.com")]))
+
+    [(retry, _)] = retries.retried
+    assert (retry.id, retry.attempt) == (message.id, 1)
+    assert (retry.payload.to, retry.payload.cc) == (["b@x.com"], [])
+    assert await retries.scheduler.pending() == 1
+    assert await retries.dead_letters.recent(10) == []
+
+
+async def test_permanent_failure_is_dead_lettered_without_retry() -> None:
+    retries = Retries()
+    message = OutboxMessage(payload=payload(to=["a@x.com", "b@x.com"]))
+
+    await retries.retry.handle_failure(message, DeliveryError([failure(550, "a@x.com")]))
+
+    [entry] = await retries.dead_letters.recent(10)
+    assert (entry.message_id, entry.reason, entry.attempts) == (
+        message.id,
+        "permanent_failure",
+        1,
+    )
+    assert entry.payload.to == ["a@x.com"]
+    assert "SMTPResponseException" in entry.error
+    assert retries.dead_lettered == [message]
+    assert await retries.scheduler.pending() == 0
+
+
+async def test_mixed_failure_splits_between_retry_and_dead_letter() -> None:
+    retries = Retries()
+    message = OutboxMessage(payload=payload(to=["a@x.com", "b@x.com", "c@x.com"]))
+
+    await retries.retry.handle_failure(
+        message, DeliveryError([failure(550, "a@x.com"), failure(451, "b@x.com")])
+    )
+
+    [entry] = await retries.dead_letters.recent(10)
+    assert entry.payload.to == ["a@x.com"]
+    [(retry, _)] = retries.retried
+    assert retry.payload.to == ["b@x.com"]
+
+
+async def test_last_attempt_is_dead_lettered_as_retries_exhausted() -> None:
+    retries = Retries(retry_max_attempts=3)
+    message = OutboxMessage(payload=payload(to=["a@x.com"]), attempt=2)
+
+    await retries.retry.handle_failure(message, DeliveryError([failure(451, "a@x.com")]))
+
+    [entry] = await retries.dead_letters.recent(10)
+    assert (entry.reason, entry.attempts) == ("retries_exhausted", 3)
+    assert retries.retried == []
+
+
+async def test_dead_letters_are_listed_newest_first_and_capped() -> None:
+    settings = RetrySettings(dead_letter_max_entries=2)
+    dead_letters = DeadLetterStore(MemoryStore(), settings)
+    ids = []
+    for message_id in ("m1", "m2", "m3"):
+        entry = await dead_letters.add(
+            message_id=message_id,
+            payload=payload(),
+            attempts=1,
+            reason="permanent_failure",
+            error="SMTPResponseException: 550",
+        )
+        ids.append(entry.id)
+
+    assert [e.message_id for e in await dead_letters.recent(10)] == ["m3", "m2"]
+    assert [e.message_id for e in await dead_letters.recent(1)] == ["m3"]
+
+    await dead_letters.delete(ids[2])
+    assert await dead_letters.get(ids[2]) is None
+    assert [e.message_id for e in await dead_letters.recent(10)] == ["m2"]
@@ -0,0 +1,132 @@
+"""Memory scheduler: due order, cancellation and the outbox size cap."""
+
+import asyncio
+import time
+
+import pytest
+
+from config import QueueSettings
+from outbox import MemoryOutbox, OutboxMessage
+from scheduler import MemoryScheduler
+from support import eventually, payload
+
+pytestmark = pytest.mark.anyio
+
+
+def queue_settings(**overrides: object) -> QueueSettings:
+    defaults = {"queue_scheduler_poll_interval": 0.2, "queue_poll_timeout": 0.01}
+    return QueueSettings(**{**defaults, **overrides})
+
+
+class CountingScheduler(MemoryScheduler):
+    def __init__(self, outbox: MemoryOutbox, queue_settings: QueueSettings) -> None:
+        super().__init__(outbox, queue_settings)
+        self.releases = 0
+
+    async def release_due(self) -> int:
+        self.releases += 1
+        return await super().release_due()
+
+
+def message(message_id: str) -> OutboxMessage:
+    return OutboxMessage(payload=payload(), id=message_id)
+
+
+async def drain(outbox: MemoryOutbox) -> list[str]:
+    ids = []
+    while messages := await outbox.receive(count=100, timeout=0.01):
+        ids += [m.id for m in messages]
+        await outbox.ack_many(messages)
+    return ids
+
+
+async def test_releases_due_messages_in_due_order() -> None:
+    settings = queue_settings()
+    outbox = MemoryOutbox(settings)
+    scheduler = MemoryScheduler(outbox, settings)
+    now = time.time()
+    await scheduler.schedule(message("late"), now - 1)
+    await scheduler.schedule(message("early"), now - 2)
+    await scheduler.schedule(message("future"), now + 3600)
+
+    assert await scheduler.release_due() == 2
+    assert await drain(outbox) == ["early", "late"]
+    assert await scheduler.pending() == 1
+
+
+async def test_rescheduling_replaces_the_held_message() -> None:
+    settings = queue_settings()
+    outbox = MemoryOutbox(settings)
+    scheduler = MemoryScheduler(outbox, settings)
+    await scheduler.schedule(message("m1"), time.time() - 1)
+    await scheduler.schedule(message("m1"), time.time() + 3600)
+
+    assert await scheduler.release_due() == 0
+    assert await scheduler.pending() == 1
+
+
+async def test_cancelled_messages_are_not_released() -> None:
+    settings = queue_settings()
+    outbox = MemoryOutbox(settings)
+    scheduler = MemoryScheduler(outbox, settings)
+    await scheduler.schedule(message("m1"), time.time() - 1)
+    await scheduler.schedule(message("m2"), time.time() - 1)
+
+    assert await scheduler.cancel("m1")
+    assert not await scheduler.cancel("m1")
+    assert not await scheduler.cancel("unknown")
+    assert await scheduler.release_due() == 1
+    assert await drain(outbox) == ["m2"]
+
+
+async def test_releases_only_what_fits_under_max_size() -> None:
+    settings = queue_settings(queue_max_size=2)
+    outbox = MemoryOutbox(settings)
+    scheduler = MemoryScheduler(outbox, settings)
+    await outbox.enqueue(message("queued"))
+    for message_id in ("m1", "m2", "m3"):
+        await scheduler.schedule(message(message_id), time.time() - 1)
+
+    assert await scheduler.release_due() == 1
+    assert await scheduler.pending() == 2
+    assert await drain(outbox) == ["queued", "m1"]
+
+    assert await scheduler.release_due() == 2
+    assert await drain(outbox) == ["m2", "m3"]
+
+
+async def test_waits_for_the_poll_interval_while_the_outbox_is_full() -> None:
+    settings = queue_settings(queue_max_size=1)
+    outbox = MemoryOutbox(settings)
+    scheduler = CountingScheduler(outbox, settings)
+    await outbox.enqueue(message("queued"))
+    await scheduler.schedule(message("due"), time.time() - 1)
+
+    await scheduler.start()
+    try:
+        await asyncio.sleep(0.1)
+        assert scheduler.releases == 1
+
+        assert await drain(outbox) == ["queued"]
+        await eventually(lambda: scheduler.releases == 2, timeout=1.0)
+        assert await drain(outbox) == ["due"]
+    finally:
+        await scheduler.close()
+
+
+async def test_wakes_up_for_a_message_due_before_the_next_poll() -> None:
+    settings = queue_settings(queue_scheduler_poll_interval=60.0)
+    outbox = MemoryOutbox(settings)
+    scheduler = MemoryScheduler(outbox, settings)
+
+    await scheduler.start()
+    try:
+        await asyncio.sleep(0.01)
+        await scheduler.schedule(message("soon"), time.time() + 0.05)
+
+        async def released() -> bool:
+            return await outbox.depth() == 1
+
+        await eventually(released, timeout=1.0)
+    finally:
+        await scheduler.close()
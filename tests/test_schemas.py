@@ -0,0 +1,28 @@
+"""Validation of notification payloads."""
+
+import pytest
+from pydantic import ValidationError
+
+from support import payload
+
+
+def test_recipient_variables_override_the_shared_variables() -> None:
+    email = payload(
+        to=["a@x.com", "b@x.com"],
+        recipientVariables={"a@x.com": {"headline": "Hello A"}},
+    )
+
+    variables = email.recipient_variables["a@x.com"]
+    assert variables.headline == "Hello A"
+    assert variables.body == email.template_variables.body
+
+
+@pytest.mark.parametrize("overrides", ["oops", ["headline"], None])
+def test_recipient_variables_must_be_objects(overrides: object) -> None:
+    with pytest.raises(ValidationError, match="must be an object"):
+        payload(to=["a@x.com"], recipientVariables={"a@x.com": overrides})
+
+
+def test_recipient_variables_must_name_recipients() -> None:
+    with pytest.raises(ValidationError, match="not recipients: b@x.com"):
+        payload(to=["a@x.com"], recipientVariables={"b@x.com": {"headline": "Hi"}})
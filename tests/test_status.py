@@ -0,0 +1,220 @@
+"""Delivery status transitions in the memory store, and merging of buffered updates."""
+
+import time
+from dataclasses import asdict
+
+import pytest
+from aiosmtplib import SMTPResponseException
+
+from config import StatusSettings
+from outbox import OutboxMessage
+from sender import FailedDelivery
+from status import MemoryStatusStore, _Record, _Update
+from support import payload
+
+pytestmark = pytest.mark.anyio
+
+
+def store(**overrides: object) -> MemoryStatusStore:
+    return MemoryStatusStore(StatusSettings(**overrides))
+
+
+def notification(*to: str) -> OutboxMessage:
+    return OutboxMessage(payload=payload(to=list(to or ["a@x.com"])))
+
+
+def failure(code: int, *recipients: str) -> list[FailedDelivery]:
+    return [FailedDelivery(list(recipients), SMTPResponseException(code, f"Reply {code}"))]
+
+
+async def test_accepted_notification_is_queued() -> None:
+    statuses = store()
+    message = notification("a@x.com", "b@x.com")
+
+    await statuses.accepted(message)
+
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.recipients, status.attempts) == ("queued", 2, 0)
+    assert status.queued_at is not None and status.next_attempt_at is None
+
+
+async def test_scheduled_notification_is_deferred_until_due() -> None:
+    statuses = store()
+    message = notification()
+    due = time.time() + 60
+
+    await statuses.accepted(message, due)
+
+    status = await statuses.get(message.id)
+    assert status is not None and status.status == "deferred"
+    assert status.next_attempt_at is not None
+    assert status.next_attempt_at.timestamp() == pytest.approx(due, abs=0.001)
+
+
+async def test_delivery_is_sending_then_sent() -> None:
+    statuses = store()
+    message = notification()
+    await statuses.accepted(message)
+
+    await statuses.sending(message)
+    status = await statuses.get(message.id)
+    assert status is not None and (status.status, status.attempts) == ("sending", 1)
+
+    await statuses.delivered(message)
+    status = await statuses.get(message.id)
+    assert status is not None and status.status == "sent"
+    assert status.sent_at is not None
+
+
+async def test_worker_ahead_of_the_api_is_not_overwritten() -> None:
+    statuses = store()
+    message = notification()
+
+    await statuses.sending(message)
+    await statuses.accepted(message)
+
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.recipients) == ("sending", 1)
+
+
+async def test_retry_then_dead_letter_records_the_last_reply() -> None:
+    statuses = store()
+    message = notification("a@x.com", "b@x.com")
+    await statuses.accepted(message)
+    await statuses.sending(message)
+
+    due = time.time() + 30
+    await statuses.retrying(message, due, failure(451, "a@x.com"))
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.smtp_code, status.smtp_response) == (
+        "deferred",
+        451,
+        "Reply 451",
+    )
+    assert status.next_attempt_at is not None
+
+    retry = OutboxMessage(payload=message.payload, id=message.id, attempt=1)
+    await statuses.sending(retry)
+    await statuses.dead_lettered(retry, failure(550, "a@x.com"))
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.attempts, status.failed_recipients) == ("failed", 2, 1)
+    assert (status.smtp_code, status.next_attempt_at) == (550, None)
+
+
+async def test_requeued_notification_forgets_its_failures() -> None:
+    statuses = store()
+    message = notification()
+    await statuses.accepted(message)
+    await statuses.dead_lettered(message, failure(550, "a@x.com"))
+
+    await statuses.requeued(message)
+
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.failed_recipients) == ("queued", 0)
+
+
+async def test_cancelled_notification() -> None:
+    statuses = store()
+    message = notification()
+    await statuses.accepted(message, time.time() + 60)
+
+    await statuses.cancelled(message.id)
+
+    status = await statuses.get(message.id)
+    assert status is not None
+    assert (status.status, status.next_attempt_at) == ("cancelled", None)
+
+
+async def test_coalesced_notifications_follow_their_digest() -> None:
+    statuses = store()
+    first, second = notification(), notification()
+    for message in (first, second):
+        await statuses.accepted(message)
+        await statuses.coalesced(message)
+    status = await statuses.get(first.id)
+    assert status is not None and status.status == "coalesced"
+
+    digest = OutboxMessage(payload=payload(), members=[first.id, second.id])
+    await statuses.sending(digest)
+    await statuses.delivered(digest)
+
+    found = await statuses.get_many([first.id, second.id, digest.id])
+    assert set(found) == {first.id, second.id}
+    assert {(s.status, s.digest_id) for s in found.values()} == {("sent", digest.id)}
+
+
+async def test_campaign_recipients_are_not_tracked() -> None:
+    statuses = store()
+    message = OutboxMessage(payload=payload(to=["a@x.com"]), campaign_id="c1")
+
+    await statuses.sending(message)
+    await statuses.delivered(message)
+
+    assert await statuses.get(message.id) is None
+
+
+async def test_least_recently_updated_records_are_dropped_past_the_limit() -> None:
+    statuses = store(status_max_entries=2)
+    first, second, third = notification(), notification(), notification()
+    for message in (first, second, third):
+        await statuses.accepted(message)
+
+    assert set(await statuses.get_many([first.id, second.id, third.id])) == {
+        second.id,
+        third.id,
+    }
+
+
+async def test_records_expire_after_their_last_update(monkeypatch: pytest.MonkeyPatch) -> None:
+    statuses = store(status_ttl=60)
+    message = notification()
+    await statuses.accepted(message)
+    now = time.time()
+
+    monkeypatch.setattr(time, "time", lambda: now + 59)
+    assert await statuses.get(message.id) is not None
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert await statuses.get(message.id) is None
+
+
+@pytest.mark.parametrize(
+    "updates",
+    [
+        [
+            _Update(defaults={"status": "queued", "recipients": 2, "queued": 1.0}),
+            _Update(fields={"status": "sending", "attempts": 1}),
+        ],
+        [
+            _Update(fields={"status": "sending", "attempts": 1}),
+            _Update(defaults={"status": "queued", "recipients": 2, "queued": 1.0}),
+        ],
+        [
+            _Update(fields={"status": "failed", "code": 550}, failed=1),
+            _Update(fields={"status": "queued", "failed": 0, "code": None}),
+            _Update(fields={"status": "failed"}, failed=2),
+        ],
+    ],
+    ids=["defaults-first", "fields-first", "failed-count-reset"],
+)
+def test_merged_updates_apply_like_updates_in_turn(updates: list[_Update]) -> None:
+    base = _Record(status="deferred", failed=1, code=451)
+    in_turn = _Record(**asdict(base))
+    for update in updates:
+        in_turn.apply(update)
+
+    merged = _Update(
+        fields=dict(updates[0].fields),
+        defaults=dict(updates[0].defaults),
+        failed=updates[0].failed,
+    )
+    for update in updates[1:]:
+        merged.merge(update)
+    at_once = _Record(**asdict(base))
+    at_once.apply(merged)
+
+    assert at_once == in_turn
@@ -0,0 +1,109 @@
+"""``strip_html`` must match ``bleach.clean(value, tags=[], strip=True)`` exactly.
+
+Its fast path skips bleach for values that look like plain text; these tests
+compare both on inputs chosen to sit on either side of that decision.
+"""
+
+import random
+
+import bleach
+import pytest
+
+from schemas import strip_html
+
+
+def bleach_clean(value: str) -> str:
+    return bleach.clean(value, tags=[], strip=True)
+
+
+CASES = [
+    "",
+    "plain text",
+    "a > b",
+    "Tom & Jerry",
+    "&",
+    "&&",
+    "a &b c",
+    "<",
+    "a < b",
+    "1 <2",
+    "<b>bold</b>",
+    "<script>alert(1)</script>",
+    '<a href="https://example.com" onclick="x()">link</a>',
+    "<!-- comment -->text",
+    "<!DOCTYPE html>",
+    "<br/>",
+    "</p>",
+    "&amp;",
+    "&lt;script&gt;",
+    "&nbsp;",
+    "&copy; 2026",
+    "&#65;&#x42;",
+    "&#0;",
+    "&unknown;",
+    "&amp",
+    "\x00",
+    "a\x01b",
+    "tab\tnewline\ncr\r",
+    "\x0b\x0c",
+    "\x1f",
+    "\x7f",
+    "\x80\x85\x9f",
+    "\ufeffbom",
+    "\ufffe\uffff",
+    "\U0001f600",
+    "café",
+    "日本語 <i>テキスト</i>",
+    "emoji 🎉 & more",
+    "Ω > α",
+    "\u200bzero width",
+    "\u2028line separator",
+]
+
+
+@pytest.mark.parametrize("value", CASES)
+def test_matches_bleach(value: str) -> None:
+    assert strip_html(value) == bleach_clean(value)
+
+
+# Characters mixing markup, references, controls, whitespace and non-ASCII,
+# so that random strings often start tags and entities.
+ALPHABET = (
+    "<>&;#/=\"' \t\n\r!-?"
+    "abcdefxyzABC0123456789"
+    "\x00\x01\x08\x0b\x0c\x1b\x1f\x7f\x80\x9f"
+    "\xe9\xa0\u65e5\U0001f389\u200b\u2028\ufeff\ufffd"
+)
+SNIPPETS = ["<b>", "</b>", "<a href='x'>", "&amp;", "&lt;", "&#", "&#x", "<!--", "-->", "<br/>"]
+
+
+def random_strings(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    values = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 12)):
+            if rng.random() < 0.2:
+                parts.append(rng.choice(SNIPPETS))
+            else:
+                parts.append("".join(rng.choices(ALPHABET, k=rng.randint(1, 6))))
+        values.append("".join(parts))
+    return values
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_random_strings_match_bleach(seed: int) -> None:
+    for value in random_strings(200, seed):
+        assert strip_html(value) == bleach_clean(value), repr(value)
+
+
+def test_long_values_match_bleach() -> None:
+    """Values past SANITIZE_CACHE_MAX_LENGTH take the uncached path."""
+    for value in random_strings(20, seed=1000):
+        long_value = value * 50 + "<i>x</i> & y"
+        assert strip_html(long_value) == bleach_clean(long_value)
+
+
+def test_cached_result_is_stable() -> None:
+    value = "<b>Hello</b> & welcome"
+    assert strip_html(value) == strip_html(value) == bleach_clean(value)
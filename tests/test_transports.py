@@ -0,0 +1,136 @@
+"""HTTP provider and local mailbox transports."""
+
+import asyncio
+import functools
+import json
+from collections.abc import AsyncIterator, Callable
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+from aiosmtplib import SMTPResponseException
+
+from config import TransportSettings
+from transports import FileTransport, HTTPTransport
+
+pytestmark = pytest.mark.anyio
+
+MESSAGE = b"Subject: Hello\nTo: a@x.com\n\nFirst line\nSecond line\n"
+
+Provider = Callable[[httpx.Request], httpx.Response]
+HTTPFactory = Callable[[Provider], HTTPTransport]
+
+
+@pytest.fixture
+async def http(monkeypatch: pytest.MonkeyPatch) -> AsyncIterator[HTTPFactory]:
+    """Returns an HTTP transport, batching two messages, served by a mock provider."""
+    transports: list[HTTPTransport] = []
+
+    def create(provider: Provider) -> HTTPTransport:
+        monkeypatch.setattr(
+            httpx,
+            "AsyncClient",
+            functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(provider)),
+        )
+        transport = HTTPTransport(
+            TransportSettings(
+                transport_http_url="http://provider.test/send",
+                transport_http_batch_size=2,
+                transport_http_linger=0.01,
+            )
+        )
+        transports.append(transport)
+        return transport
+
+    yield create
+    for transport in transports:
+        await transport.close()
+
+
+async def send_two(transport: HTTPTransport) -> list[BaseException | None]:
+    await transport.start()
+    results = await asyncio.wait_for(
+        asyncio.gather(
+            transport.send("from@x.com", ["a@x.com"], MESSAGE),
+            transport.send("from@x.com", ["b@x.com"], MESSAGE),
+            return_exceptions=True,
+        ),
+        timeout=2.0,
+    )
+    return [None if result == {} else result for result in results]
+
+
+def smtp_codes(results: list[BaseException | None]) -> list[int | None]:
+    return [
+        result.code if isinstance(result, SMTPResponseException) else result
+        for result in results
+    ]
+
+
+async def test_http_posts_a_batch_accepted_as_a_whole(http: HTTPFactory) -> None:
+    requests: list[dict[str, Any]] = []
+
+    def provider(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        return httpx.Response(202)
+
+    assert await send_two(http(provider)) == [None, None]
+    [body] = requests
+    assert [message["to"] for message in body["messages"]] == [["a@x.com"], ["b@x.com"]]
+
+
+async def test_http_results_accept_or_reject_each_message(http: HTTPFactory) -> None:
+    def provider(request: httpx.Request) -> httpx.Response:
+        results = [{"status": 202}, {"status": 400, "error": "Invalid address"}]
+        return httpx.Response(200, json={"results": results})
+
+    assert smtp_codes(await send_two(http(provider))) == [None, 550]
+
+
+async def test_http_malformed_results_fail_temporarily(http: HTTPFactory) -> None:
+    def provider(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"results": ["sent", {"status": "ok"}]})
+
+    assert smtp_codes(await send_two(http(provider))) == [451, 451]
+
+
+@pytest.mark.parametrize(("status", "code"), [(429, 451), (503, 451), (401, 550)])
+async def test_http_error_status_fails_the_batch(
+    http: HTTPFactory, status: int, code: int
+) -> None:
+    def provider(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(status, text="Nope")
+
+    assert smtp_codes(await send_two(http(provider))) == [code, code]
+
+
+async def test_http_unreachable_provider_is_a_connection_error(http: HTTPFactory) -> None:
+    def provider(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("Connection refused")
+
+    results = await send_two(http(provider))
+
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+async def test_http_unexpected_error_still_settles_every_message(http: HTTPFactory) -> None:
+    def provider(request: httpx.Request) -> httpx.Response:
+        raise RuntimeError("Unexpected")
+
+    assert smtp_codes(await send_two(http(provider))) == [451, 451]
+
+
+@pytest.mark.parametrize("file_format", ["maildir", "mbox"])
+async def test_file_transport_writes_line_feeds_only(tmp_path: Path, file_format: str) -> None:
+    path = tmp_path / "outbox"
+    transport = FileTransport(path, file_format)
+    await transport.start()
+    await transport.send("from@x.com", ["a@x.com", "bcc@x.com"], MESSAGE)
+    await transport.close()
+
+    files = [path] if file_format == "mbox" else list((path / "new").iterdir())
+    [stored] = [file.read_bytes() for file in files]
+    assert b"\r" not in stored
+    assert b"X-Envelope-From: from@x.com\nX-Envelope-To: a@x.com, bcc@x.com\n" in stored
+    assert b"\n\nFirst line\nSecond line\n" in stored